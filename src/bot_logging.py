@@ -0,0 +1,129 @@
+# Logging pipeline of the bot: handlers only put records on a queue, a background thread writes them out.
+
+# setup_logging installs a QueueHandler on the root logger, so a log call on the event loop costs a queue put
+# instead of disk I/O. A QueueListener thread writes the records to the console and to the log file, which is
+# rotated by size (LOG_MAX_BYTES) or, if LOG_ROTATE_WHEN is set, by time (e.g. 'midnight'), keeping
+# LOG_BACKUP_COUNT old files. LOG_JSON switches the file to one JSON object per line. LOG_INFO_SAMPLE_EVERY > 1
+# keeps only the first of every N INFO (and DEBUG) records of each call site; warnings and errors are always
+# kept, and so is a record logged with extra={'sample': False}.
+
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+from datetime import datetime, timezone
+from typing import Dict, Optional, Tuple
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Attributes every LogRecord has; anything else was passed with extra= and goes into the JSON output
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'sample'}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue_handler: Optional[logging.Handler] = None
+
+
+# Formats a record as one JSON object: time, level, logger, message, exception and the extra= fields
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+# Queue handler passing the merged message and the formatted traceback separately, so the listener's formatters
+# (text or JSON) still see the exception
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+# Keeps the first of every `every` INFO/DEBUG records of each call site (logger name, file and line)
+class SamplingFilter(logging.Filter):
+    def __init__(self, every: int):
+        super().__init__()
+        self.every = every
+        self._seen: Dict[Tuple[str, str, int], int] = {}
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.every <= 1 or record.levelno > logging.INFO or not getattr(record, 'sample', True):
+            return True
+        site = (record.name, record.pathname, record.lineno)
+        with self._lock:
+            count = self._seen.get(site, 0)
+            self._seen[site] = count + 1
+            if count % self.every == 0:
+                return True
+            self.dropped += 1
+            return False
+
+
+# File handler rotating by time if `when` is set, otherwise by size
+def rotating_file_handler(path: str, max_bytes: int, backup_count: int, when: str = '') -> logging.Handler:
+    if when:
+        return logging.handlers.TimedRotatingFileHandler(path, when=when, backupCount=backup_count, encoding='utf-8')
+    return logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+
+
+# Route all logging through a queue to the console and the rotating log file. Returns the queue handler.
+def setup_logging(path: str, level: str = 'INFO', max_bytes: int = 10 * 1024 * 1024, backup_count: int = 5,
+                  when: str = '', json_format: bool = False, sample_every: int = 1) -> logging.Handler:
+    global _listener, _queue_handler
+    stop_logging()
+
+    file_handler = rotating_file_handler(path, max_bytes, backup_count, when)
+    file_handler.setFormatter(JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT))
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _queue_handler = _QueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(sample_every))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level.upper())
+
+    _listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
+    return queue_handler
+
+
+# Write out the queued records and stop the writer thread (also run at exit)
+def stop_logging():
+    global _listener, _queue_handler
+    if _queue_handler is not None:
+        logging.getLogger().removeHandler(_queue_handler)
+        _queue_handler = None
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+atexit.register(stop_logging)
@@ -0,0 +1,115 @@
+# Callback data of the inline buttons: a compact, versioned codec and an O(1) dispatcher.
+
+# Button data is encoded as '<version>|<action>|<arg>|...', e.g. '1|c|Xy3kQ' for the schedule button of class Xy3kQ.
+# Actions are short codes (Action), so the data stays far below Telegram's 64-byte limit, and a button can only
+# match the action it was built for (no prefix overlaps like 'CANCEL' vs 'CANCEL_<id>'). Data of another version,
+# e.g. a button of a message sent before an upgrade, does not decode and is answered as outdated.
+# CallbackRouter is a handler that decodes the data and looks its action up in a table of callbacks; it
+# replaces chains of regex CallbackQueryHandlers. The callback gets the decoded arguments as context.args.
+
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+from telegram import Update
+from telegram.ext import Application, BaseHandler, CallbackContext
+
+CALLBACK_VERSION = '1'
+SEPARATOR = '|'
+
+# Telegram's limit for the callback data of a button
+MAX_CALLBACK_DATA_BYTES = 64
+
+
+# Action codes of the buttons
+class Action:
+    # Generic
+    CANCEL = 'x'
+    SKIP = 's'
+    # Dashboard
+    NEWCLASS = 'nc'
+    CANCELCLASS = 'cc'
+    NEWREQUEST = 'nr'
+    SCHEDULE = 'sc'
+    # NEWCLASS
+    DATE = 'd'
+    TIME = 't'
+    BACK_TO_DATE = 'bd'
+    # CANCELCLASS
+    PICK_CLASS_TO_CANCEL = 'pc'
+    CONFIRM_CANCEL = 'yc'
+    BACK_TO_CLASS_LIST = 'bl'
+    # SCHEDULE
+    PREV_DAY = 'pd'
+    NEXT_DAY = 'nd'
+    CLASS = 'c'
+    MODE = 'm'
+    PAGE = 'p'
+    RANGE_PREV = 'rp'
+    RANGE_NEXT = 'rn'
+    DAY = 'dy'
+    EDIT_STATUS = 'es'
+    STATUS = 'st'
+    DELETE_CLASS = 'dc'
+    CONFIRM_DELETE = 'yd'
+    BACK_TO_SCHEDULE = 'bs'
+    BULK_START = 'bk'
+    BULK_TOGGLE = 'bt'
+    BULK_ALL = 'ba'
+    BULK_STATUS = 'bx'
+
+
+class CallbackData(NamedTuple):
+    action: str
+    args: List[str]
+
+
+# Encode the callback data of a button. Raises ValueError if an argument contains the separator or the data is
+# longer than Telegram allows.
+def encode(action: str, *args: Any) -> str:
+    parts = [CALLBACK_VERSION, action]
+    for arg in args:
+        arg = str(arg)
+        if SEPARATOR in arg:
+            raise ValueError(f"Callback argument {arg!r} contains {SEPARATOR!r}")
+        parts.append(arg)
+    data = SEPARATOR.join(parts)
+    if len(data.encode('utf-8')) > MAX_CALLBACK_DATA_BYTES:
+        raise ValueError(f"Callback data {data!r} is longer than {MAX_CALLBACK_DATA_BYTES} bytes")
+    return data
+
+
+# Decode callback data, or None if it is not of the current version
+def decode(data: Optional[str]) -> Optional[CallbackData]:
+    if not isinstance(data, str):
+        return None
+    parts = data.split(SEPARATOR)
+    if len(parts) < 2 or parts[0] != CALLBACK_VERSION:
+        return None
+    return CallbackData(parts[1], parts[2:])
+
+
+class CallbackRouter(BaseHandler[Update, CallbackContext, Any]):
+    # routes: action -> callback. fallback: optional callback for callback queries no route accepts (unknown
+    # or outdated data); without it such queries are left to the next handlers.
+    def __init__(self, routes: Dict[str, Callable], fallback: Optional[Callable] = None, block: bool = True):
+        super().__init__(self._route, block=block)
+        self.routes = dict(routes)
+        self.fallback = fallback
+
+    def check_update(self, update: object) -> Optional[CallbackData]:
+        if not isinstance(update, Update) or update.callback_query is None:
+            return None
+        callback_data = decode(update.callback_query.data)
+        if callback_data is not None and callback_data.action in self.routes:
+            return callback_data
+        if self.fallback is not None:
+            return CallbackData('', [])
+        return None
+
+    def collect_additional_context(self, context: CallbackContext, update: Update, application: Application,
+                                   check_result: CallbackData) -> None:
+        context.args = check_result.args
+
+    # The handler's callback: run the route of the button's action, or the fallback for data no route accepts
+    async def _route(self, update: Update, context: CallbackContext) -> Any:
+        callback_data = decode(update.callback_query.data)
+        callback = self.routes.get(callback_data.action) if callback_data is not None else None
+        return await (callback or self.fallback)(update, context)
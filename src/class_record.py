@@ -0,0 +1,118 @@
+# Compact read-only view of a class document, shared by all the list and keyboard renderers.
+
+# The UTC startdate is parsed once per distinct ISO string (parse_startdate is memoized, as the same
+# classes are rendered again and again) and the local Saint Petersburg time and its display text are
+# computed on first use and kept on the record. Records also answer record['field'] / record.get('field')
+# with the Firestore field names, so code written against the document dicts keeps working.
+
+from datetime import datetime
+from functools import lru_cache
+from typing import Any, Dict, Optional
+from zoneinfo import ZoneInfo
+
+# Define the time zone for Saint Petersburg
+ST_PETERSBURG = ZoneInfo('Europe/Moscow')
+
+# Display format of class start times
+START_FORMAT = '%d.%m.%Y %H:%M'
+
+# Firestore field name -> record attribute
+_FIELDS = {
+    'id': 'id',
+    'userId': 'user_id',
+    'status': 'status',
+    'startdate': 'startdate',
+    'enddate': 'enddate',
+    'message': 'message',
+    'isMembershipUsed': 'is_membership_used',
+}
+
+
+# Parse a UTC ISO8601 startdate ('...Z' or '...+00:00'), memoized per string
+@lru_cache(maxsize=4096)
+def parse_startdate(startdate: str) -> datetime:
+    return datetime.fromisoformat(startdate.replace('Z', '+00:00'))
+
+
+# Local display text ('DD.MM.YYYY HH:MM') of a UTC ISO8601 startdate, memoized per string
+@lru_cache(maxsize=4096)
+def format_local_start(startdate: str) -> str:
+    return parse_startdate(startdate).astimezone(ST_PETERSBURG).strftime(START_FORMAT)
+
+
+class ClassRecord:
+    __slots__ = ('id', 'user_id', 'status', 'startdate', 'enddate', 'message', 'is_membership_used', 'start', '_local_start', '_start_text')
+
+    def __init__(self, id: str, user_id: str, status: str, startdate: str, enddate: str = '', message: str = '',
+                 is_membership_used: bool = False):
+        self.id = id
+        self.user_id = user_id
+        self.status = status
+        self.startdate = startdate
+        self.enddate = enddate
+        self.message = message
+        self.is_membership_used = is_membership_used
+        # Start time as an aware UTC datetime
+        self.start = parse_startdate(startdate)
+        self._local_start = None
+        self._start_text = None
+
+    # Build a record from a class document (its dict plus the document ID)
+    @classmethod
+    def from_dict(cls, class_data: Dict[str, Any], class_id: Optional[str] = None) -> 'ClassRecord':
+        return cls(
+            id=class_id or class_data.get('id', ''),
+            user_id=class_data.get('userId', ''),
+            status=class_data.get('status', ''),
+            startdate=class_data['startdate'],
+            enddate=class_data.get('enddate', ''),
+            message=class_data.get('message', ''),
+            is_membership_used=class_data.get('isMembershipUsed', False),
+        )
+
+    # Start time in the Saint Petersburg time zone
+    @property
+    def local_start(self) -> datetime:
+        if self._local_start is None:
+            self._local_start = self.start.astimezone(ST_PETERSBURG)
+        return self._local_start
+
+    # Start time as displayed to users, e.g. '07.10.2024 14:00'
+    @property
+    def start_text(self) -> str:
+        if self._start_text is None:
+            self._start_text = format_local_start(self.startdate)
+        return self._start_text
+
+    # Start time and status, e.g. '07.10.2024 14:00 | статус: подтверждено'
+    @property
+    def label(self) -> str:
+        return f"{self.start_text} | статус: {self.status}"
+
+    # The class as a document dict with the Firestore field names
+    def to_dict(self) -> Dict[str, Any]:
+        return {field: getattr(self, attribute) for field, attribute in _FIELDS.items()}
+
+    def __getitem__(self, field: str) -> Any:
+        if field not in _FIELDS:
+            raise KeyError(field)
+        return getattr(self, _FIELDS[field])
+
+    def get(self, field: str, default: Any = None) -> Any:
+        return getattr(self, _FIELDS[field]) if field in _FIELDS else default
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, ClassRecord) and self.to_dict() == other.to_dict()
+
+    def __repr__(self) -> str:
+        return f"ClassRecord(id={self.id!r}, start={self.start_text!r}, status={self.status!r}, user_id={self.user_id!r})"
+
+    # Pickled (persistence) and copied without the memoized values
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state: Dict[str, Any]):
+        self.__init__(
+            state['id'], state['userId'], state['status'], state['startdate'], state['enddate'],
+            state['message'], state['isMembershipUsed'],
+        )
@@ -0,0 +1,86 @@
+# Holds tunable runtime settings read from environment variables (the .env file is loaded here).
+
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Number of worker threads running blocking Firestore calls off the asyncio event loop
+FIRESTORE_MAX_WORKERS = int(os.getenv('FIRESTORE_MAX_WORKERS', '8'))
+
+# User profile cache: maximum number of cached profiles and seconds before an entry expires
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '1024'))
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', '300'))
+
+# Seconds before a day of the occupied-slot index is reloaded from Firestore
+SLOT_INDEX_TTL = float(os.getenv('SLOT_INDEX_TTL', '60'))
+
+# Attempts of a booking or cancellation transaction before giving up under contention
+TRANSACTION_MAX_ATTEMPTS = int(os.getenv('TRANSACTION_MAX_ATTEMPTS', '5'))
+
+# Seconds a cached schedule window (one week of classes per admin) is served before it is reloaded
+SCHEDULE_CACHE_TTL = float(os.getenv('SCHEDULE_CACHE_TTL', '60'))
+
+# Live index: keep classes and users in memory with Firestore snapshot listeners ('true' to enable), the days
+# of classes listened to before and after today and the seconds between moves of that window
+LIVE_INDEX = os.getenv('LIVE_INDEX', 'false').lower() == 'true'
+LIVE_INDEX_PAST_DAYS = int(os.getenv('LIVE_INDEX_PAST_DAYS', '7'))
+LIVE_INDEX_FUTURE_DAYS = int(os.getenv('LIVE_INDEX_FUTURE_DAYS', '60'))
+LIVE_INDEX_REFRESH = float(os.getenv('LIVE_INDEX_REFRESH', '3600'))
+
+# Background jobs ('false' to disable): reminders of the classes starting within REMINDER_LEAD_HOURS, checked every
+# REMINDER_INTERVAL seconds, and confirmed classes of the last AUTO_STATUS_LOOKBACK_DAYS marked as done once they
+# ended, checked every AUTO_STATUS_INTERVAL seconds
+JOBS_ENABLED = os.getenv('JOBS_ENABLED', 'true').lower() == 'true'
+REMINDER_LEAD_HOURS = float(os.getenv('REMINDER_LEAD_HOURS', '24'))
+REMINDER_INTERVAL = float(os.getenv('REMINDER_INTERVAL', '600'))
+AUTO_STATUS_INTERVAL = float(os.getenv('AUTO_STATUS_INTERVAL', '900'))
+AUTO_STATUS_LOOKBACK_DAYS = int(os.getenv('AUTO_STATUS_LOOKBACK_DAYS', '7'))
+
+# How updates are received: 'polling' (default) or 'webhook'
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+
+# Webhook mode: public base URL registered with Telegram, local address of the embedded web server
+# and an optional secret Telegram sends back in every request
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8000'))
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN', '')
+
+# Update processing: handlers running concurrently across chats (updates of one chat always run in order)
+# and updates admitted at once, running or waiting for their chat
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '16'))
+UPDATE_MAX_PENDING = int(os.getenv('UPDATE_MAX_PENDING', '256'))
+
+# Number of chats whose last pushed command list is remembered to skip redundant set_my_commands calls
+COMMAND_CACHE_SIZE = int(os.getenv('COMMAND_CACHE_SIZE', '4096'))
+
+# Outgoing Telegram requests: overall and per-chat rates, burst size per chat, group rate and retries after a 429
+RATE_LIMIT_GLOBAL_PER_SECOND = float(os.getenv('RATE_LIMIT_GLOBAL_PER_SECOND', '30'))
+RATE_LIMIT_CHAT_PER_SECOND = float(os.getenv('RATE_LIMIT_CHAT_PER_SECOND', '1'))
+RATE_LIMIT_CHAT_BURST = float(os.getenv('RATE_LIMIT_CHAT_BURST', '3'))
+RATE_LIMIT_GROUP_PER_MINUTE = float(os.getenv('RATE_LIMIT_GROUP_PER_MINUTE', '20'))
+RATE_LIMIT_MAX_RETRIES = int(os.getenv('RATE_LIMIT_MAX_RETRIES', '3'))
+
+# Persistence of conversation states and user/chat/bot data across restarts: 'none' (default) or 'sqlite',
+# the SQLite file and the seconds between writes of the changed entries
+PERSISTENCE_BACKEND = os.getenv('PERSISTENCE_BACKEND', 'none').lower()
+PERSISTENCE_PATH = os.getenv('PERSISTENCE_PATH', 'bot_state.sqlite3')
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv('PERSISTENCE_UPDATE_INTERVAL', '30'))
+
+# Metrics: local address of the JSON endpoint in polling mode (GET /metrics, port 0 disables it; in webhook mode the
+# endpoint is served by the webhook app) and seconds between summary log lines
+# (0 disables them)
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9090'))
+METRICS_LOG_INTERVAL = float(os.getenv('METRICS_LOG_INTERVAL', '300'))
+
+# Logging: log file and level, rotation by size (bytes per file) or by time (LOG_ROTATE_WHEN, e.g. 'midnight'),
+# rotated files kept, JSON lines in the file ('true') and 1-in-N sampling of the INFO records of each call site
+LOG_FILE = os.getenv('LOG_FILE', 'bot.log')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+LOG_ROTATE_WHEN = os.getenv('LOG_ROTATE_WHEN', '')
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '5'))
+LOG_JSON = os.getenv('LOG_JSON', 'false').lower() == 'true'
+LOG_INFO_SAMPLE_EVERY = int(os.getenv('LOG_INFO_SAMPLE_EVERY', '1'))
@@ -2,21 +2,95 @@
 # fetching user data, classes, adding new classes, and handling requests.
 
 # Initialization: The initialize_firebase function initializes the Firebase Admin SDK. 
+# Concurrency: Firestore calls are blocking (gRPC), so every helper runs in a bounded thread pool
+# and is awaited by the handlers. The blocking version of a helper is available as `helper.__wrapped__`.
+# Caching: user profiles are served from an in-process LRU+TTL cache (user_cache) before querying Firestore.
+# Live index: when LIVE_INDEX is enabled, the read helpers answer from live_index (kept current by snapshot
+# listeners, see live_index.py) first, and the write helpers apply the bot's own changes to it.
+# Metrics: the public coroutine helpers are timed by metrics.instrument_functions (applied at the end of this
+# module), and every call through run_blocking is counted for the handler run that issued it.
+# Class reads return ClassRecord view-models (see class_record.py) rather than raw document dicts.
 
 # User Operations: Functions like get_user_by_telegram_username fetch user data based on the Telegram username.
 # Class Operations: Functions to fetch classes, add new classes, and update class statuses.
+# Booking: book_class runs as a transaction that claims a deterministic document in 'slots', so a time slot
+# can only be booked once, and updates the user with ArrayUnion/Increment. cancel_class is its counterpart and
+# holds the refund policy shared by student cancellations and admin deletions.
 # Request Operations: Function to add new user requests.
 
+import asyncio
+import functools
+import logging
 import firebase_admin
+from concurrent.futures import ThreadPoolExecutor
 from firebase_admin import credentials, firestore
-from datetime import datetime
+from google.api_core import exceptions as google_exceptions
+from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Callable, Tuple, TypeVar
+from config import (
+    FIRESTORE_MAX_WORKERS, USER_CACHE_SIZE, USER_CACHE_TTL, TRANSACTION_MAX_ATTEMPTS,
+    LIVE_INDEX_PAST_DAYS, LIVE_INDEX_FUTURE_DAYS, LIVE_INDEX_REFRESH,
+)
+from user_cache import UserCache
+from class_record import ClassRecord
+from live_index import LiveIndex, NOT_INDEXED
+from metrics import count_firestore_call, instrument_functions
 # from utils import ST_PETERSBURG
 
 # Define the time zone for Saint Petersburg
 ST_PETERSBURG = ZoneInfo('Europe/Moscow')
 
+T = TypeVar('T')
+
+# Maximum number of document references sent in a single get_all round trip
+GET_ALL_CHUNK_SIZE = 100
+
+# Maximum number of writes in a single batched commit (Firestore's limit)
+BATCH_WRITE_SIZE = 500
+
+# Cache of user profiles shared by all handlers
+user_cache = UserCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+# Snapshot-fed indexes of classes and users, answering reads once start_live_index was awaited
+live_index = LiveIndex(past_days=LIVE_INDEX_PAST_DAYS, future_days=LIVE_INDEX_FUTURE_DAYS)
+_live_index_task: Optional[asyncio.Task] = None
+
+# Thread pool for blocking Firestore calls, created on first use
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+# Get the Firestore thread pool, sized by FIRESTORE_MAX_WORKERS
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=FIRESTORE_MAX_WORKERS, thread_name_prefix='firestore')
+    return _executor
+
+
+# Shut down the Firestore thread pool (called once the bot stops)
+def shutdown_executor() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+# Run a blocking callable in the Firestore thread pool without blocking the event loop
+async def run_blocking(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    loop = asyncio.get_running_loop()
+    count_firestore_call()
+    return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+
+
+# Decorator turning a blocking Firestore helper into a coroutine function executed in the thread pool
+def offload(func: Callable[..., T]) -> Callable[..., Any]:
+    @functools.wraps(func)
+    async def wrapper(*args: Any, **kwargs: Any) -> T:
+        return await run_blocking(func, *args, **kwargs)
+    return wrapper
+
+
 # Initialize Firebase Admin SDK (Ensure this is called once)
 def initialize_firebase(service_account_key_path: str) -> firestore.client:
     if not firebase_admin._apps:
@@ -24,8 +98,45 @@ def initialize_firebase(service_account_key_path: str) -> firestore.client:
         firebase_admin.initialize_app(cred)
     return firestore.client()
 
-# Fetch user data by Telegram username
-def get_user_by_telegram_username(db: firestore.client, telegram_username: str) -> Optional[Dict[str, Any]]:
+# Get hit/miss counters of the user profile cache
+def get_user_cache_stats() -> Dict[str, Any]:
+    return user_cache.stats()
+
+
+# Start the snapshot listeners of the live index and roll its classes window every LIVE_INDEX_REFRESH seconds
+async def start_live_index(db: firestore.client) -> None:
+    global _live_index_task
+    await run_blocking(live_index.start, db)
+    _live_index_task = asyncio.create_task(_roll_live_index(db))
+    logging.info(f"Live index started: {live_index.stats()}")
+
+
+async def _roll_live_index(db: firestore.client) -> None:
+    while True:
+        await asyncio.sleep(LIVE_INDEX_REFRESH)
+        try:
+            await run_blocking(live_index.roll, db)
+        except Exception as e:
+            logging.error(f"Error rolling the live index window: {e}")
+
+
+# Stop the snapshot listeners of the live index
+async def stop_live_index() -> None:
+    global _live_index_task
+    if _live_index_task is not None:
+        _live_index_task.cancel()
+        _live_index_task = None
+    await run_blocking(live_index.stop)
+
+
+# Forget the cached state of a user changed server-side
+def _invalidate_user(user_id: str) -> None:
+    user_cache.invalidate(user_id=user_id)
+    live_index.invalidate_user(user_id)
+
+
+# Query user data by Telegram username (blocking, bypasses the cache)
+def _query_user_by_telegram_username(db: firestore.client, telegram_username: str) -> Optional[Dict[str, Any]]:
     users_ref = db.collection('users')
     query = users_ref.where('telegram', '==', telegram_username).stream()
     user_docs = list(query)
@@ -37,8 +148,21 @@ def get_user_by_telegram_username(db: firestore.client, telegram_username: str)
     return None
 
 
-# Get User Data by User ID
-def get_user_by_id(db: firestore.client, user_id: str) -> Optional[Dict[str, Any]]:
+# Fetch user data by Telegram username
+async def get_user_by_telegram_username(db: firestore.client, telegram_username: str) -> Optional[Dict[str, Any]]:
+    user_data = live_index.get_user_by_username(telegram_username)
+    if user_data is not NOT_INDEXED:
+        return user_data
+    user_data = user_cache.get_by_username(telegram_username)
+    if user_data is None:
+        user_data = await run_blocking(_query_user_by_telegram_username, db, telegram_username)
+        if user_data:
+            user_cache.put(user_data)
+    return user_data
+
+
+# Read user data by User ID (blocking, bypasses the cache)
+def _read_user_by_id(db: firestore.client, user_id: str) -> Optional[Dict[str, Any]]:
     user_doc = db.collection('users').document(user_id).get()
     if user_doc.exists:
         user_data = user_doc.to_dict()
@@ -47,55 +171,282 @@ def get_user_by_id(db: firestore.client, user_id: str) -> Optional[Dict[str, Any
     return None
 
 
-# Fetch classes by class IDs
-def get_classes_by_ids(db: firestore.client, class_ids: List[str]) -> List[Dict[str, Any]]:
-    classes = []
-    for class_id in class_ids:
-        class_doc = db.collection('classes').document(str(class_id)).get()
-        if class_doc.exists:
-            class_data = class_doc.to_dict()
-            class_data['id'] = class_doc.id  # Ensure the class ID is included
-            classes.append(class_data)        
-    return classes
+# Get User Data by User ID
+async def get_user_by_id(db: firestore.client, user_id: str) -> Optional[Dict[str, Any]]:
+    user_data = live_index.get_user_by_id(user_id)
+    if user_data is not NOT_INDEXED:
+        return user_data
+    user_data = user_cache.get_by_id(user_id)
+    if user_data is None:
+        user_data = await run_blocking(_read_user_by_id, db, user_id)
+        if user_data:
+            user_cache.put(user_data)
+    return user_data
 
 
-# Fetch occupied time slots for a specific date
-def get_occupied_time_slots(db: firestore.client, selected_date: str) -> List[str]:
-    occupied_slots = []
-    classes_ref = db.collection('classes')
-    start_datetime = f"{selected_date}T00:00:00+00:00"
-    end_datetime = f"{selected_date}T23:59:59+00:00"
-    booked_classes = classes_ref.where('startdate', '>=', start_datetime).where('startdate', '<=', end_datetime).stream()
-    for class_doc in booked_classes:
-        class_data = class_doc.to_dict()
-        startdate_str = class_data['startdate']
-        startdate = datetime.fromisoformat(startdate_str.replace('Z', '+00:00'))
-        local_startdate = startdate.astimezone(ST_PETERSBURG)
-        time = local_startdate.strftime('%H:%M')
-        occupied_slots.append(time)
-    return occupied_slots
-
-
-# Fetch Classes by Date
-def get_classes_by_date(db: firestore.client, date_str: str) -> List[Dict[str, Any]]:
-    classes = []
+# Fetch several users by their document IDs, keyed by user ID. Cache misses are resolved in one batched read.
+async def get_users_by_ids(db: firestore.client, user_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    users = {}
+    missing_ids = []
+    for user_id in dict.fromkeys(user_ids):
+        user_data = live_index.get_user_by_id(user_id)
+        if user_data is NOT_INDEXED:
+            user_data = user_cache.get_by_id(user_id)
+        if user_data is None:
+            missing_ids.append(user_id)
+        else:
+            users[user_id] = user_data
+    if missing_ids:
+        fetched, not_found_ids = await run_blocking(get_documents_by_ids, db, 'users', missing_ids)
+        if not_found_ids:
+            logging.warning(f"Users not found: {not_found_ids}")
+        for user_data in fetched:
+            user_cache.put(user_data)
+            users[user_data['id']] = user_data
+    return users
+
+
+# Read a single class by its document ID (blocking, bypasses the live index)
+def _read_class_by_id(db: firestore.client, class_id: str) -> Optional[ClassRecord]:
+    class_doc = db.collection('classes').document(str(class_id)).get()
+    if class_doc.exists:
+        return ClassRecord.from_dict(class_doc.to_dict(), class_doc.id)
+    return None
+
+
+# Fetch a single class by its document ID
+async def get_class_by_id(db: firestore.client, class_id: str) -> Optional[ClassRecord]:
+    class_record = live_index.get_class(str(class_id))
+    if class_record is not NOT_INDEXED:
+        return class_record
+    return await run_blocking(_read_class_by_id, db, class_id)
+
+
+# Fetch documents of a collection by IDs in chunked get_all round trips.
+# Returns the found documents in input order (duplicates dropped) and the list of missing IDs.
+def get_documents_by_ids(db: firestore.client, collection: str, doc_ids: List[str]) -> Tuple[List[Dict[str, Any]], List[str]]:
+    ordered_ids = list(dict.fromkeys(str(doc_id) for doc_id in doc_ids))
+    found = {}
+    collection_ref = db.collection(collection)
+    for i in range(0, len(ordered_ids), GET_ALL_CHUNK_SIZE):
+        refs = [collection_ref.document(doc_id) for doc_id in ordered_ids[i:i + GET_ALL_CHUNK_SIZE]]
+        for doc in db.get_all(refs):
+            if doc.exists:
+                doc_data = doc.to_dict()
+                doc_data['id'] = doc.id  # Ensure the document ID is included
+                found[doc.id] = doc_data
+    documents = [found[doc_id] for doc_id in ordered_ids if doc_id in found]
+    missing_ids = [doc_id for doc_id in ordered_ids if doc_id not in found]
+    return documents, missing_ids
+
+
+# Read classes by class IDs (blocking, bypasses the live index)
+def _read_classes_by_ids(db: firestore.client, class_ids: List[str]) -> List[ClassRecord]:
+    classes, missing_ids = get_documents_by_ids(db, 'classes', class_ids)
+    if missing_ids:
+        logging.warning(f"Classes not found: {missing_ids}")
+    return [ClassRecord.from_dict(class_data) for class_data in classes]
+
+
+# Fetch classes by class IDs. Classes missing from the live index are resolved in one batched read.
+async def get_classes_by_ids(db: firestore.client, class_ids: List[str]) -> List[ClassRecord]:
+    ordered_ids = list(dict.fromkeys(str(class_id) for class_id in class_ids))
+    indexed = {}
+    for class_id in ordered_ids:
+        class_record = live_index.get_class(class_id)
+        if class_record is not NOT_INDEXED:
+            indexed[class_id] = class_record
+    missing_ids = [class_id for class_id in ordered_ids if class_id not in indexed]
+    if missing_ids:
+        for class_record in await run_blocking(_read_classes_by_ids, db, missing_ids):
+            indexed[class_record.id] = class_record
+    return [indexed[class_id] for class_id in ordered_ids if class_id in indexed]
+
+
+# Format of the UTC bounds of startdate range queries. Bounds carry no zone suffix, so a bound sorts before
+# every stored startdate of the same second, whether it was written as '...Z', '....000Z' or '...+00:00'.
+RANGE_BOUND_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+# UTC range bound of a local (Saint Petersburg) time. Naive datetimes are taken as local time.
+def utc_range_bound(local_time: datetime) -> str:
+    if local_time.tzinfo is None:
+        local_time = local_time.replace(tzinfo=ST_PETERSBURG)
+    return local_time.astimezone(ZoneInfo('UTC')).strftime(RANGE_BOUND_FORMAT)
+
+
+# Local midnight of a day ('YYYY-MM-DD') and of the next day
+def local_day_bounds(date_str: str) -> Tuple[datetime, datetime]:
+    day_start = datetime.strptime(date_str, '%Y-%m-%d').replace(tzinfo=ST_PETERSBURG)
+    return day_start, day_start + timedelta(days=1)
+
+
+# Stream the class documents starting in [start_local, end_local)
+def _stream_classes_between(db: firestore.client, start_local: datetime, end_local: datetime):
     classes_ref = db.collection('classes')
-    start_datetime = f"{date_str}T00:00:00+00:00"
-    end_datetime = f"{date_str}T23:59:59+00:00"
-    booked_classes = classes_ref.where('startdate', '>=', start_datetime).where('startdate', '<=', end_datetime).stream()
-    for class_doc in booked_classes:
-        class_data = class_doc.to_dict()
-        class_data['id'] = class_doc.id
-        classes.append(class_data)
+    return (
+        classes_ref
+        .where('startdate', '>=', utc_range_bound(start_local))
+        .where('startdate', '<', utc_range_bound(end_local))
+        .stream()
+    )
+
+
+# Read the classes starting in [start_local, end_local) with one range query, ordered by start time (blocking)
+def _read_classes_between(db: firestore.client, start_local: datetime, end_local: datetime) -> List[ClassRecord]:
+    classes = [
+        ClassRecord.from_dict(class_doc.to_dict(), class_doc.id)
+        for class_doc in _stream_classes_between(db, start_local, end_local)
+    ]
+    classes.sort(key=lambda class_record: class_record.start)
     return classes
 
 
+# Fetch the classes starting in [start_local, end_local), ordered by start time
+async def get_classes_between(db: firestore.client, start_local: datetime, end_local: datetime) -> List[ClassRecord]:
+    classes = live_index.get_classes_between(start_local, end_local)
+    if classes is not NOT_INDEXED:
+        return classes
+    return await run_blocking(_read_classes_between, db, start_local, end_local)
+
+
+# Fetch occupied time slots ('HH:MM', local time) for a specific local date
+async def get_occupied_time_slots(db: firestore.client, selected_date: str) -> List[str]:
+    booked_classes = await get_classes_between(db, *local_day_bounds(selected_date))
+    return [class_record.local_start.strftime('%H:%M') for class_record in booked_classes]
+
+
+# Fetch Classes by (local) Date
+async def get_classes_by_date(db: firestore.client, date_str: str) -> List[ClassRecord]:
+    return await get_classes_between(db, *local_day_bounds(date_str))
+
+
+# Raised when the requested class slot is already booked
+class SlotTakenError(Exception):
+    pass
+
+
+# ID of the slot document claimed by a class starting at the given UTC ISO8601 time, e.g. '2024-10-01T07:00'
+def slot_document_id(startdate: str) -> str:
+    utc_start = datetime.fromisoformat(startdate.replace('Z', '+00:00')).astimezone(ZoneInfo('UTC'))
+    return utc_start.strftime('%Y-%m-%dT%H:%M')
+
+
+# Books a class inside a transaction (retried by Firestore on contention). Reads the user, the slot document and
+# the classes starting in the same hour, then writes the class, the slot and the user update atomically.
+@firestore.transactional
+def _book_class_in_transaction(transaction, db: firestore.client, user_id: str, class_data: Dict[str, Any]) -> Dict[str, Any]:
+    user_ref = db.collection('users').document(user_id)
+    slot_ref = db.collection('slots').document(slot_document_id(class_data['startdate']))
+
+    user_doc = user_ref.get(transaction=transaction)
+    if not user_doc.exists:
+        raise ValueError(f"User {user_id} not found")
+
+    # A slot document whose class no longer exists (e.g. deleted in the web app) is stale and may be reclaimed
+    slot_doc = slot_ref.get(transaction=transaction)
+    if slot_doc.exists:
+        claimed_class_id = slot_doc.to_dict().get('classId')
+        if claimed_class_id and db.collection('classes').document(claimed_class_id).get(transaction=transaction).exists:
+            raise SlotTakenError(slot_ref.id)
+
+    # Classes created outside the bot do not claim slot documents, so check the classes of that hour as well
+    hour_start = datetime.strptime(slot_ref.id, '%Y-%m-%dT%H:%M')
+    same_hour_classes = (
+        db.collection('classes')
+        .where('startdate', '>=', hour_start.isoformat())
+        .where('startdate', '<', (hour_start + timedelta(hours=1)).isoformat())
+        .limit(1)
+        .stream(transaction=transaction)
+    )
+    if list(same_hour_classes):
+        raise SlotTakenError(slot_ref.id)
+
+    # Use a membership point if the user has one
+    is_membership_used = (user_doc.to_dict().get('membership') or 0) > 0
+
+    class_ref = db.collection('classes').document()
+    booked_class = dict(class_data, id=class_ref.id, isMembershipUsed=is_membership_used, userId=user_id)
+    transaction.set(class_ref, booked_class)
+    transaction.set(slot_ref, {'classId': class_ref.id, 'userId': user_id, 'startdate': booked_class['startdate']})
+
+    user_update_data = {'classes': firestore.ArrayUnion([class_ref.id])}
+    if is_membership_used:
+        user_update_data['membership'] = firestore.Increment(-1)
+    transaction.update(user_ref, user_update_data)
+    return booked_class
+
+
+# Book a class for a user. Returns the saved class data, raises SlotTakenError if the slot is already booked.
+async def book_class(db: firestore.client, user_id: str, class_data: Dict[str, Any]) -> Dict[str, Any]:
+    transaction = db.transaction(max_attempts=TRANSACTION_MAX_ATTEMPTS)
+    booked_class = await run_blocking(_book_class_in_transaction, transaction, db, user_id, class_data)
+    live_index.put_class(ClassRecord.from_dict(booked_class))
+    # Membership and classes were changed server-side
+    _invalidate_user(user_id)
+    return booked_class
+
+
+# Refund policy: a membership point used for a class is returned if the class is cancelled at least 24 hours
+# before it starts, or if it was not confirmed (still pending or cancelled by the tutor)
+def is_refund_due(class_data: Dict[str, Any], now: Optional[datetime] = None) -> bool:
+    if not class_data.get('isMembershipUsed', False):
+        return False
+    now = now or datetime.now(ZoneInfo('UTC'))
+    class_start = datetime.fromisoformat(class_data['startdate'].replace('Z', '+00:00'))
+    hours_difference = (class_start - now).total_seconds() / 3600
+    return hours_difference >= 24 or class_data.get('status') in ['в ожидании', 'отменено']
+
+
+# Cancels a class inside a transaction: deletes the class and its slot document and removes it from the user,
+# refunding the membership point server-side. Returns None if the class does not exist (already cancelled).
+@firestore.transactional
+def _cancel_class_in_transaction(transaction, db: firestore.client, class_id: str) -> Optional[Dict[str, Any]]:
+    class_ref = db.collection('classes').document(class_id)
+    class_doc = class_ref.get(transaction=transaction)
+    if not class_doc.exists:
+        return None
+    class_data = class_doc.to_dict()
+    class_data['id'] = class_doc.id
+
+    # All reads have to happen before the first write
+    slot_ref = db.collection('slots').document(slot_document_id(class_data['startdate']))
+    slot_doc = slot_ref.get(transaction=transaction)
+    user_ref = db.collection('users').document(class_data['userId'])
+    user_doc = user_ref.get(transaction=transaction)
+
+    refunded = is_refund_due(class_data)
+    transaction.delete(class_ref)
+    if slot_doc.exists and slot_doc.to_dict().get('classId') == class_id:
+        transaction.delete(slot_ref)
+    if user_doc.exists:
+        user_update_data = {'classes': firestore.ArrayRemove([class_id])}
+        if refunded:
+            user_update_data['membership'] = firestore.Increment(1)
+        transaction.update(user_ref, user_update_data)
+    return {'class': class_data, 'refunded': refunded and user_doc.exists}
+
+
+# Cancel (delete) a class and apply the refund policy. Safe to call twice: returns None if the class is already gone,
+# otherwise a dict with the deleted 'class' data and whether a membership point was 'refunded'.
+async def cancel_class(db: firestore.client, class_id: str) -> Optional[Dict[str, Any]]:
+    transaction = db.transaction(max_attempts=TRANSACTION_MAX_ATTEMPTS)
+    result = await run_blocking(_cancel_class_in_transaction, transaction, db, class_id)
+    if result:
+        live_index.remove_class(class_id)
+        # Membership and classes were changed server-side
+        _invalidate_user(result['class']['userId'])
+    return result
+
+
 # Add a new class
+@offload
 def add_new_class(db: firestore.client, class_data: Dict[str, Any]) -> Optional[str]:
     try:
         new_class_ref = db.collection('classes').document()  # Create a new document reference with auto-generated ID
         class_data['id'] = new_class_ref.id  # Set the 'id' field in class_data
         new_class_ref.set(class_data)
+        live_index.put_class(ClassRecord.from_dict(class_data))
         return new_class_ref.id  # Return the document ID
     except Exception as e:
         print(f"Error adding new class: {e}")
@@ -103,10 +454,12 @@ def add_new_class(db: firestore.client, class_data: Dict[str, Any]) -> Optional[
 
 
 # Delete a class
+@offload
 def delete_class(db: firestore.client, class_id: str) -> bool:
     try:
         class_ref = db.collection('classes').document(class_id)
         class_ref.delete()
+        live_index.remove_class(class_id)
         return True
     except Exception as e:
         print(f"Error deleting class: {e}")
@@ -114,10 +467,12 @@ def delete_class(db: firestore.client, class_id: str) -> bool:
     
 
 # Update user's classes list
+@offload
 def update_user_classes(db: firestore.client, user_id: str, class_id: str) -> bool:
     try:
         user_ref = db.collection('users').document(user_id)
         user_ref.update({'classes': firestore.ArrayUnion([class_id])})
+        _invalidate_user(user_id)
         return True
     except Exception as e:
         print(f"Error updating user classes: {e}")
@@ -125,6 +480,7 @@ def update_user_classes(db: firestore.client, user_id: str, class_id: str) -> bo
 
 
 # Add a new request
+@offload
 def add_new_request(db: firestore.client, request_data: Dict[str, Any]) -> bool:
     try:
         # Create a new document reference with an auto-generated ID
@@ -138,10 +494,12 @@ def add_new_request(db: firestore.client, request_data: Dict[str, Any]) -> bool:
 
 
 # Remove a class from user's classes list
+@offload
 def remove_user_class(db: firestore.client, user_id: str, class_id: str) -> bool:
     try:
         user_ref = db.collection('users').document(user_id)
         user_ref.update({'classes': firestore.ArrayRemove([class_id])})
+        _invalidate_user(user_id)
         return True
     except Exception as e:
         print(f"Error removing class from user: {e}")
@@ -149,11 +507,48 @@ def remove_user_class(db: firestore.client, user_id: str, class_id: str) -> bool
 
 
 # Update class status
+@offload
 def update_class_status(db: firestore.client, class_id: str, status: str) -> bool:
     try:
         class_ref = db.collection('classes').document(class_id)
         class_ref.update({'status': status})
+        live_index.update_class(class_id, {'status': status})
         return True
     except Exception as e:
         print(f"Error updating class status: {e}")
         return False
+
+
+# Set the status of several classes in batched commits. Classes deleted in the meantime (e.g. in the web app)
+# are skipped: a batch that fails with NotFound is committed again with only the classes that still exist.
+# Returns the number of classes updated.
+@offload
+def update_classes_status(db: firestore.client, class_ids: List[str], status: str) -> int:
+    updated = 0
+    for i in range(0, len(class_ids), BATCH_WRITE_SIZE):
+        chunk = class_ids[i:i + BATCH_WRITE_SIZE]
+        try:
+            _commit_classes_status(db, chunk, status)
+        except google_exceptions.NotFound:
+            existing, missing_ids = get_documents_by_ids(db, 'classes', chunk)
+            logging.warning(f"Skipping deleted classes in a status update: {missing_ids}")
+            chunk = [class_data['id'] for class_data in existing]
+            if chunk:
+                _commit_classes_status(db, chunk, status)
+        for class_id in chunk:
+            live_index.update_class(class_id, {'status': status})
+        updated += len(chunk)
+    return updated
+
+
+# Commit one batch setting the status of the given classes (blocking)
+def _commit_classes_status(db: firestore.client, class_ids: List[str], status: str):
+    classes_ref = db.collection('classes')
+    batch = db.batch()
+    for class_id in class_ids:
+        batch.update(classes_ref.document(class_id), {'status': status})
+    batch.commit()
+
+
+# Time every public coroutine helper above (the thread pool and live index plumbing excluded)
+instrument_functions(globals(), exclude=('run_blocking', 'start_live_index', 'stop_live_index'))
@@ -0,0 +1,46 @@
+# Registers all the bot's handlers on an application. Shared by main.py and the load-test harness in tests/,
+# so both run exactly the same handler chain.
+
+from telegram.ext import (
+    Application,
+    CommandHandler,
+)
+from callback_data import Action, CallbackRouter
+from handlers_button import cancel_button, cancel_command, skip_button, stale_button
+from handlers_start import start
+from handlers_newclass import newclass_conv_handler
+from handlers_newrequest import newrequest_conv_handler
+from handlers_cancelclass import cancelclass_conv_handler
+from handlers_schedule import schedule_conv_handler
+from metrics import instrument_handlers
+
+
+# Add the command, conversation and button handlers. Conversations are persistent if the application has a persistence.
+# Every handler callback is wrapped by the metrics layer (latency, errors and Firestore calls per run).
+def register_handlers(application: Application, persistent: bool = False):
+    # START Command Handler
+    application.add_handler(CommandHandler('start', start))
+
+    # Add the cancel command handler
+    application.add_handler(CommandHandler('cancel', cancel_command))
+
+    # NEWCLASS Conversation Handler
+    application.add_handler(newclass_conv_handler(persistent=persistent))
+
+    # NEWREQUEST Conversation Handler
+    application.add_handler(newrequest_conv_handler(persistent=persistent))
+
+    # CANCELCLASS Conversation Handler
+    application.add_handler(cancelclass_conv_handler(persistent=persistent))
+
+    # SCHEDULE Conversation Handler
+    application.add_handler(schedule_conv_handler(persistent=persistent))
+
+    # Button Callback Handler (Handles generic buttons not managed by ConversationHandlers, and outdated buttons)
+    application.add_handler(CallbackRouter({
+        Action.CANCEL: cancel_button,
+        Action.SKIP: skip_button,
+    }, fallback=stale_button))
+
+    # Time every handler callback
+    instrument_handlers(application)
@@ -1,7 +1,6 @@
-# Handles generic button callbacks not managed by ConversationHandler instances.
+# Handles generic button callbacks not managed by ConversationHandler instances, and the /cancel command.
 
 from telegram import (
-    BotCommandScopeChat,
     BotCommand,
     Update,
 )
@@ -9,31 +8,30 @@ from telegram.ext import (
     ConversationHandler,
     CallbackContext,
 )
+from utils import set_chat_commands
 
 
-# Universal handler for buttons
-async def button_handler(update: Update, context: CallbackContext):
+# Handler for the Cancel buttons: ends the current command.
+async def cancel_button(update: Update, context: CallbackContext):
     query = update.callback_query
     await query.answer()
-    data = query.data
-
-    if data == 'CANCEL':
-        # Send a cancellation message
-        await query.edit_message_text(text="Команда отменена.")
-
-        # Reset commands to default (/start)
-        await context.bot.set_my_commands(
-            [BotCommand('start', 'Запустить бота')],
-            scope=BotCommandScopeChat(update.effective_chat.id)
-        )
-        return ConversationHandler.END
-    elif data == 'SKIP':
-        # Handle 'SKIP' action
-        pass
-    else:
-        # Handle other generic buttons if any
-        await query.edit_message_text(text="Неизвестное действие. Попробуйте ещё раз.")
-        return ConversationHandler.END
+
+    # Send a cancellation message
+    await query.edit_message_text(text="Команда отменена.")
+
+    # Reset commands to default (/start)
+    await set_chat_commands(context, update.effective_chat.id, [BotCommand('start', 'Запустить бота')])
+    return ConversationHandler.END
+
+
+# Handler for a Skip button outside the step it belongs to: nothing to skip.
+async def skip_button(update: Update, context: CallbackContext):
+    await update.callback_query.answer()
+
+
+# Handler for buttons no conversation accepts (an outdated message or a button of another version of the bot).
+async def stale_button(update: Update, context: CallbackContext):
+    await update.callback_query.answer(text="Эта кнопка больше не действует. Начните заново: /start")
 
 
 # Runs the "/cancel" command
@@ -41,8 +39,5 @@ async def cancel_command(update: Update, context: CallbackContext):
     await update.message.reply_text("Команда отменена.")
 
     # Reset commands to default (/start)
-    await context.bot.set_my_commands(
-        [BotCommand('start', 'Запустить бота')],
-        scope=BotCommandScopeChat(update.effective_chat.id)
-    )
+    await set_chat_commands(context, update.effective_chat.id, [BotCommand('start', 'Запустить бота')])
     return ConversationHandler.END
\ No newline at end of file
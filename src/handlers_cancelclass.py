@@ -1,24 +1,25 @@
 # Handles the CANCELCLASS conversation, including displaying refund policy messages based on class details.
 
 import logging
-from datetime import datetime
+from datetime import date, datetime
 from zoneinfo import ZoneInfo
 from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
-    BotCommandScopeChat,
     BotCommand,
     Update,
 )
 from telegram.ext import (
-    CallbackQueryHandler,
     ConversationHandler,
     CallbackContext,
     CommandHandler,
 )
-from firebase_utils import get_user_by_telegram_username, get_classes_by_ids
-from handlers_button import button_handler, cancel_command
-from utils import reset_user_commands, ST_PETERSBURG
+from firebase_utils import get_user_by_telegram_username, get_class_by_id, get_classes_by_ids, cancel_class
+from callback_data import Action, CallbackRouter, encode
+from handlers_button import cancel_button, cancel_command
+from slot_index import slot_index, slot_of
+from schedule_cache import schedule_cache
+from utils import set_chat_commands
 from handlers_start import start
 
 
@@ -26,6 +27,17 @@ from handlers_start import start
 SELECT_CLASS_TO_CANCEL, CONFIRM_CANCELLATION = range(2)
 
 
+# Builds the list of the user's classes to select for cancellation, with a Cancel button.
+def build_cancel_keyboard(classes: list) -> InlineKeyboardMarkup:
+    classes_buttons = []
+    for class_record in classes:
+        classes_buttons.append(
+            [InlineKeyboardButton(class_record.label, callback_data=encode(Action.PICK_CLASS_TO_CANCEL, class_record.id))]
+        )
+    classes_buttons.append([InlineKeyboardButton("Отмена", callback_data=encode(Action.CANCEL))])
+    return InlineKeyboardMarkup(classes_buttons)
+
+
  # Entry point. Displays a list of the user's classes to select for cancellation.
 async def cancelclass_start(update: Update, context: CallbackContext):
     if update.callback_query:
@@ -39,14 +51,11 @@ async def cancelclass_start(update: Update, context: CallbackContext):
         await update.message.reply_text("Выберите занятие, которое вы хотите отменить:")
 
     # Set commands relevant to CANCELCLASS
-    await context.bot.set_my_commands(
-        [BotCommand('cancel', 'Отменить команду')],
-        scope=BotCommandScopeChat(chat_id)
-    )
+    await set_chat_commands(context, chat_id, [BotCommand('cancel', 'Отменить команду')])
 
     # Get user data
     db = context.bot_data['db']
-    user_data = get_user_by_telegram_username(db, user.username)
+    user_data = await get_user_by_telegram_username(db, user.username)
     if not user_data:
         await context.bot.send_message(chat_id=chat_id, text="Данные пользователя не найдены.")
         return ConversationHandler.END
@@ -54,20 +63,8 @@ async def cancelclass_start(update: Update, context: CallbackContext):
     classes_ids = user_data.get('classes', [])
     if classes_ids:
         # Fetch user's classes
-        classes = get_classes_by_ids(db, classes_ids)
-        classes_buttons = []
-        for class_data in classes:
-            class_id = class_data.get('id')
-            # Convert UTC startdate to Saint Petersburg time zone for display
-            utc_start = datetime.fromisoformat(class_data['startdate'].replace('Z', '+00:00'))
-            spb_start = utc_start.astimezone(ST_PETERSBURG)
-            formatted_start = spb_start.strftime('%d.%m.%Y %H:%M')
-            class_info = f"{formatted_start} | статус: {class_data['status']}"
-            classes_buttons.append(
-                [InlineKeyboardButton(class_info, callback_data=f"CANCEL_{class_id}")]
-            )
-        classes_buttons.append([InlineKeyboardButton("Отмена", callback_data='CANCEL')])
-        reply_markup = InlineKeyboardMarkup(classes_buttons)
+        classes = await get_classes_by_ids(db, classes_ids)
+        reply_markup = build_cancel_keyboard(classes)
         await query.edit_message_text(text="Выберите занятие, которое вы хотите отменить:", reply_markup=reply_markup)
         return SELECT_CLASS_TO_CANCEL
     else:
@@ -79,39 +76,32 @@ async def cancelclass_start(update: Update, context: CallbackContext):
 async def select_class_to_cancel(update: Update, context: CallbackContext):
     query = update.callback_query
     await query.answer()
-    class_id = query.data.split('_')[1]
+    class_id = context.args[0]
     context.user_data['class_id_to_cancel'] = class_id
     db = context.bot_data['db']
-    class_doc = db.collection('classes').document(class_id).get()
+    class_record = await get_class_by_id(db, class_id)
     
-    if class_doc.exists:
-        class_data = class_doc.to_dict()
-        context.user_data['selected_class_data'] = class_data  # Store for later use
-
-        # Convert UTC startdate to Saint Petersburg time zone for display
-        utc_start = datetime.fromisoformat(class_data['startdate'].replace('Z', '+00:00'))
-        spb_start = utc_start.astimezone(ST_PETERSBURG)
-        formatted_start = spb_start.strftime('%d.%m.%Y %H:%M')
-        class_info = f"{formatted_start} | статус: {class_data['status']}"
+    if class_record:
+        class_info = class_record.label
 
         # Calculate hours difference
         utc_now = datetime.utcnow().replace(tzinfo=ZoneInfo('UTC'))
-        hours_difference = (utc_start - utc_now).total_seconds() / 3600
+        hours_difference = (class_record.start - utc_now).total_seconds() / 3600
 
         # Determine the message to display based on refund policy
         message = ''
         if (
             hours_difference <= 24 and
-            class_data.get('isMembershipUsed', False) and
-            class_data.get('status') == 'подтверждено'
+            class_record.is_membership_used and
+            class_record.status == 'подтверждено'
         ):
             message = (
                 "Преподаватель уже подтвердил это занятие, и до его начала остаётся менее 24 часов. "
                 "Отменив это занятие, вы потеряете занятие из абонемента."
             )
         elif (
-            class_data.get('isMembershipUsed', False) and
-            class_data.get('status') != 'выполнено'
+            class_record.is_membership_used and
+            class_record.status != 'выполнено'
         ):
             message = "Вы можете отменить урок без потери занятия из абонемента."
         else:
@@ -126,9 +116,9 @@ async def select_class_to_cancel(update: Update, context: CallbackContext):
         await query.edit_message_text(
             text=full_text,
             reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("Да, отменить", callback_data='CONFIRM_CANCEL')],
-                [InlineKeyboardButton("Нет, вернуться", callback_data='BACK_TO_CLASS_LIST')],
-                [InlineKeyboardButton("Отмена", callback_data='CANCEL')]
+                [InlineKeyboardButton("Да, отменить", callback_data=encode(Action.CONFIRM_CANCEL))],
+                [InlineKeyboardButton("Нет, вернуться", callback_data=encode(Action.BACK_TO_CLASS_LIST))],
+                [InlineKeyboardButton("Отмена", callback_data=encode(Action.CANCEL))]
             ])
         )
         return CONFIRM_CANCELLATION
@@ -142,73 +132,32 @@ async def confirm_cancellation(update: Update, context: CallbackContext):
     query = update.callback_query
     await query.answer()
     class_id = context.user_data.get('class_id_to_cancel')
-    user = query.from_user
     if not class_id:
         await query.edit_message_text(text="Не выбрано занятие для отмены.")
         return ConversationHandler.END
 
     db = context.bot_data['db']
 
-    # Get user data
-    user_data = get_user_by_telegram_username(db, user.username)
-    if not user_data:
-        await query.edit_message_text(text="Данные пользователя не найдены.")
-        return ConversationHandler.END
-
     try:
-        # Get the latest class data
-        class_doc_ref = db.collection('classes').document(class_id)
-        class_doc = class_doc_ref.get()
-        if not class_doc.exists:
+        # Delete the class and refund the membership point if the policy allows it
+        result = await cancel_class(db, class_id)
+        if not result:
             await query.edit_message_text(text="Занятие не найдено.")
             return ConversationHandler.END
-        class_data = class_doc.to_dict()
 
-        # Calculate hours difference
-        utc_now = datetime.utcnow().replace(tzinfo=ZoneInfo('UTC'))
-        class_start = datetime.fromisoformat(class_data['startdate'].replace('Z', '+00:00'))
-        hours_difference = (class_start - utc_now).total_seconds() / 3600
-
-        # Determine if refund applies
-        refund_membership = False
-        if class_data.get('isMembershipUsed', False):
-            if hours_difference >= 24:
-                refund_membership = True
-            elif class_data.get('status') in ['в ожидании', 'отменено']:
-                refund_membership = True
-
-        # Start a batch
-        batch = db.batch()
-
-        # Delete class document
-        batch.delete(class_doc_ref)
+        # Free the slot in the occupied-slot index and refresh the schedules showing that day
+        class_date, class_hour = slot_of(result['class']['startdate'])
+        slot_index.release(class_date, class_hour)
+        schedule_cache.invalidate_day(date.fromisoformat(class_date))
 
-        # Update user's classes array
-        user_ref = db.collection('users').document(user_data['id'])
-        updated_classes = user_data.get('classes', [])
-        if class_id in updated_classes:
-            updated_classes.remove(class_id)
-        # Prepare user data update
-        user_update_data = {'classes': updated_classes}
-        if refund_membership:
-            user_update_data['membership'] = user_data.get('membership', 0) + 1
-
-        batch.update(user_ref, user_update_data)
-
-        # Commit the batch
-        batch.commit()
-
-        await query.edit_message_text(text="Ваше занятие отменено.")
+        notice = "Ваше занятие отменено."
 
     except Exception as e:
         logging.error(f"Error in confirm_cancellation handler: {e}")
-        await query.edit_message_text(text="Произошла ошибка при отмене вашего занятия. Попробуйте ещё раз.")
+        notice = "Произошла ошибка при отмене вашего занятия. Попробуйте ещё раз."
 
-    # Reset commands based on user status
-    await reset_user_commands(update, context)
-
-    # Call the start function to display updated class list
-    await start(update, context)
+    # Call the start function to display the result with the updated class list (it also resets the commands)
+    await start(update, context, notice=notice)
 
     return ConversationHandler.END
 
@@ -221,7 +170,7 @@ async def back_to_class_list(update: Update, context: CallbackContext):
     # Fetch user's classes
     user = query.from_user
     db = context.bot_data['db']
-    user_data = get_user_by_telegram_username(db, user.username)
+    user_data = await get_user_by_telegram_username(db, user.username)
     if not user_data:
         await query.edit_message_text(text="Данные пользователя не найдены. Убедитесь, что ваш Telegram связан с учётной записью.")
         return ConversationHandler.END
@@ -229,18 +178,8 @@ async def back_to_class_list(update: Update, context: CallbackContext):
     classes_ids = user_data.get('classes', [])
     if classes_ids:
         # Fetch user's classes
-        classes = get_classes_by_ids(db, classes_ids)
-        buttons = []
-        for class_data in classes:
-            # Convert UTC startdate to Saint Petersburg time zone
-            utc_start = datetime.fromisoformat(class_data['startdate'].replace('Z', '+00:00'))
-            spb_start = utc_start.astimezone(ST_PETERSBURG)
-            formatted_start = spb_start.strftime('%d.%m.%Y %H:%M')
-            button_text = f"{formatted_start} | Status: {class_data['status']}"
-            buttons.append([InlineKeyboardButton(button_text, callback_data=f"CANCEL_{class_data['id']}")])
-
-        buttons.append([InlineKeyboardButton("Отмена", callback_data='CANCEL')])
-        reply_markup = InlineKeyboardMarkup(buttons)
+        classes = await get_classes_by_ids(db, classes_ids)
+        reply_markup = build_cancel_keyboard(classes)
         await query.edit_message_text(text="Выберите занятие, которое вы хотите отменить:", reply_markup=reply_markup)
         return SELECT_CLASS_TO_CANCEL
     else:
@@ -249,25 +188,25 @@ async def back_to_class_list(update: Update, context: CallbackContext):
 
 
 # Defines the ConversationHandler for the CANCELCLASS flow. States: SELECT_CLASS_TO_CANCEL and CONFIRM_CANCELLATION.
-def cancelclass_conv_handler() -> ConversationHandler:
+def cancelclass_conv_handler(persistent: bool = False) -> ConversationHandler:
     return ConversationHandler(
+        name='cancelclass',
+        persistent=persistent,
         entry_points=[
-            CallbackQueryHandler(cancelclass_start, pattern='^CANCELCLASS$'),
+            CallbackRouter({Action.CANCELCLASS: cancelclass_start}),
             CommandHandler('cancelclass', cancelclass_start)
         ],
         states={
             SELECT_CLASS_TO_CANCEL: [
-                CallbackQueryHandler(select_class_to_cancel, pattern='^CANCEL_'),
-                CallbackQueryHandler(button_handler, pattern='^CANCEL$')
+                CallbackRouter({Action.PICK_CLASS_TO_CANCEL: select_class_to_cancel}),
             ],
             CONFIRM_CANCELLATION: [
-                CallbackQueryHandler(confirm_cancellation, pattern='^CONFIRM_CANCEL$'),
-                CallbackQueryHandler(back_to_class_list, pattern='^BACK_TO_CLASS_LIST$'),  # Added handler
-                CallbackQueryHandler(button_handler, pattern='^CANCEL$')
+                CallbackRouter({Action.CONFIRM_CANCEL: confirm_cancellation, Action.BACK_TO_CLASS_LIST: back_to_class_list}),
             ],
         },
+        # Cancel buttons of every state
         fallbacks=[
-            CallbackQueryHandler(button_handler, pattern='^CANCEL$'),
+            CallbackRouter({Action.CANCEL: cancel_button}),
             CommandHandler('cancel', cancel_command),
         ],
     )
@@ -1,30 +1,68 @@
 # Handles the NEWCLASS conversation for booking new classes, including membership point usage.
 
 import logging
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
-    BotCommandScopeChat,
     BotCommand,
     Update,
 )
 from telegram.ext import (
-    CallbackQueryHandler,
     ConversationHandler,
     CallbackContext,
     MessageHandler,
     CommandHandler,
     filters,
 )
-from firebase_utils import get_user_by_telegram_username, get_occupied_time_slots
-from utils import convert_to_utc, reset_user_commands, ST_PETERSBURG
-from handlers_button import button_handler, cancel_command
+from firebase_utils import get_user_by_telegram_username, book_class, SlotTakenError
+from slot_index import slot_index, hour_bit, FIRST_HOUR, LAST_HOUR
+from schedule_cache import schedule_cache
+from utils import convert_to_utc, set_chat_commands, ST_PETERSBURG
+from callback_data import Action, CallbackRouter, encode
+from handlers_button import cancel_button, cancel_command
 from handlers_start import start
 
 # Define Conversation States for NEWCLASS
 SELECT_DATE, SELECT_TIME, ENTER_MESSAGE = range(3)
 
+SLOT_TAKEN_TEXT = "Это время уже занято. Пожалуйста, выберите другое время."
+
+
+# Builds the date picker: the weekdays of the next 7 days (starting today) and a Cancel button.
+def build_date_keyboard(today: datetime) -> InlineKeyboardMarkup:
+    dates_buttons = []
+    for i in range(0, 7):  # Start from 0 to include today
+        day = today + timedelta(days=i)
+        if day.weekday() < 5:  # Exclude weekends (0=Monday, ..., 6=Sunday)
+            display_date_str = day.strftime('%d.%m.%Y')  # DD.MM.YYYY
+            callback_date_str = day.strftime('%Y-%m-%d')  # YYYY-MM-DD
+            dates_buttons.append(
+                [InlineKeyboardButton(display_date_str, callback_data=encode(Action.DATE, callback_date_str))]
+            )
+
+    dates_buttons.append([InlineKeyboardButton("Отмена", callback_data=encode(Action.CANCEL))])
+    return InlineKeyboardMarkup(dates_buttons)
+
+
+# Builds one button per free hour of the selected date. Past hours are skipped if the date is today.
+def build_time_buttons(selected_date, now: datetime, occupied_hours: int) -> list:
+    times_buttons = []
+    is_today = selected_date == now.date()
+    for hour in range(FIRST_HOUR, LAST_HOUR):
+        # Skip past time slots if selected date is today
+        if is_today and hour <= now.hour:
+            continue
+
+        start_time = f"{hour:02d}:00"
+        end_time = f"{(hour + 1):02d}:00"
+        time_slot_display = f"{start_time} - {end_time}"
+        if not occupied_hours & hour_bit(hour):
+            times_buttons.append(
+                [InlineKeyboardButton(time_slot_display, callback_data=encode(Action.TIME, start_time))]
+            )
+    return times_buttons
+
 
 # Entry point. Asks the user to select a date for the new class.
 async def newclass_start(update: Update, context: CallbackContext):
@@ -37,25 +75,10 @@ async def newclass_start(update: Update, context: CallbackContext):
         chat_id = update.message.chat_id
 
     # Set commands relevant to NEWCLASS
-    await context.bot.set_my_commands(
-        [BotCommand('cancel', 'Отменить команду')],
-        scope=BotCommandScopeChat(chat_id)
-    )
+    await set_chat_commands(context, chat_id, [BotCommand('cancel', 'Отменить команду')])
 
     # Generate available dates
-    dates_buttons = []
-    today = datetime.now(ST_PETERSBURG)
-    for i in range(0, 7):
-        day = today + timedelta(days=i)
-        if day.weekday() < 5:  # Exclude weekends (0=Monday, ..., 6=Sunday)
-            display_date_str = day.strftime('%d.%m.%Y')  # DD.MM.YYYY
-            callback_date_str = day.strftime('%Y-%m-%d')  # YYYY-MM-DD
-            dates_buttons.append(
-                [InlineKeyboardButton(display_date_str, callback_data=f"DATE_{callback_date_str}")]
-            )
-
-    dates_buttons.append([InlineKeyboardButton("Отмена", callback_data='CANCEL')])
-    reply_markup = InlineKeyboardMarkup(dates_buttons)
+    reply_markup = build_date_keyboard(datetime.now(ST_PETERSBURG))
     # await context.bot.send_message(chat_id=query.message.chat_id, text="Available dates:", reply_markup=reply_markup)
     await context.bot.send_message(chat_id=chat_id, text="Доступные даты:", reply_markup=reply_markup)
     return SELECT_DATE
@@ -64,7 +87,7 @@ async def newclass_start(update: Update, context: CallbackContext):
 # Handles the date selection. Displays available time slots for the selected date. Filters time slots by current time.
 async def select_date(update: Update, context: CallbackContext):
     query = update.callback_query
-    selected_date = query.data.split('_')[1]
+    selected_date = context.args[0]
     context.user_data['selected_date'] = selected_date
     logging.info(f"Selected date: {selected_date}")
     selected_date_display = datetime.strptime(selected_date, '%Y-%m-%d').strftime('%d.%m.%Y')
@@ -72,32 +95,15 @@ async def select_date(update: Update, context: CallbackContext):
     await query.edit_message_text(text=f"Выбранная дата: {selected_date_display}\nВыберите время")
 
     # Generate time slots
-    times_buttons = []
     db = context.bot_data['db']
-    occupied_slots = get_occupied_time_slots(db, selected_date)
-
-    # Determine if selected date is today
-    today = datetime.now(ST_PETERSBURG).date()
+    occupied_hours = await slot_index.get_bitmap(db, selected_date)
     selected_date_obj = datetime.strptime(selected_date, '%Y-%m-%d').date()
-    current_hour = datetime.now(ST_PETERSBURG).hour
-
-    for hour in range(8, 20):
-        # Skip past time slots if selected date is today
-        if selected_date_obj == today and hour <= current_hour:
-            continue
-
-        start_time = f"{hour:02d}:00"
-        end_time = f"{(hour + 1):02d}:00"
-        time_slot_display = f"{start_time} - {end_time}"
-        if start_time not in occupied_slots:
-            times_buttons.append(
-                [InlineKeyboardButton(time_slot_display, callback_data=f"TIME_{start_time}")]
-            )
+    times_buttons = build_time_buttons(selected_date_obj, datetime.now(ST_PETERSBURG), occupied_hours)
 
     if times_buttons:
         # Add 'Back to selecting a date' button
-        times_buttons.append([InlineKeyboardButton("Назад к выбору даты", callback_data='BACK_TO_DATE')])
-        times_buttons.append([InlineKeyboardButton("Отмена", callback_data='CANCEL')])
+        times_buttons.append([InlineKeyboardButton("Назад к выбору даты", callback_data=encode(Action.BACK_TO_DATE))])
+        times_buttons.append([InlineKeyboardButton("Отмена", callback_data=encode(Action.CANCEL))])
         reply_markup = InlineKeyboardMarkup(times_buttons)
         await context.bot.send_message(chat_id=query.message.chat_id, text="Доступные слоты:", reply_markup=reply_markup)
     else:
@@ -112,14 +118,14 @@ async def select_date(update: Update, context: CallbackContext):
 # Handles the time slot selection. Asks the user to enter an additional message or skip.
 async def select_time(update: Update, context: CallbackContext):
     query = update.callback_query
-    selected_time = query.data.split('_')[1]
+    selected_time = context.args[0]
     context.user_data['selected_time'] = selected_time
     logging.info(f"Selected time: {selected_time}")
 
     # Present message input with SKIP button
     keyboard = [
-        [InlineKeyboardButton("Пропустить", callback_data='SKIP')],
-        [InlineKeyboardButton("Отмена", callback_data='CANCEL')]
+        [InlineKeyboardButton("Пропустить", callback_data=encode(Action.SKIP))],
+        [InlineKeyboardButton("Отмена", callback_data=encode(Action.CANCEL))]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     await query.edit_message_text(
@@ -129,6 +135,42 @@ async def select_time(update: Update, context: CallbackContext):
     return ENTER_MESSAGE
 
 
+# Books the selected date and time for the user with a transactional write that claims the slot and
+# takes a membership point if available. Returns the text to reply with.
+async def save_selected_class(context: CallbackContext, user_data: dict) -> str:
+    db = context.bot_data['db']
+    selected_date = context.user_data['selected_date']
+    selected_time = context.user_data['selected_time']
+    selected_hour = int(selected_time.split(':')[0])
+
+    # Reject the slot early if this process already knows it was taken after the slots were shown
+    if not await slot_index.claim(db, selected_date, selected_hour):
+        return SLOT_TAKEN_TEXT
+
+    # Prepare class data (id and isMembershipUsed are set by the transaction)
+    class_data = {
+        'status': 'в ожидании',
+        'startdate': convert_to_utc(selected_date, selected_time),
+        'enddate': convert_to_utc(selected_date, selected_time, add_hours=1),
+        'message': context.user_data['message'],
+    }
+
+    try:
+        await book_class(db, user_data['id'], class_data)
+    except SlotTakenError:
+        # Booked by someone else (possibly outside the bot), so the slot stays occupied in the index
+        return SLOT_TAKEN_TEXT
+    except Exception:
+        # Give the slot back if the class was not saved
+        slot_index.release(selected_date, selected_hour)
+        raise
+
+    # Refresh the schedules showing that day
+    schedule_cache.invalidate_day(date.fromisoformat(selected_date))
+
+    return "Вы успешно записались на следующее занятие в ΣΙΓΜΑ! Пожалуйста, подождите, пока преподаватель подтвердит занятие."
+
+
 # Handles the case when the user skips entering an additional message. Saves the class and updates the database.
 async def skip_message(update: Update, context: CallbackContext):
     query = update.callback_query
@@ -142,71 +184,19 @@ async def skip_message(update: Update, context: CallbackContext):
 
     try:
         # Get user data from Firestore
-        user_data = get_user_by_telegram_username(db, user.username)
+        user_data = await get_user_by_telegram_username(db, user.username)
         if not user_data:
             await query.message.reply_text("Данные пользователя не найдены. Убедитесь, что ваш Telegram связан с учётной записью.")
             return ConversationHandler.END
 
-        # Check membership points
-        membership_points = user_data.get('membership', 0)
-        if membership_points > 0:
-            is_membership_used = True
-            membership_points -= 1  # Decrement membership points
-        else:
-            is_membership_used = False
-
-        # Prepare class data
-        class_data = {
-            'id': '',  # Will be set in add_new_class
-            'status': 'в ожидании',
-            'startdate': convert_to_utc(context.user_data['selected_date'], context.user_data['selected_time']),
-            'enddate': convert_to_utc(
-                context.user_data['selected_date'], 
-                context.user_data['selected_time'],
-                add_hours=1
-            ),
-            'message': context.user_data['message'],
-            'isMembershipUsed': is_membership_used,
-            'userId': user_data['id'],  # Use userData.id from Firestore
-        }
-
-        # Start a batch
-        batch = db.batch()
-
-        # Create a new document reference for the class
-        class_ref = db.collection('classes').document()
-        class_data['id'] = class_ref.id
-
-        # Add the class to the batch
-        batch.set(class_ref, class_data)
-
-        # Update user's classes list
-        updated_classes = user_data.get('classes', [])
-        updated_classes.append(class_ref.id)
-        user_update_data = {
-            'classes': updated_classes
-        }
-        if is_membership_used:
-            user_update_data['membership'] = membership_points
-
-        # Update user data in the batch
-        user_ref = db.collection('users').document(user_data['id'])
-        batch.update(user_ref, user_update_data)
-
-        # Commit the batch
-        batch.commit()
-
-        await query.message.reply_text("Вы успешно записались на следующее занятие в ΣΙΓΜΑ! Пожалуйста, подождите, пока преподаватель подтвердит занятие.")
+        notice = await save_selected_class(context, user_data)
 
     except Exception as e:
         logging.error(f"Error in skip_message handler: {e}")
-        await query.message.reply_text("Произошла ошибка при сохранении вашего занятия. Попробуйте ещё раз.")
+        notice = "Произошла ошибка при сохранении вашего занятия. Попробуйте ещё раз."
 
-    # Reset commands based on user status
-    await reset_user_commands(update, context)
-
-    # Call the start function to display updated class list
-    await start(update, context)
+    # Call the start function to display the result with the updated class list (it also resets the commands)
+    await start(update, context, notice=notice)
 
     return ConversationHandler.END
 
@@ -225,71 +215,19 @@ async def enter_message(update: Update, context: CallbackContext):
 
     try:
         # Get user data from Firestore
-        user_data = get_user_by_telegram_username(db, user.username)
+        user_data = await get_user_by_telegram_username(db, user.username)
         if not user_data:
             await update.message.reply_text("Данные пользователя не найдены. Убедитесь, что ваш Telegram связан с учётной записью.")
             return ConversationHandler.END
 
-        # Check membership points
-        membership_points = user_data.get('membership', 0)
-        if membership_points > 0:
-            is_membership_used = True
-            membership_points -= 1  # Decrement membership points
-        else:
-            is_membership_used = False
-
-        # Prepare class data
-        class_data = {
-            'id': '',  # Will be set in add_new_class
-            'status': 'в ожидании',
-            'startdate': convert_to_utc(context.user_data['selected_date'], context.user_data['selected_time']),
-            'enddate': convert_to_utc(
-                context.user_data['selected_date'], 
-                context.user_data['selected_time'],
-                add_hours=1
-            ),
-            'message': context.user_data['message'],
-            'isMembershipUsed': is_membership_used,
-            'userId': user_data['id'],  # Use userData.id from Firestore
-        }
-
-        # Start a batch
-        batch = db.batch()
-
-        # Create a new document reference for the class
-        class_ref = db.collection('classes').document()
-        class_data['id'] = class_ref.id
-
-        # Add the class to the batch
-        batch.set(class_ref, class_data)
-
-        # Update user's classes list
-        updated_classes = user_data.get('classes', [])
-        updated_classes.append(class_ref.id)
-        user_update_data = {
-            'classes': updated_classes
-        }
-        if is_membership_used:
-            user_update_data['membership'] = membership_points
-
-        # Update user data in the batch
-        user_ref = db.collection('users').document(user_data['id'])
-        batch.update(user_ref, user_update_data)
-
-        # Commit the batch
-        batch.commit()
-
-        await update.message.reply_text("Вы успешно записались на следующее занятие в ΣΙΓΜΑ! Пожалуйста, подождите, пока преподаватель подтвердит занятие.")
+        notice = await save_selected_class(context, user_data)
 
     except Exception as e:
         logging.error(f"Error in enter_message handler: {e}")
-        await update.message.reply_text("Произошла ошибка при сохранении вашего занятия. Попробуйте ещё раз.")
-
-    # Reset commands based on user status
-    await reset_user_commands(update, context)
+        notice = "Произошла ошибка при сохранении вашего занятия. Попробуйте ещё раз."
 
-    # Call the start function to display updated class list
-    await start(update, context)
+    # Call the start function to display the result with the updated class list (it also resets the commands)
+    await start(update, context, notice=notice)
 
     return ConversationHandler.END
 
@@ -301,48 +239,35 @@ async def back_to_date_selection(update: Update, context: CallbackContext):
     await query.edit_message_text(text="Выберите день")
 
     # Generate available dates
-    dates_buttons = []
-    today = datetime.now(ST_PETERSBURG)
-    for i in range(0, 7):  # Start from 0 to include today
-        day = today + timedelta(days=i)
-        if day.weekday() < 5:  # Exclude weekends (0=Monday, ..., 6=Sunday)
-            display_date_str = day.strftime('%d.%m.%Y')  # DD.MM.YYYY
-            callback_date_str = day.strftime('%Y-%m-%d')  # YYYY-MM-DD
-            dates_buttons.append(
-                [InlineKeyboardButton(display_date_str, callback_data=f"DATE_{callback_date_str}")]
-            )
-
-    dates_buttons.append([InlineKeyboardButton("Отмена", callback_data='CANCEL')])
-    reply_markup = InlineKeyboardMarkup(dates_buttons)
+    reply_markup = build_date_keyboard(datetime.now(ST_PETERSBURG))
     await context.bot.send_message(chat_id=query.message.chat_id, text="Доступные даты:", reply_markup=reply_markup)
     return SELECT_DATE
 
 
 # Defines the ConversationHandler for the NEWCLASS flow. States: SELECT_DATE, SELECT_TIME and ENTER_MESSAGE.
-def newclass_conv_handler() -> ConversationHandler:
+def newclass_conv_handler(persistent: bool = False) -> ConversationHandler:
     return ConversationHandler(
+        name='newclass',
+        persistent=persistent,
         entry_points=[
-            CallbackQueryHandler(newclass_start, pattern='^NEWCLASS$'),
+            CallbackRouter({Action.NEWCLASS: newclass_start}),
             CommandHandler('newclass', newclass_start),
         ],
         states={
             SELECT_DATE: [
-                CallbackQueryHandler(select_date, pattern='^DATE_'),
-                CallbackQueryHandler(button_handler, pattern='^CANCEL$')
+                CallbackRouter({Action.DATE: select_date}),
             ],
             SELECT_TIME: [
-                CallbackQueryHandler(select_time, pattern='^TIME_'),
-                CallbackQueryHandler(back_to_date_selection, pattern='^BACK_TO_DATE$'),
-                CallbackQueryHandler(button_handler, pattern='^CANCEL$')
+                CallbackRouter({Action.TIME: select_time, Action.BACK_TO_DATE: back_to_date_selection}),
             ],
             ENTER_MESSAGE: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, enter_message),
-                CallbackQueryHandler(skip_message, pattern='^SKIP$'),
-                CallbackQueryHandler(button_handler, pattern='^CANCEL$')
+                CallbackRouter({Action.SKIP: skip_message}),
             ]
         },
+        # Cancel buttons of every state
         fallbacks=[
-            CallbackQueryHandler(button_handler, pattern='^CANCEL$'),
+            CallbackRouter({Action.CANCEL: cancel_button}),
             CommandHandler('cancel', cancel_command),
         ],
     )
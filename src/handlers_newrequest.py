@@ -5,12 +5,10 @@ from datetime import datetime
 from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
-    BotCommandScopeChat,
     BotCommand,
     Update,
 )
 from telegram.ext import (
-    CallbackQueryHandler,
     ConversationHandler,
     CallbackContext,
     MessageHandler,
@@ -18,8 +16,9 @@ from telegram.ext import (
     filters,
 )
 from firebase_utils import add_new_request
-from handlers_button import button_handler, cancel_command
-from utils import reset_user_commands
+from callback_data import Action, CallbackRouter, encode
+from handlers_button import cancel_button, cancel_command
+from utils import reset_user_commands, set_chat_commands
 
 # Define Conversation States for NEWREQUEST
 ENTER_NAME, ENTER_REQUEST_MESSAGE = range(2)
@@ -31,10 +30,7 @@ async def newrequest_start(update: Update, context: CallbackContext):
     await query.edit_message_text(text="Пожалуйста, укажите ваше имя.")
     
     # Set commands relevant to NEWCLASS
-    await context.bot.set_my_commands(
-        [BotCommand('cancel', 'Отменить команду')],
-        scope=BotCommandScopeChat(update.effective_chat.id)
-    )
+    await set_chat_commands(context, update.effective_chat.id, [BotCommand('cancel', 'Отменить команду')])
 
     return ENTER_NAME
 
@@ -49,8 +45,8 @@ async def enter_name(update: Update, context: CallbackContext):
     await update.message.reply_text(
         "Чтобы продолжить, оставьте дополнительное сообщение или нажмите Пропустить",
         reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("Пропустить", callback_data='SKIP')],
-            [InlineKeyboardButton("Отмена", callback_data='CANCEL')]
+            [InlineKeyboardButton("Пропустить", callback_data=encode(Action.SKIP))],
+            [InlineKeyboardButton("Отмена", callback_data=encode(Action.CANCEL))]
         ])
     )
     return ENTER_REQUEST_MESSAGE
@@ -76,7 +72,7 @@ async def skip_message(update: Update, context: CallbackContext):
             'date': datetime.utcnow().isoformat(),
             'id': ''  # Placeholder; will be set in add_new_request
         }
-        success = add_new_request(db, request_data)
+        success = await add_new_request(db, request_data)
         if success:
             await query.message.reply_text("Ваша заявка отправлена! Пожалуйста, подождите, пока преподаватель свяжется с вами.")
         else:
@@ -110,7 +106,7 @@ async def enter_request_message(update: Update, context: CallbackContext):
             'date': datetime.utcnow().isoformat(),
             'id': ''  # Placeholder; will be set in add_new_request
         }
-        success = add_new_request(db, request_data)
+        success = await add_new_request(db, request_data)
         if success:
             await update.message.reply_text("Ваша заявка отправлена! Пожалуйста, подождите, пока преподаватель свяжется с вами.")
         else:
@@ -126,21 +122,23 @@ async def enter_request_message(update: Update, context: CallbackContext):
     return ConversationHandler.END
 
 
-def newrequest_conv_handler() -> ConversationHandler:
+def newrequest_conv_handler(persistent: bool = False) -> ConversationHandler:
     return ConversationHandler(
+        name='newrequest',
+        persistent=persistent,
         entry_points=[
-            CallbackQueryHandler(newrequest_start, pattern='^NEWREQUEST$'),
+            CallbackRouter({Action.NEWREQUEST: newrequest_start}),
             CommandHandler('newclass', newrequest_start),
         ],
         states={
             ENTER_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, enter_name)],
             ENTER_REQUEST_MESSAGE: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, enter_request_message),
-                CallbackQueryHandler(skip_message, pattern='^SKIP$'),
+                CallbackRouter({Action.SKIP: skip_message}),
             ]
         },
         fallbacks=[
-            CallbackQueryHandler(button_handler, pattern='^CANCEL$'),
+            CallbackRouter({Action.CANCEL: cancel_button}),
             CommandHandler('cancel', cancel_command),
         ],
     )
\ No newline at end of file
@@ -1,25 +1,74 @@
 # Handles the SCHEDULE conversation: schedule for a day, switch between days, edit class status, delete class, refund policy.
+# '/schedule week' and '/schedule month' start with a paginated overview of the period (classes per day); tapping a day
+# opens the day view with the usual edit flow. 'Выбрать несколько' switches the day view to a multi-select mode that
+# applies one status to the ticked classes with a single batched write and re-renders the day in place.
+# The whole conversation lives in one message per session: every screen is shown by editing it (show_schedule_view).
 
 import logging
-from datetime import datetime, timedelta
-from zoneinfo import ZoneInfo
+from collections import Counter
+from datetime import date, datetime, time, timedelta
+from typing import Tuple
 from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     Update,
 )
+from telegram.error import BadRequest
 from telegram.ext import (
-    CallbackQueryHandler,
     ConversationHandler,
     CallbackContext,
     CommandHandler,
 )
-from firebase_utils import get_classes_by_date, get_user_by_id, update_class_status
-from handlers_button import button_handler, cancel_command
+from firebase_utils import (
+    get_class_by_id,
+    get_classes_between,
+    get_user_by_id,
+    get_users_by_ids,
+    update_class_status,
+    update_classes_status,
+    cancel_class,
+)
+from callback_data import Action, CallbackRouter, decode, encode
+from handlers_button import cancel_button, cancel_command
+from slot_index import slot_index, slot_of
+from schedule_cache import schedule_cache
+from class_record import ClassRecord
 from utils import ST_PETERSBURG
 
 # Define Conversation States
-VIEW_SCHEDULE, EDIT_CLASS, EDIT_STATUS = range(3)
+VIEW_SCHEDULE, EDIT_CLASS, EDIT_STATUS, BULK_SELECT = range(4)
+
+# Statuses an admin can set, with their button texts
+STATUS_CHOICES = [
+    ('в ожидании', 'В ожидании'),
+    ('подтверждено', 'Подтверждено'),
+    ('отменено', 'Отменено'),
+    ('выполнено', 'Выполнено'),
+]
+
+# Overview modes of '/schedule <mode>', days listed per overview page and short weekday names
+RANGE_MODES = ('week', 'month')
+DAYS_PER_PAGE = 7
+WEEKDAY_NAMES = ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс']
+
+
+# Show a screen of the conversation in its message: the message of the pressed button, or the message the
+# /schedule command started with. A new message is sent only if there is none to edit (or it can no longer be edited).
+async def show_schedule_view(update: Update, context: CallbackContext, text: str, reply_markup: InlineKeyboardMarkup):
+    try:
+        if update.callback_query and update.callback_query.message:
+            await update.callback_query.edit_message_text(text=text, reply_markup=reply_markup)
+            return
+        message_id = context.user_data.get('schedule_message_id')
+        if message_id:
+            await context.bot.edit_message_text(chat_id=update.effective_chat.id, message_id=message_id, text=text, reply_markup=reply_markup)
+            return
+    except BadRequest as e:
+        if 'not modified' in str(e).lower():
+            return
+        logging.warning(f"Could not edit the schedule message, sending a new one: {e}")
+    message = await context.bot.send_message(chat_id=update.effective_chat.id, text=text, reply_markup=reply_markup)
+    context.user_data['schedule_message_id'] = message.message_id
 
 
 # Initiate the SCHEDULE command, setting the default date and displaying the schedule for that date.
@@ -27,130 +76,287 @@ async def schedule_start(update: Update, context: CallbackContext):
     if update.callback_query:
         query = update.callback_query
         await query.answer()
-        chat_id = query.message.chat_id
+        context.user_data.pop('schedule_message_id', None)
     else:
-        await update.message.reply_text("Загружаю расписание...")
-        chat_id = update.message.chat_id
+        # This message becomes the schedule view once the classes are loaded
+        message = await update.message.reply_text("Загружаю расписание...")
+        context.user_data['schedule_message_id'] = message.message_id
 
-    db = context.bot_data['db']
     # Set default date to today in Saint Petersburg timezone
     today = datetime.now(ST_PETERSBURG).date()
     context.user_data['filter_by_this_date'] = today.isoformat()
+    # Start a fresh student name memo for this conversation
+    context.user_data['student_names'] = {}
+
+    # '/schedule week' or '/schedule month' opens the overview of the current period
+    mode = context.args[0].lower() if context.args else ''
+    if mode in RANGE_MODES:
+        await load_schedule_range(context, mode, today)
+        await display_schedule_range(update, context)
+        return VIEW_SCHEDULE
 
     # Fetch and display the schedule
-    await display_schedule(chat_id, context)
+    await display_schedule(update, context)
     return VIEW_SCHEDULE
 
 
-# Fetch the classes for the specified date and display them as buttons.
-async def display_schedule(chat_id, context: CallbackContext):
+# First day and the day after the last day of the week or month containing a date.
+def range_bounds(mode: str, day: date) -> Tuple[date, date]:
+    if mode == 'week':
+        start = day - timedelta(days=day.weekday())
+        return start, start + timedelta(days=7)
+    start = day.replace(day=1)
+    return start, (start + timedelta(days=32)).replace(day=1)
+
+
+# Russian plural of the number of classes, e.g. '1 занятие', '3 занятия', '5 занятий'.
+def classes_count_text(count: int) -> str:
+    if count % 10 == 1 and count % 100 != 11:
+        return f"{count} занятие"
+    if 2 <= count % 10 <= 4 and not 12 <= count % 100 <= 14:
+        return f"{count} занятия"
+    return f"{count} занятий"
+
+
+# Load the classes of the week or month containing a day with one range query and keep the number of classes
+# per day for the overview. The page containing that day is shown first.
+async def load_schedule_range(context: CallbackContext, mode: str, day: date):
     db = context.bot_data['db']
-    filter_date_str = context.user_data['filter_by_this_date']
-    filter_date = datetime.fromisoformat(filter_date_str).date()
+    start, end = range_bounds(mode, day)
+    classes = await get_classes_between(
+        db,
+        datetime.combine(start, time.min, tzinfo=ST_PETERSBURG),
+        datetime.combine(end, time.min, tzinfo=ST_PETERSBURG),
+    )
+    counts = Counter(class_record.local_start.date().isoformat() for class_record in classes)
+    context.user_data['schedule_range'] = {
+        'mode': mode,
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'counts': dict(counts),
+        'page': (day - start).days // DAYS_PER_PAGE,
+    }
+
+
+# Build the overview page: one button per day with its number of classes, page and period navigation.
+def build_range_summary(schedule_range: dict) -> Tuple[str, InlineKeyboardMarkup]:
+    start = date.fromisoformat(schedule_range['start'])
+    end = date.fromisoformat(schedule_range['end'])
+    counts = schedule_range['counts']
+    days = [start + timedelta(days=i) for i in range((end - start).days)]
+    pages = (len(days) + DAYS_PER_PAGE - 1) // DAYS_PER_PAGE
+    page = min(max(schedule_range['page'], 0), pages - 1)
+
+    period = 'неделю' if schedule_range['mode'] == 'week' else 'месяц'
+    text = (
+        f"Расписание на {period} {start.strftime('%d.%m.%Y')} – {(end - timedelta(days=1)).strftime('%d.%m.%Y')}: "
+        f"{classes_count_text(sum(counts.values()))}."
+    )
+    if pages > 1:
+        text += f"\nСтраница {page + 1} из {pages}."
+    text += "\nЧтобы открыть день, нажмите на него."
 
-    # Fetch classes for the date
-    classes = get_classes_by_date(db, filter_date_str)
     buttons = []
-
-    if classes:
-        for class_data in classes:
-            # Convert UTC startdate to Saint Petersburg time zone
-            utc_start = datetime.fromisoformat(class_data['startdate'].replace('Z', '+00:00'))
-            spb_start = utc_start.astimezone(ST_PETERSBURG)
-            formatted_start = spb_start.strftime('%d.%m.%Y %H:%M')
-
-            # Get student name
-            user_data = get_user_by_id(db, class_data['userId'])
-            student_name = user_data.get('name', 'Unknown')
-
-            # Create button text
-            button_text = f"{formatted_start} | {class_data['status']} | {student_name}"
-            buttons.append([InlineKeyboardButton(button_text, callback_data=f"CLASS_{class_data['id']}")])
+    for day in days[page * DAYS_PER_PAGE:(page + 1) * DAYS_PER_PAGE]:
+        count = counts.get(day.isoformat(), 0)
+        day_text = f"{WEEKDAY_NAMES[day.weekday()]} {day.strftime('%d.%m')} — {classes_count_text(count) if count else 'нет занятий'}"
+        buttons.append([InlineKeyboardButton(day_text, callback_data=encode(Action.DAY, day.isoformat()))])
+
+    if pages > 1:
+        page_buttons = []
+        if page > 0:
+            page_buttons.append(InlineKeyboardButton("Пред. страница", callback_data=encode(Action.PAGE, page - 1)))
+        if page < pages - 1:
+            page_buttons.append(InlineKeyboardButton("След. страница", callback_data=encode(Action.PAGE, page + 1)))
+        buttons.append(page_buttons)
+
+    buttons.append([
+        InlineKeyboardButton("<<", callback_data=encode(Action.RANGE_PREV)),
+        InlineKeyboardButton(">>", callback_data=encode(Action.RANGE_NEXT)),
+        InlineKeyboardButton("Отмена", callback_data=encode(Action.CANCEL))
+    ])
+    return text, InlineKeyboardMarkup(buttons)
+
+
+# Show the loaded overview in the schedule message.
+async def display_schedule_range(update: Update, context: CallbackContext):
+    text, reply_markup = build_range_summary(context.user_data['schedule_range'])
+    await show_schedule_view(update, context, text, reply_markup)
+
+
+# Handlers for the overview buttons: switch to the week/month overview, page through it or move to the previous/next period.
+async def navigate_range(update: Update, context: CallbackContext):
+    query = update.callback_query
+    await query.answer()
+    action = decode(query.data).action
+    schedule_range = context.user_data.get('schedule_range')
+
+    if action == Action.MODE:
+        # From the day view: overview of the period containing the shown day
+        day = date.fromisoformat(context.user_data['filter_by_this_date'])
+        await load_schedule_range(context, context.args[0], day)
+    elif not schedule_range:
+        await query.edit_message_text(text="Обзор расписания устарел. Откройте его заново командой /schedule week.")
+        return VIEW_SCHEDULE
+    elif action == Action.PAGE:
+        schedule_range['page'] = int(context.args[0])
     else:
-        await context.bot.send_message(chat_id=chat_id, text="В этот день у вас нет занятий.")
+        start = date.fromisoformat(schedule_range['start'])
+        if action == Action.RANGE_PREV:
+            day = start - timedelta(days=1)
+        else:
+            day = date.fromisoformat(schedule_range['end'])
+        await load_schedule_range(context, schedule_range['mode'], range_bounds(schedule_range['mode'], day)[0])
+
+    await display_schedule_range(update, context)
+    return VIEW_SCHEDULE
+
+
+# Handler for when an admin taps a day of the overview: show that day with the usual class buttons.
+async def select_day(update: Update, context: CallbackContext):
+    query = update.callback_query
+    await query.answer()
+    context.user_data['filter_by_this_date'] = context.args[0]
+    await display_schedule(update, context)
+    return VIEW_SCHEDULE
+
+
+# Resolve student names for the given user IDs with one batched read and remember them for this conversation.
+async def load_student_names(context: CallbackContext, user_ids) -> dict:
+    student_names = context.user_data.setdefault('student_names', {})
+    missing_ids = [user_id for user_id in dict.fromkeys(user_ids) if user_id not in student_names]
+    if missing_ids:
+        db = context.bot_data['db']
+        users = await get_users_by_ids(db, missing_ids)
+        for user_id in missing_ids:
+            student_names[user_id] = users.get(user_id, {}).get('name', 'Unknown')
+    return student_names
+
+
+# Get a student name from the conversation memo, fetching the user only if it was not seen yet.
+async def get_student_name(context: CallbackContext, user_id: str) -> str:
+    student_names = context.user_data.setdefault('student_names', {})
+    if user_id not in student_names:
+        db = context.bot_data['db']
+        user_data = await get_user_by_id(db, user_id)
+        student_names[user_id] = user_data.get('name', 'Unknown') if user_data else 'Unknown'
+    return student_names[user_id]
+
+
+# Build one button per class using the prefetched student names.
+def build_schedule_buttons(classes, student_names: dict) -> list:
+    buttons = []
+    for class_record in classes:
+        student_name = student_names.get(class_record.user_id, 'Unknown')
+
+        # Create button text
+        button_text = f"{class_record.start_text} | {class_record.status} | {student_name}"
+        buttons.append([InlineKeyboardButton(button_text, callback_data=encode(Action.CLASS, class_record.id))])
+    return buttons
+
+
+# Build the day view: one button per class, day navigation and the overview and multi-select switches.
+def build_day_view(filter_date: date, classes, student_names: dict, notice: str = '') -> Tuple[str, InlineKeyboardMarkup]:
+    buttons = build_schedule_buttons(classes, student_names)
 
     # Add navigation buttons
     navigation_buttons = [
-        InlineKeyboardButton("<", callback_data='PREV_DAY'),
-        InlineKeyboardButton(">", callback_data='NEXT_DAY'),
-        InlineKeyboardButton("Отмена", callback_data='CANCEL')
+        InlineKeyboardButton("<", callback_data=encode(Action.PREV_DAY)),
+        InlineKeyboardButton(">", callback_data=encode(Action.NEXT_DAY)),
+        InlineKeyboardButton("Отмена", callback_data=encode(Action.CANCEL))
     ]
 
     buttons.append(navigation_buttons)
+    buttons.append([
+        InlineKeyboardButton("Неделя", callback_data=encode(Action.MODE, 'week')),
+        InlineKeyboardButton("Месяц", callback_data=encode(Action.MODE, 'month'))
+    ])
+    if len(classes) > 1:
+        buttons.append([InlineKeyboardButton("Выбрать несколько", callback_data=encode(Action.BULK_START))])
 
     # Format date
     day_name = filter_date.strftime('%A')
     formatted_date = filter_date.strftime('%d.%m.%Y')
 
-    reply_markup = InlineKeyboardMarkup(buttons)
-    await context.bot.send_message(
-        chat_id=chat_id,
-        text=f"Ваши занятия на {day_name}, {formatted_date}. Чтобы изменить статус или удалить, нажмите кнопку с этим занятием.",
-        reply_markup=reply_markup
-    )
+    if classes:
+        text = f"Ваши занятия на {day_name}, {formatted_date}. Чтобы изменить статус или удалить, нажмите кнопку с этим занятием."
+    else:
+        text = f"{day_name}, {formatted_date}: в этот день у вас нет занятий."
+    if notice:
+        text = f"{notice}\n\n{text}"
+    return text, InlineKeyboardMarkup(buttons)
+
+
+# Fetch the classes for the specified date and show them as buttons in the schedule message, with an optional
+# notice (e.g. the result of an edit) above them.
+async def display_schedule(update: Update, context: CallbackContext, notice: str = ''):
+    db = context.bot_data['db']
+    filter_date_str = context.user_data['filter_by_this_date']
+    filter_date = datetime.fromisoformat(filter_date_str).date()
+
+    # Fetch classes for the date from the admin's cached week (the neighbouring weeks are prefetched)
+    classes = await schedule_cache.get_day(db, update.effective_chat.id, filter_date)
+    student_names = {}
+
+    if classes:
+        # Resolve all students of the day in one read
+        student_names = await load_student_names(context, [class_record.user_id for class_record in classes])
+
+    text, reply_markup = build_day_view(filter_date, classes, student_names, notice)
+    await show_schedule_view(update, context, text, reply_markup)
 
 
 # Handlers for < and > buttons to navigate between dates.
 async def navigate_date(update: Update, context: CallbackContext):
     query = update.callback_query
     await query.answer()
-    data = query.data
     current_date = datetime.fromisoformat(context.user_data['filter_by_this_date'])
 
-    if data == 'PREV_DAY':
+    if decode(query.data).action == Action.PREV_DAY:
         new_date = current_date - timedelta(days=1)
-    elif data == 'NEXT_DAY':
-        new_date = current_date + timedelta(days=1)
     else:
-        return
+        new_date = current_date + timedelta(days=1)
 
     context.user_data['filter_by_this_date'] = new_date.date().isoformat()
-    # Edit message to update schedule
-    await query.edit_message_reply_markup(reply_markup=None)
-    await display_schedule(query.message.chat_id, context)
+    # Show the new day in the same message
+    await display_schedule(update, context)
 
 
 # Handler for when an admin selects a class to edit.
 async def select_class(update: Update, context: CallbackContext):
     query = update.callback_query
     await query.answer()
-    class_id = query.data.split('_')[1]
+    class_id = context.args[0]
     context.user_data['selected_class_id'] = class_id
     db = context.bot_data['db']
 
     # Fetch class data
-    class_doc = db.collection('classes').document(class_id).get()
-    if not class_doc.exists:
+    class_record = await get_class_by_id(db, class_id)
+    if not class_record:
         await query.edit_message_text(text="Занятие не найдено.")
         return VIEW_SCHEDULE
 
-    class_data = class_doc.to_dict()
-    context.user_data['selected_class_data'] = class_data
-
-    # Convert UTC startdate to Saint Petersburg time zone
-    utc_start = datetime.fromisoformat(class_data['startdate'].replace('Z', '+00:00'))
-    spb_start = utc_start.astimezone(ST_PETERSBURG)
-    formatted_start = spb_start.strftime('%d.%m.%Y %H:%M')
+    # user_data is persisted: keep the document fields, not the record
+    context.user_data['selected_class_data'] = class_record.to_dict()
 
     # Get student name
-    user_data = get_user_by_id(db, class_data['userId'])
-    student_name = user_data.get('name', 'Unknown')
+    student_name = await get_student_name(context, class_record.user_id)
 
     # Prepare class details
-    is_membership_used = 'да' if class_data.get('isMembershipUsed', False) else 'нет'
+    is_membership_used = 'да' if class_record.is_membership_used else 'нет'
     message_text = (
-        f"{formatted_start} | статус: {class_data['status']}\n"
+        f"{class_record.label}\n"
         f"Ученик: {student_name}\n"
         f"Использован абонемент: {is_membership_used}\n"
-        f"Сообщение: {class_data.get('message', '')}"
+        f"Сообщение: {class_record.message}"
     )
 
     # Display options
     keyboard = [
-        [InlineKeyboardButton("Изменить статус", callback_data='EDIT_STATUS')],
-        [InlineKeyboardButton("Удалить занятие", callback_data='DELETE_CLASS')],
-        [InlineKeyboardButton("Назад к расписанию", callback_data='BACK_TO_SCHEDULE')],
-        [InlineKeyboardButton("Отмена", callback_data='CANCEL')]
+        [InlineKeyboardButton("Изменить статус", callback_data=encode(Action.EDIT_STATUS))],
+        [InlineKeyboardButton("Удалить занятие", callback_data=encode(Action.DELETE_CLASS))],
+        [InlineKeyboardButton("Назад к расписанию", callback_data=encode(Action.BACK_TO_SCHEDULE))],
+        [InlineKeyboardButton("Отмена", callback_data=encode(Action.CANCEL))]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
@@ -163,32 +369,21 @@ async def edit_status_start(update: Update, context: CallbackContext):
     query = update.callback_query
     await query.answer()
 
-    class_data = context.user_data['selected_class_data']
-    # Prepare class details
-    # Convert UTC startdate to Saint Petersburg time zone
-    utc_start = datetime.fromisoformat(class_data['startdate'].replace('Z', '+00:00'))
-    spb_start = utc_start.astimezone(ST_PETERSBURG)
-    formatted_start = spb_start.strftime('%d.%m.%Y %H:%M')
+    class_record = ClassRecord.from_dict(context.user_data['selected_class_data'])
 
     # Get student name
-    db = context.bot_data['db']
-    user_data = get_user_by_id(db, class_data['userId'])
-    student_name = user_data.get('name', 'Unknown')
+    student_name = await get_student_name(context, class_record.user_id)
 
+    # Prepare class details
     message_text = (
         "Вы собираетесь изменить статус этого занятия:\n"
-        f"{formatted_start} | статус: {class_data['status']}\n"
+        f"{class_record.label}\n"
         f"Ученик: {student_name}"
     )
 
     # Display status options
-    keyboard = [
-        [InlineKeyboardButton("В ожидании", callback_data='STATUS_в ожидании')],
-        [InlineKeyboardButton("Подтверждено", callback_data='STATUS_подтверждено')],
-        [InlineKeyboardButton("Отменено", callback_data='STATUS_отменено')],
-        [InlineKeyboardButton("Выполнено", callback_data='STATUS_выполнено')],
-        [InlineKeyboardButton("Назад к расписанию", callback_data='BACK_TO_SCHEDULE')]
-    ]
+    keyboard = [[InlineKeyboardButton(label, callback_data=encode(Action.STATUS, status))] for status, label in STATUS_CHOICES]
+    keyboard.append([InlineKeyboardButton("Назад к расписанию", callback_data=encode(Action.BACK_TO_SCHEDULE))])
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     await query.edit_message_text(text=message_text, reply_markup=reply_markup)
@@ -199,23 +394,132 @@ async def edit_status_start(update: Update, context: CallbackContext):
 async def update_status(update: Update, context: CallbackContext):
     query = update.callback_query
     await query.answer()
-    new_status = query.data.split('_')[1]
+    new_status = context.args[0]
     class_id = context.user_data['selected_class_id']
     db = context.bot_data['db']
 
     try:
-        update_class_status(db, class_id, new_status)
-        await query.edit_message_text(text=f"Статус занятия изменён на: '{new_status}'.")
+        await update_class_status(db, class_id, new_status)
+        schedule_cache.invalidate_day(ClassRecord.from_dict(context.user_data['selected_class_data']).local_start.date())
+        notice = f"Статус занятия изменён на: '{new_status}'."
     except Exception as e:
         logging.error(f"Error updating class status: {e}")
-        await query.edit_message_text(text="Произошла ошибка обновления статуса занятия. Попробуйте ещё раз.")
+        notice = "Произошла ошибка обновления статуса занятия. Попробуйте ещё раз."
 
-    # Optionally, End the conversation or Refresh the schedule
-    # return ConversationHandler.END # End the conversation
-    await display_schedule(query.message.chat_id, context)
+    # Refresh the schedule in the same message, with the result above it
+    await display_schedule(update, context, notice)
     return VIEW_SCHEDULE  # Return to the schedule viewing state
 
 
+# Build the multi-select keyboard: a toggle per class of the day, select all/none, the statuses to apply and back.
+def build_bulk_keyboard(classes, student_names: dict, selected_ids) -> InlineKeyboardMarkup:
+    selected_ids = set(selected_ids)
+    buttons = []
+    for class_record in classes:
+        mark = '☑' if class_record.id in selected_ids else '☐'
+        student_name = student_names.get(class_record.user_id, 'Unknown')
+        button_text = f"{mark} {class_record.local_start.strftime('%H:%M')} | {class_record.status} | {student_name}"
+        buttons.append([InlineKeyboardButton(button_text, callback_data=encode(Action.BULK_TOGGLE, class_record.id))])
+
+    all_selected = bool(classes) and len(selected_ids) == len(classes)
+    buttons.append([InlineKeyboardButton("Снять все" if all_selected else "Выбрать все", callback_data=encode(Action.BULK_ALL))])
+    if selected_ids:
+        status_buttons = [InlineKeyboardButton(label, callback_data=encode(Action.BULK_STATUS, status)) for status, label in STATUS_CHOICES]
+        buttons.append(status_buttons[:2])
+        buttons.append(status_buttons[2:])
+    buttons.append([InlineKeyboardButton("Назад к расписанию", callback_data=encode(Action.BACK_TO_SCHEDULE))])
+    return InlineKeyboardMarkup(buttons)
+
+
+# Text of the multi-select screen
+def bulk_text(selected_count: int) -> str:
+    return (
+        f"Выберите занятия и статус для них. Выбрано: {selected_count}.\n"
+        "Статус будет применён ко всем выбранным занятиям сразу."
+    )
+
+
+# Handler for 'Выбрать несколько': switch the day view to multi-select, editing its message.
+async def bulk_start(update: Update, context: CallbackContext):
+    query = update.callback_query
+    await query.answer()
+    db = context.bot_data['db']
+    filter_date = date.fromisoformat(context.user_data['filter_by_this_date'])
+
+    # The day's classes are kept for the toggles (as document fields, user_data is persisted), so ticking a class
+    # needs no Firestore read
+    classes = await schedule_cache.get_day(db, query.message.chat_id, filter_date)
+    student_names = await load_student_names(context, [class_record.user_id for class_record in classes])
+    context.user_data['bulk_classes'] = [class_record.to_dict() for class_record in classes]
+    context.user_data['bulk_selected'] = []
+
+    await query.edit_message_text(text=bulk_text(0), reply_markup=build_bulk_keyboard(classes, student_names, []))
+    return BULK_SELECT
+
+
+# Handler for the class toggles and select all/none: only the keyboard of the message is edited.
+async def bulk_toggle(update: Update, context: CallbackContext):
+    query = update.callback_query
+    await query.answer()
+    classes = [ClassRecord.from_dict(class_data) for class_data in context.user_data.get('bulk_classes', [])]
+    selected = context.user_data.setdefault('bulk_selected', [])
+
+    if decode(query.data).action == Action.BULK_ALL:
+        selected[:] = [] if len(selected) == len(classes) else [class_record.id for class_record in classes]
+    else:
+        class_id = context.args[0]
+        if class_id in selected:
+            selected.remove(class_id)
+        elif any(class_record.id == class_id for class_record in classes):
+            selected.append(class_id)
+
+    student_names = context.user_data.get('student_names', {})
+    await query.edit_message_text(text=bulk_text(len(selected)), reply_markup=build_bulk_keyboard(classes, student_names, selected))
+    return BULK_SELECT
+
+
+# Handler for a status of the multi-select screen: one batched write for all ticked classes, then the day view is
+# re-rendered once in the same message from the updated classes (or reloaded, if some were deleted meanwhile).
+async def bulk_apply(update: Update, context: CallbackContext):
+    query = update.callback_query
+    await query.answer()
+    new_status = context.args[0]
+    classes = [ClassRecord.from_dict(class_data) for class_data in context.user_data.get('bulk_classes', [])]
+    selected = set(context.user_data.get('bulk_selected', []))
+    filter_date = date.fromisoformat(context.user_data['filter_by_this_date'])
+    db = context.bot_data['db']
+
+    selected_classes = [class_record for class_record in classes if class_record.id in selected]
+    changed_ids = [class_record.id for class_record in selected_classes if class_record.status != new_status]
+    try:
+        updated = 0
+        if changed_ids:
+            updated = await update_classes_status(db, changed_ids, new_status)
+            schedule_cache.invalidate_day(filter_date)
+            if updated == len(changed_ids):
+                classes = [
+                    ClassRecord.from_dict(dict(class_record.to_dict(), status=new_status), class_record.id)
+                    if class_record.id in changed_ids else class_record
+                    for class_record in classes
+                ]
+            else:
+                classes = await schedule_cache.get_day(db, query.message.chat_id, filter_date)
+        notice = f"Статус '{new_status}' установлен: {classes_count_text(updated)}."
+        if len(selected_classes) > len(changed_ids):
+            notice += f" Уже имели этот статус: {classes_count_text(len(selected_classes) - len(changed_ids))}."
+        if updated < len(changed_ids):
+            notice += f" Не найдены (удалены): {classes_count_text(len(changed_ids) - updated)}."
+    except Exception as e:
+        logging.error(f"Error updating class statuses: {e}")
+        notice = "Произошла ошибка обновления статусов. Попробуйте ещё раз."
+
+    context.user_data.pop('bulk_classes', None)
+    context.user_data.pop('bulk_selected', None)
+    text, reply_markup = build_day_view(filter_date, classes, context.user_data.get('student_names', {}), notice)
+    await show_schedule_view(update, context, text, reply_markup)
+    return VIEW_SCHEDULE
+
+
 # Prompt admin if they are sure to delete a class
 async def delete_class_confirm(update: Update, context: CallbackContext):
     query = update.callback_query
@@ -225,8 +529,8 @@ async def delete_class_confirm(update: Update, context: CallbackContext):
     await query.edit_message_text(
         text="Вы уверены, что хотите удалить это занятие?",
         reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("Да, удалить", callback_data='CONFIRM_DELETE')],
-            [InlineKeyboardButton("Нет, вернуться", callback_data='BACK_TO_SCHEDULE')]
+            [InlineKeyboardButton("Да, удалить", callback_data=encode(Action.CONFIRM_DELETE))],
+            [InlineKeyboardButton("Нет, вернуться", callback_data=encode(Action.BACK_TO_SCHEDULE))]
         ])
     )
     return EDIT_CLASS
@@ -240,62 +544,24 @@ async def delete_class(update: Update, context: CallbackContext):
     db = context.bot_data['db']
 
     try:
-        # Fetch class data
-        class_doc_ref = db.collection('classes').document(class_id)
-        class_doc = class_doc_ref.get()
-        if not class_doc.exists:
+        # Delete the class and refund the membership point if the policy allows it
+        result = await cancel_class(db, class_id)
+        if not result:
             await query.edit_message_text(text="Занятие не найдено.")
             return ConversationHandler.END
-        class_data = class_doc.to_dict()
 
-        # Fetch user data
-        user_data = get_user_by_id(db, class_data['userId'])
-        if not user_data:
-            await query.edit_message_text(text="Данные пользователя не найдены.")
-            return ConversationHandler.END
+        # Free the slot in the occupied-slot index and refresh the schedules showing that day
+        class_date, class_hour = slot_of(result['class']['startdate'])
+        slot_index.release(class_date, class_hour)
+        schedule_cache.invalidate_day(date.fromisoformat(class_date))
 
-        # Calculate hours difference
-        utc_now = datetime.utcnow().replace(tzinfo=ZoneInfo('UTC'))
-        class_start = datetime.fromisoformat(class_data['startdate'].replace('Z', '+00:00'))
-        hours_difference = (class_start - utc_now).total_seconds() / 3600
-
-        # Determine if refund applies
-        refund_membership = False
-        if class_data.get('isMembershipUsed', False):
-            if hours_difference >= 24:
-                refund_membership = True
-            elif class_data.get('status') in ['в ожидании', 'отменено']:
-                refund_membership = True
-
-        # Start a batch
-        batch = db.batch()
-
-        # Delete class document
-        batch.delete(class_doc_ref)
-
-        # Update user's classes array
-        user_ref = db.collection('users').document(user_data['id'])
-        updated_classes = user_data.get('classes', [])
-        if class_id in updated_classes:
-            updated_classes.remove(class_id)
-        # Prepare user data update
-        user_update_data = {'classes': updated_classes}
-        if refund_membership:
-            user_update_data['membership'] = user_data.get('membership', 0) + 1
-
-        batch.update(user_ref, user_update_data)
-
-        # Commit the batch
-        batch.commit()
-
-        await query.edit_message_text(text="Занятие удалено, баллы абонемента скорректированы.")
+        notice = "Занятие удалено, баллы абонемента скорректированы."
     except Exception as e:
         logging.error(f"Error deleting class: {e}")
-        await query.edit_message_text(text="Произошла ошибка при удалении занятия. Попробуйте ещё раз.")
+        notice = "Произошла ошибка при удалении занятия. Попробуйте ещё раз."
 
-    # Optionally, End the conversation or Refresh the schedule
-    # return ConversationHandler.END # End the conversation
-    await display_schedule(query.message.chat_id, context)
+    # Refresh the schedule in the same message, with the result above it
+    await display_schedule(update, context, notice)
     return VIEW_SCHEDULE  # Return to the schedule viewing state
 
 
@@ -307,43 +573,64 @@ async def back_to_schedule(update: Update, context: CallbackContext):
     # Clear selected class data
     context.user_data.pop('selected_class_id', None)
     context.user_data.pop('selected_class_data', None)
+    context.user_data.pop('bulk_classes', None)
+    context.user_data.pop('bulk_selected', None)
 
-    # Edit message to remove previous content
-    await query.edit_message_text(text="Возвращаюсь к расписанию...")
-
-    # Display schedule
-    await display_schedule(query.message.chat_id, context)
+    # Display schedule in the same message
+    await display_schedule(update, context)
     return VIEW_SCHEDULE
 
 
-# Define the Conversation Handler
-def schedule_conv_handler() -> ConversationHandler:
+# Define the Conversation Handler (its state is stored by the persistence backend if persistent is set)
+def schedule_conv_handler(persistent: bool = False) -> ConversationHandler:
     return ConversationHandler(
+        name='schedule',
+        persistent=persistent,
         entry_points=[
-            CallbackQueryHandler(schedule_start, pattern='^SCHEDULE$'),
+            CallbackRouter({Action.SCHEDULE: schedule_start}),
             CommandHandler('schedule', schedule_start),
         ],
+        # One router per state: the action of a button is looked up in a table instead of tried against patterns
         states={
             VIEW_SCHEDULE: [
-                CallbackQueryHandler(navigate_date, pattern='^(PREV_DAY|NEXT_DAY)$'),
-                CallbackQueryHandler(select_class, pattern='^CLASS_'),
-                CallbackQueryHandler(button_handler, pattern='^CANCEL$'),
+                CallbackRouter({
+                    Action.PREV_DAY: navigate_date,
+                    Action.NEXT_DAY: navigate_date,
+                    Action.CLASS: select_class,
+                    Action.MODE: navigate_range,
+                    Action.PAGE: navigate_range,
+                    Action.RANGE_PREV: navigate_range,
+                    Action.RANGE_NEXT: navigate_range,
+                    Action.DAY: select_day,
+                    Action.BULK_START: bulk_start,
+                }),
             ],
             EDIT_CLASS: [
-                CallbackQueryHandler(edit_status_start, pattern='^EDIT_STATUS$'),
-                CallbackQueryHandler(delete_class_confirm, pattern='^DELETE_CLASS$'),
-                CallbackQueryHandler(delete_class, pattern='^CONFIRM_DELETE$'),
-                CallbackQueryHandler(back_to_schedule, pattern='^BACK_TO_SCHEDULE$'),
-                CallbackQueryHandler(button_handler, pattern='^CANCEL$'),
+                CallbackRouter({
+                    Action.EDIT_STATUS: edit_status_start,
+                    Action.DELETE_CLASS: delete_class_confirm,
+                    Action.CONFIRM_DELETE: delete_class,
+                    Action.BACK_TO_SCHEDULE: back_to_schedule,
+                }),
             ],
             EDIT_STATUS: [
-                CallbackQueryHandler(update_status, pattern='^STATUS_'),
-                CallbackQueryHandler(back_to_schedule, pattern='^BACK_TO_SCHEDULE$'),
-                CallbackQueryHandler(button_handler, pattern='^CANCEL$'),
+                CallbackRouter({
+                    Action.STATUS: update_status,
+                    Action.BACK_TO_SCHEDULE: back_to_schedule,
+                }),
+            ],
+            BULK_SELECT: [
+                CallbackRouter({
+                    Action.BULK_TOGGLE: bulk_toggle,
+                    Action.BULK_ALL: bulk_toggle,
+                    Action.BULK_STATUS: bulk_apply,
+                    Action.BACK_TO_SCHEDULE: back_to_schedule,
+                }),
             ]
         },
+        # Cancel buttons of every state
         fallbacks=[
-            CallbackQueryHandler(button_handler, pattern='^CANCEL$'),
+            CallbackRouter({Action.CANCEL: cancel_button}),
             CommandHandler('cancel', cancel_command),
         ],
     )
@@ -1,23 +1,77 @@
-# Handles the /start command, displays user classes, membership points, and action options.
+# Handles the /start command, displays user classes, membership points, and action options in a single message.
 
 import logging
-from datetime import datetime
+from typing import Tuple
 from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
-    BotCommandScopeChat,
     BotCommand,
     Update,
 )
 from telegram.ext import CallbackContext
+from callback_data import Action, encode
 from firebase_utils import (
     get_user_by_telegram_username, 
     get_classes_by_ids
 )
-from utils import ST_PETERSBURG
+from utils import remember_chat, send_or_edit, set_chat_commands
 
 
-async def start(update: Update, context: CallbackContext):
+# Builds the dashboard text and keyboard of a registered user: classes, membership points and actions.
+def build_dashboard(greeting: str, user_data: dict, classes: list) -> Tuple[str, InlineKeyboardMarkup]:
+    is_admin = user_data.get('isadmin', False)
+    sections = [greeting]
+
+    if classes:
+        classes_text = ''
+        for class_record in classes:
+            classes_text += f"- {class_record.label}\n"
+        sections.append(f"Ваши занятия:\n{classes_text.rstrip()}")
+    else:
+        sections.append("У вас нет запланированных занятий.")
+
+    # Membership points
+    membership_points = user_data.get('membership', 0)
+    if membership_points:
+        sections.append(f"Занятий в абонементе: {membership_points}")
+    else:
+        sections.append("Занятий в абонементе: 0. Чтобы приобрести абонемент, свяжитесь с преподавателем.")
+
+    sections.append("Выберите действие:")
+
+    # Present options
+    keyboard = [
+        [InlineKeyboardButton("Записаться на новое занятие", callback_data=encode(Action.NEWCLASS))],
+        [InlineKeyboardButton("Отменить занятие", callback_data=encode(Action.CANCELCLASS))],
+    ]
+
+    # If user is admin, add the "See my schedule" button
+    if is_admin:
+        keyboard.append([InlineKeyboardButton("Расписание преподавателя", callback_data=encode(Action.SCHEDULE))])
+
+    # Add the Cancel button
+    keyboard.append([InlineKeyboardButton("Отмена", callback_data=encode(Action.CANCEL))])
+
+    return "\n\n".join(sections), InlineKeyboardMarkup(keyboard)
+
+
+# Builds the screen offering a user who is not in the database to leave a request.
+def build_new_user_screen(greeting: str) -> Tuple[str, InlineKeyboardMarkup]:
+    text = (
+        f"{greeting}\n\n"
+        "Похоже, вашего юзернейма пока нет в нашей базе данных. Хотите оставить заявку на первое занятие в ΣΙΓΜΑ?\n\n"
+        "Пожалуйста, выберите действие:"
+    )
+    keyboard = [
+        [InlineKeyboardButton("Оставить заявку", callback_data=encode(Action.NEWREQUEST))],
+        [InlineKeyboardButton("Отмена", callback_data=encode(Action.CANCEL))]
+    ]
+    return text, InlineKeyboardMarkup(keyboard)
+
+
+# Shows the dashboard as a single message. When reached from a button, the message of that button is edited
+# in place. An optional notice (e.g. the result of a booking) is shown above the dashboard.
+async def start(update: Update, context: CallbackContext, notice: str = ''):
     db = context.bot_data['db']
     user = None
     chat_id = None
@@ -35,22 +89,19 @@ async def start(update: Update, context: CallbackContext):
         return
 
     username = user.full_name or user.username or 'пользователь'
-
-    # Send greeting message
-    await context.bot.send_message(chat_id=chat_id, text=f"Добрый день, {username}!")
+    greeting = f"Добрый день, {username}!"
+    if notice:
+        greeting = f"{notice}\n\n{greeting}"
 
     # Fetch UserData from Firestore
     try:
-        logging.info(f"Looking up user with telegram username: {user.username}")
-        user_data = get_user_by_telegram_username(db, user.username)
-        logging.info(f"User data found: {user_data}")
+        logging.debug(f"Looking up user with telegram username: {user.username}")
+        user_data = await get_user_by_telegram_username(db, user.username)
+        logging.info(f"User {user_data['id'] if user_data else 'not found'} for @{user.username}")
 
         if user_data: # User was found scenario
-
-            # Get info if user is admin
-            is_admin = user_data.get('isadmin', False)
-            # Get created by this user class IDs
-            classes_ids = user_data.get('classes', [])
+            if update.effective_chat.type == 'private':
+                remember_chat(context, user.username, chat_id)
 
             # Set commands based on user status
             commands = [
@@ -58,76 +109,28 @@ async def start(update: Update, context: CallbackContext):
                 BotCommand('cancelclass', 'Отменить занятие'),
                 BotCommand('cancel', 'Отменить команду')
             ]
-            if is_admin:
+            if user_data.get('isadmin', False):
                 commands.append(BotCommand('schedule', 'Расписание преподавателя'))
 
-            await context.bot.set_my_commands(
-                commands,
-                scope=BotCommandScopeChat(update.effective_chat.id)
-            )
-
-            if classes_ids:
-                # Fetch user's classes
-                classes = get_classes_by_ids(db, classes_ids)
-                classes_text = ''
-                for class_data in classes:
-                    # Convert UTC startdate to Saint Petersburg time zone
-                    utc_start = datetime.fromisoformat(class_data['startdate'].replace('Z', '+00:00'))
-                    spb_start = utc_start.astimezone(ST_PETERSBURG)
-                    formatted_start = spb_start.strftime('%d.%m.%Y %H:%M')
-                    classes_text += f"- {formatted_start} | статус: {class_data['status']}\n"
-                await context.bot.send_message(chat_id=chat_id, text=f"Ваши занятия:\n{classes_text}")
-            else:
-                await context.bot.send_message(chat_id=chat_id, text="У вас нет запланированных занятий.")
-
-            # Display membership points
-            membership_points = user_data.get('membership', 0)
-            if membership_points:
-                await context.bot.send_message(chat_id=chat_id, text=f"Занятий в абонементе: {membership_points}")
-            else:
-                await context.bot.send_message(chat_id=chat_id, text="Занятий в абонементе: 0. Чтобы приобрести абонемент, свяжитесь с преподавателем.")
-
-            # Present options
-            keyboard = [
-                [InlineKeyboardButton("Записаться на новое занятие", callback_data='NEWCLASS')],
-                [InlineKeyboardButton("Отменить занятие", callback_data='CANCELCLASS')],
-            ]
+            await set_chat_commands(context, update.effective_chat.id, commands)
 
-            # If user is admin, add the "See my schedule" button
-            if is_admin:
-                keyboard.append([InlineKeyboardButton("Расписание преподавателя", callback_data='SCHEDULE')])
-
-            # Add the Cancel button
-            keyboard.append([InlineKeyboardButton("Отмена", callback_data='CANCEL')])
-
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await context.bot.send_message(chat_id=chat_id, text="Выберите действие:", reply_markup=reply_markup)
+            # Fetch user's classes
+            classes_ids = user_data.get('classes', [])
+            classes = await get_classes_by_ids(db, classes_ids) if classes_ids else []
+            text, reply_markup = build_dashboard(greeting, user_data, classes)
 
         else: # User not found scenario
 
             # Set commands for new users
-            await context.bot.set_my_commands(
-                [
-                    BotCommand('newrequest', 'Оставить заявку на первое занятие'),
-                    BotCommand('cancel', 'Отменить команду')
-                ],
-                scope=BotCommandScopeChat(update.effective_chat.id)
-            )
+            await set_chat_commands(context, update.effective_chat.id, [
+                BotCommand('newrequest', 'Оставить заявку на первое занятие'),
+                BotCommand('cancel', 'Отменить команду')
+            ])
 
             # Suggest to leave a request as a new user
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text="Похоже, вашего юзернейма пока нет в нашей базе данных. Хотите оставить заявку на первое занятие в ΣΙΓΜΑ?"
-            )
-
-            # Option buttons
-            keyboard = [
-                [InlineKeyboardButton("Оставить заявку", callback_data='NEWREQUEST')],
-                [InlineKeyboardButton("Отмена", callback_data='CANCEL')]
-            ]
+            text, reply_markup = build_new_user_screen(greeting)
 
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await context.bot.send_message(chat_id=chat_id, text="Пожалуйста, выберите действие:", reply_markup=reply_markup)
+        await send_or_edit(update, context, chat_id, text, reply_markup)
 
     except Exception as e:
         logging.error(f"Error in start handler: {e}")
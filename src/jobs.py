@@ -0,0 +1,179 @@
+# Background jobs run by the application's JobQueue (APScheduler): class reminders and automatic status updates.
+
+# Reminders: every REMINDER_INTERVAL seconds the classes starting within the next REMINDER_LEAD_HOURS are read
+# with one range query and their students with one batched read; each student gets one reminder per class,
+# sent through the bot, so it is paced by the outbound rate limiter. Students are messaged in the private chat
+# remembered by the start handler (bot_data['chat_ids']); the reminded classes are kept in
+# bot_data['reminded_classes'], so reminders are not repeated after a restart.
+# Auto-status: every AUTO_STATUS_INTERVAL seconds the confirmed classes of the last AUTO_STATUS_LOOKBACK_DAYS
+# that have ended are set to 'выполнено' in batched writes.
+# Jobs run as tasks on the event loop and await Firestore in the thread pool, so they never block updates.
+# Durations and outcomes of the runs are kept in job_metrics.
+
+import asyncio
+import functools
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+from zoneinfo import ZoneInfo
+from telegram.error import Forbidden, TelegramError
+from telegram.ext import Application, CallbackContext
+from class_record import ClassRecord, parse_startdate, ST_PETERSBURG
+from config import (
+    REMINDER_INTERVAL,
+    REMINDER_LEAD_HOURS,
+    AUTO_STATUS_INTERVAL,
+    AUTO_STATUS_LOOKBACK_DAYS,
+)
+from firebase_utils import get_classes_between, get_users_by_ids, update_classes_status
+from schedule_cache import schedule_cache
+
+# Statuses of classes that get a reminder
+REMINDED_STATUSES = ('в ожидании', 'подтверждено')
+
+# Duration of a class without an enddate
+DEFAULT_CLASS_DURATION = timedelta(hours=1)
+
+
+class JobMetrics:
+    def __init__(self):
+        # job name -> counters and durations (seconds) of its runs
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+
+    def record(self, name: str, duration: float, error: bool = False):
+        job = self._jobs.setdefault(name, {'runs': 0, 'errors': 0, 'last_duration': 0.0, 'max_duration': 0.0, 'total_duration': 0.0})
+        job['runs'] += 1
+        job['errors'] += int(error)
+        job['last_duration'] = duration
+        job['max_duration'] = max(job['max_duration'], duration)
+        job['total_duration'] += duration
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            name: dict(job, avg_duration=job['total_duration'] / job['runs'])
+            for name, job in self._jobs.items()
+        }
+
+
+# Durations of the background job runs
+job_metrics = JobMetrics()
+
+
+# Get the durations and outcomes of the background job runs
+def get_job_stats() -> Dict[str, Dict[str, Any]]:
+    return job_metrics.stats()
+
+
+# Decorator recording the duration of a job callback in job_metrics and logging its failures
+def timed_job(name: str):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(context: CallbackContext):
+            started = time.monotonic()
+            error = False
+            try:
+                return await func(context)
+            except Exception as e:
+                error = True
+                logging.error(f"Error in the {name} job: {e}")
+            finally:
+                duration = time.monotonic() - started
+                job_metrics.record(name, duration, error)
+                logging.info(f"Job {name} finished in {duration:.3f}s")
+        return wrapper
+    return decorator
+
+
+def reminder_text(class_record: ClassRecord) -> str:
+    return f"Напоминание: у вас занятие {class_record.start_text} (статус: {class_record.status})."
+
+
+# Send one reminder per upcoming class. Returns the number of reminders sent.
+@timed_job('reminders')
+async def send_reminders(context: CallbackContext) -> int:
+    db = context.bot_data['db']
+    now = datetime.now(ST_PETERSBURG)
+    reminded = context.bot_data.setdefault('reminded_classes', {})
+
+    # Forget the classes that have started
+    for class_id, startdate in list(reminded.items()):
+        if parse_startdate(startdate) <= now:
+            del reminded[class_id]
+
+    classes = [
+        class_record for class_record in await get_classes_between(db, now, now + timedelta(hours=REMINDER_LEAD_HOURS))
+        if class_record.status in REMINDED_STATUSES and class_record.id not in reminded
+    ]
+    if not classes:
+        return 0
+
+    users = await get_users_by_ids(db, [class_record.user_id for class_record in classes])
+    chat_ids = context.bot_data.get('chat_ids', {})
+
+    async def remind(class_record: ClassRecord) -> bool:
+        user_data = users.get(class_record.user_id) or {}
+        chat_id = chat_ids.get(user_data.get('telegram'))
+        if chat_id is None:
+            # The student never opened the bot: Telegram does not allow messaging them
+            return False
+        try:
+            await context.bot.send_message(chat_id=chat_id, text=reminder_text(class_record))
+        except Forbidden:
+            logging.warning(f"Student {class_record.user_id} blocked the bot, no reminder sent")
+            # Not retried, but not counted as sent either
+            reminded[class_record.id] = class_record.startdate
+            return False
+        except TelegramError as e:
+            logging.error(f"Error sending a reminder for class {class_record.id}: {e}")
+            return False
+        reminded[class_record.id] = class_record.startdate
+        return True
+
+    # The rate limiter paces the sends, so they are all handed over at once
+    sent = await asyncio.gather(*(remind(class_record) for class_record in classes))
+    return sum(sent)
+
+
+# Mark the confirmed classes that have ended as 'выполнено'. Returns the number of classes updated.
+@timed_job('auto_status')
+async def complete_past_classes(context: CallbackContext) -> int:
+    db = context.bot_data['db']
+    now = datetime.now(ZoneInfo('UTC'))
+    classes = await get_classes_between(db, now - timedelta(days=AUTO_STATUS_LOOKBACK_DAYS), now)
+    finished = [
+        class_record for class_record in classes
+        if class_record.status == 'подтверждено' and class_end(class_record) <= now
+    ]
+    if not finished:
+        return 0
+
+    updated = await update_classes_status(db, [class_record.id for class_record in finished], 'выполнено')
+    for day in {class_record.local_start.date() for class_record in finished}:
+        schedule_cache.invalidate_day(day)
+    logging.info(f"Marked {updated} past classes as 'выполнено'", extra={'sample': False})
+    return updated
+
+
+# End time of a class (its enddate, or the default duration after the start)
+def class_end(class_record: ClassRecord) -> datetime:
+    if class_record.enddate:
+        try:
+            return parse_startdate(class_record.enddate)
+        except ValueError:
+            pass
+    return class_record.start + DEFAULT_CLASS_DURATION
+
+
+# Schedule the background jobs on the application's JobQueue
+def register_jobs(application: Application) -> List[Any]:
+    job_queue = application.job_queue
+    if job_queue is None:
+        logging.warning("JobQueue is not available, reminders and automatic statuses are disabled")
+        return []
+    # A run that is still going when the next one is due is not started twice
+    job_kwargs = {'max_instances': 1, 'coalesce': True}
+    return [
+        job_queue.run_repeating(send_reminders, interval=REMINDER_INTERVAL, first=10, name='reminders', job_kwargs=job_kwargs),
+        job_queue.run_repeating(complete_past_classes, interval=AUTO_STATUS_INTERVAL, first=20, name='auto_status', job_kwargs=job_kwargs),
+    ]
@@ -0,0 +1,277 @@
+# Optional in-memory indexes of the 'classes' and 'users' collections, kept current by Firestore on_snapshot
+# listeners, so reads are served locally with near-zero staleness even when the web app changes the data.
+
+# Users: the whole collection is listened to, so once the first snapshot arrived a missing user is
+# a definite "not found". Classes: only a rolling window around today is listened to (LIVE_INDEX_PAST_DAYS
+# back, LIVE_INDEX_FUTURE_DAYS ahead); roll() re-subscribes with new bounds and swaps the index once the new
+# listener delivered its first snapshot. Reads outside the window return NOT_INDEXED and go to Firestore.
+# The bot's own writes are applied right away (put_class/remove_class), and users it updated server-side
+# (Increment/ArrayUnion) are read from Firestore until their next snapshot arrives (invalidate_user).
+# Listener callbacks run on background threads, so all state is guarded by a lock.
+
+import copy
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional, Tuple
+from zoneinfo import ZoneInfo
+from firebase_admin import firestore
+from class_record import ClassRecord, ST_PETERSBURG
+
+# Returned by the lookups when the index cannot answer (not started, outside the window, pending write)
+NOT_INDEXED = object()
+
+# Seconds to wait for the first snapshot of a (re-)subscribed listener
+SUBSCRIBE_TIMEOUT = 30
+
+# Seconds a user updated by the bot is read from Firestore if no snapshot of it arrives
+DIRTY_TTL = 10
+
+
+# Local midnight of a day offset from now, as an aware datetime
+def _local_midnight(now: datetime, days: int) -> datetime:
+    day = (now.astimezone(ST_PETERSBURG) + timedelta(days=days)).date()
+    return datetime(day.year, day.month, day.day, tzinfo=ST_PETERSBURG)
+
+
+class LiveIndex:
+    def __init__(self, past_days: int, future_days: int):
+        self._past_days = past_days
+        self._future_days = future_days
+        self._lock = threading.Lock()
+
+        self._users: Dict[str, Dict[str, Any]] = {}
+        self._user_ids_by_username: Dict[str, str] = {}
+        self._users_ready = False
+        self._users_watch = None
+        # user ID -> monotonic deadline until which the user is read from Firestore
+        self._dirty_users: Dict[str, float] = {}
+
+        self._classes: Dict[str, ClassRecord] = {}
+        # UTC bounds [start, end) of the classes held by the active listener
+        self._window: Optional[Tuple[datetime, datetime]] = None
+        self._classes_generation = 0
+        self._active_generation = 0
+        self._classes_watches: Dict[int, Any] = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def running(self) -> bool:
+        return self._users_watch is not None or bool(self._classes_watches)
+
+    # Subscribe the listeners and wait for their first snapshots (blocking)
+    def start(self, db: firestore.client):
+        ready = threading.Event()
+
+        def on_users_snapshot(docs, changes, read_time):
+            self._apply_user_changes(changes)
+            ready.set()
+
+        self._users_watch = db.collection('users').on_snapshot(on_users_snapshot)
+        if not ready.wait(SUBSCRIBE_TIMEOUT):
+            logging.warning("Users listener did not deliver a snapshot in time, users are read from Firestore until it does")
+        self.roll(db)
+
+    # Unsubscribe the listeners and drop the indexes
+    def stop(self):
+        with self._lock:
+            watches = list(self._classes_watches.values())
+            if self._users_watch is not None:
+                watches.append(self._users_watch)
+            self._users_watch = None
+            self._classes_watches.clear()
+            self._users.clear()
+            self._user_ids_by_username.clear()
+            self._users_ready = False
+            self._classes.clear()
+            self._window = None
+        for watch in watches:
+            watch.unsubscribe()
+
+    # Move the classes window to the current date: subscribe a listener with the new bounds and, once it
+    # delivered its first snapshot, switch to it and unsubscribe the previous one (blocking)
+    def roll(self, db: firestore.client, now: Optional[datetime] = None):
+        now = now or datetime.now(ZoneInfo('UTC'))
+        window_start = _local_midnight(now, -self._past_days)
+        window_end = _local_midnight(now, self._future_days + 1)
+        utc_window = (window_start.astimezone(ZoneInfo('UTC')), window_end.astimezone(ZoneInfo('UTC')))
+
+        with self._lock:
+            self._classes_generation += 1
+            generation = self._classes_generation
+        staged: Dict[str, ClassRecord] = {}
+        ready = threading.Event()
+
+        def on_classes_snapshot(docs, changes, read_time):
+            with self._lock:
+                if ready.is_set():
+                    # Later snapshots: applied only while this listener is the active one
+                    if generation == self._active_generation:
+                        self._apply_class_changes(self._classes, changes)
+                elif generation == self._classes_generation:
+                    # First snapshot: this listener becomes the active one
+                    self._apply_class_changes(staged, changes)
+                    self._classes = staged
+                    self._window = utc_window
+                    self._active_generation = generation
+                    ready.set()
+
+        query = (
+            db.collection('classes')
+            .where('startdate', '>=', utc_window[0].strftime('%Y-%m-%dT%H:%M:%S'))
+            .where('startdate', '<', utc_window[1].strftime('%Y-%m-%dT%H:%M:%S'))
+        )
+        watch = query.on_snapshot(on_classes_snapshot)
+        with self._lock:
+            self._classes_watches[generation] = watch
+
+        if not ready.wait(SUBSCRIBE_TIMEOUT):
+            logging.warning("Classes listener did not deliver a snapshot in time, keeping the previous window")
+            with self._lock:
+                self._classes_watches.pop(generation, None)
+            watch.unsubscribe()
+            return
+
+        with self._lock:
+            old_watches = [self._classes_watches.pop(old) for old in list(self._classes_watches) if old < generation]
+        for old_watch in old_watches:
+            old_watch.unsubscribe()
+
+    # Apply snapshot changes of the users collection
+    def _apply_user_changes(self, changes):
+        with self._lock:
+            for change in changes:
+                user_id = change.document.id
+                previous = self._users.pop(user_id, None)
+                if previous and self._user_ids_by_username.get(previous.get('telegram')) == user_id:
+                    del self._user_ids_by_username[previous['telegram']]
+                if change.type.name != 'REMOVED':
+                    user_data = change.document.to_dict()
+                    user_data['id'] = user_id
+                    self._users[user_id] = user_data
+                    if user_data.get('telegram'):
+                        self._user_ids_by_username[user_data['telegram']] = user_id
+                # The server state of the user has arrived
+                self._dirty_users.pop(user_id, None)
+            self._users_ready = True
+
+    # Apply snapshot changes of the classes listener to an index (called with the lock held)
+    @staticmethod
+    def _apply_class_changes(classes: Dict[str, ClassRecord], changes):
+        for change in changes:
+            class_id = change.document.id
+            if change.type.name == 'REMOVED':
+                classes.pop(class_id, None)
+                continue
+            try:
+                classes[class_id] = ClassRecord.from_dict(change.document.to_dict(), class_id)
+            except (KeyError, ValueError) as e:
+                logging.warning(f"Skipping malformed class {class_id} in the live index: {e}")
+                classes.pop(class_id, None)
+
+    # Get a user by Telegram username, or NOT_INDEXED. Reads while the index is not running are not counted.
+    def get_user_by_username(self, username: Optional[str]) -> Any:
+        with self._lock:
+            if not self.running:
+                return NOT_INDEXED
+            if not self._users_ready or not username:
+                return self._miss()
+            user_id = self._user_ids_by_username.get(username)
+            if user_id is not None and self._is_dirty(user_id):
+                return self._miss()
+            return self._hit(copy.deepcopy(self._users[user_id]) if user_id is not None else None)
+
+    # Get a user by document ID, or NOT_INDEXED
+    def get_user_by_id(self, user_id: str) -> Any:
+        with self._lock:
+            if not self.running:
+                return NOT_INDEXED
+            if not self._users_ready or self._is_dirty(user_id):
+                return self._miss()
+            user_data = self._users.get(user_id)
+            return self._hit(copy.deepcopy(user_data) if user_data is not None else None)
+
+    # Get a class by document ID, or NOT_INDEXED if it is not in the window
+    def get_class(self, class_id: str) -> Any:
+        with self._lock:
+            if not self.running:
+                return NOT_INDEXED
+            class_record = self._classes.get(class_id) if self._window else None
+            return self._hit(class_record) if class_record is not None else self._miss()
+
+    # Get the classes starting in [start_local, end_local) ordered by start time, or NOT_INDEXED if the range
+    # is not inside the window
+    def get_classes_between(self, start_local: datetime, end_local: datetime) -> Any:
+        if start_local.tzinfo is None:
+            start_local = start_local.replace(tzinfo=ST_PETERSBURG)
+        if end_local.tzinfo is None:
+            end_local = end_local.replace(tzinfo=ST_PETERSBURG)
+        with self._lock:
+            if not self.running:
+                return NOT_INDEXED
+            if not self._window or start_local < self._window[0] or end_local > self._window[1]:
+                return self._miss()
+            classes = [
+                class_record for class_record in self._classes.values()
+                if start_local <= class_record.start < end_local
+            ]
+            self.hits += 1
+        classes.sort(key=lambda class_record: class_record.start)
+        return classes
+
+    # Apply a class written by the bot before its snapshot arrives
+    def put_class(self, class_record: ClassRecord):
+        with self._lock:
+            if self._window and self._window[0] <= class_record.start < self._window[1]:
+                self._classes[class_record.id] = class_record
+
+    # Remove a class deleted by the bot before its snapshot arrives
+    def remove_class(self, class_id: str):
+        with self._lock:
+            self._classes.pop(class_id, None)
+
+    # Change fields of an indexed class (Firestore field names) written by the bot
+    def update_class(self, class_id: str, changes: Dict[str, Any]):
+        with self._lock:
+            class_record = self._classes.get(class_id)
+            if class_record is not None:
+                self._classes[class_id] = ClassRecord.from_dict(dict(class_record.to_dict(), **changes), class_id)
+
+    # Read a user from Firestore until the snapshot of a server-side update by the bot arrives
+    def invalidate_user(self, user_id: str):
+        if self.running:
+            with self._lock:
+                self._dirty_users[user_id] = time.monotonic() + DIRTY_TTL
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'running': self.running,
+                'users': len(self._users) if self._users_ready else None,
+                'classes': len(self._classes) if self._window else None,
+                'window': [bound.isoformat() for bound in self._window] if self._window else None,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / total if total else 0.0,
+            }
+
+    def _is_dirty(self, user_id: str) -> bool:
+        deadline = self._dirty_users.get(user_id)
+        if deadline is None:
+            return False
+        if time.monotonic() > deadline:
+            del self._dirty_users[user_id]
+            return False
+        return True
+
+    def _hit(self, value: Any) -> Any:
+        self.hits += 1
+        return value
+
+    def _miss(self) -> Any:
+        self.misses += 1
+        return NOT_INDEXED
@@ -4,22 +4,55 @@
 # registers handlers from handlers.py, and starts the bot.
 
 import os
+import asyncio
 import logging
 from dotenv import load_dotenv
 from telegram import Update
 from telegram.ext import (
     ApplicationBuilder, 
-    CommandHandler, 
-    CallbackQueryHandler,
     ContextTypes
 )
-from firebase_utils import initialize_firebase
-from handlers_button import button_handler, cancel_command
-from handlers_start import start
-from handlers_newclass import newclass_conv_handler
-from handlers_newrequest import newrequest_conv_handler
-from handlers_cancelclass import cancelclass_conv_handler
-from handlers_schedule import schedule_conv_handler
+from config import (
+    BOT_MODE,
+    WEBHOOK_URL,
+    WEBHOOK_LISTEN,
+    WEBHOOK_PORT,
+    WEBHOOK_SECRET_TOKEN,
+    UPDATE_CONCURRENCY,
+    UPDATE_MAX_PENDING,
+    RATE_LIMIT_GLOBAL_PER_SECOND,
+    RATE_LIMIT_CHAT_PER_SECOND,
+    RATE_LIMIT_CHAT_BURST,
+    RATE_LIMIT_GROUP_PER_MINUTE,
+    RATE_LIMIT_MAX_RETRIES,
+    PERSISTENCE_BACKEND,
+    PERSISTENCE_PATH,
+    PERSISTENCE_UPDATE_INTERVAL,
+    LIVE_INDEX,
+    JOBS_ENABLED,
+    METRICS_LISTEN,
+    METRICS_PORT,
+    METRICS_LOG_INTERVAL,
+    LOG_FILE,
+    LOG_LEVEL,
+    LOG_MAX_BYTES,
+    LOG_ROTATE_WHEN,
+    LOG_BACKUP_COUNT,
+    LOG_JSON,
+    LOG_INFO_SAMPLE_EVERY,
+)
+from firebase_utils import (
+    initialize_firebase, shutdown_executor, start_live_index, stop_live_index, get_user_cache_stats, live_index,
+)
+from handlers import register_handlers
+from jobs import register_jobs, get_job_stats
+from metrics import metrics, log_metrics_summary, start_metrics_server
+from schedule_cache import schedule_cache
+from webhook import run_webhook
+from update_processor import ChatOrderedUpdateProcessor
+from rate_limiter import OutboundRateLimiter
+from persistence import BotData, SQLitePersistence
+from bot_logging import setup_logging, stop_logging
 
 # Load environment variables from .env file
 load_dotenv()
@@ -34,14 +67,24 @@ if not TELEGRAM_BOT_TOKEN:
 if not GOOGLE_APPLICATION_CREDENTIALS:
     raise ValueError("GOOGLE_APPLICATION_CREDENTIALS is not set in the environment variables.")
 
-# Initialize Logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler("bot.log"),
-        logging.StreamHandler()
-    ]
+if BOT_MODE not in ('polling', 'webhook'):
+    raise ValueError("BOT_MODE must be either 'polling' or 'webhook'.")
+
+if PERSISTENCE_BACKEND not in ('sqlite', 'none'):
+    raise ValueError("PERSISTENCE_BACKEND must be either 'sqlite' or 'none'.")
+
+if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+    raise ValueError("WEBHOOK_URL is not set in the environment variables.")
+
+# Initialize Logging (written by a background thread, see bot_logging.py)
+setup_logging(
+    LOG_FILE,
+    level=LOG_LEVEL,
+    max_bytes=LOG_MAX_BYTES,
+    backup_count=LOG_BACKUP_COUNT,
+    when=LOG_ROTATE_WHEN,
+    json_format=LOG_JSON,
+    sample_every=LOG_INFO_SAMPLE_EVERY,
 )
 logger = logging.getLogger(__name__)
 
@@ -49,33 +92,75 @@ logger = logging.getLogger(__name__)
 db = initialize_firebase(GOOGLE_APPLICATION_CREDENTIALS)
 
 # Initialize the Telegram Bot Application
-application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
-
-# Store db in bot_data for access in handlers
-application.bot_data['db'] = db
+# Chats are processed in parallel, the updates of each chat strictly in order
+update_processor = ChatOrderedUpdateProcessor(UPDATE_CONCURRENCY, UPDATE_MAX_PENDING)
+# All outgoing requests are throttled per chat and globally, and retried after flood-control errors
+rate_limiter = OutboundRateLimiter(
+    global_per_second=RATE_LIMIT_GLOBAL_PER_SECOND,
+    chat_per_second=RATE_LIMIT_CHAT_PER_SECOND,
+    chat_burst=RATE_LIMIT_CHAT_BURST,
+    group_per_minute=RATE_LIMIT_GROUP_PER_MINUTE,
+    max_retries=RATE_LIMIT_MAX_RETRIES,
+)
+builder = (
+    ApplicationBuilder()
+    .token(TELEGRAM_BOT_TOKEN)
+    .concurrent_updates(update_processor)
+    .rate_limiter(rate_limiter)
+    .context_types(ContextTypes(bot_data=BotData))
+)
+if BOT_MODE == 'webhook':
+    # Updates arrive through the embedded web server instead of the polling Updater
+    builder = builder.updater(None)
+
+# Keep conversation states and user/chat/bot data across restarts
+persistence = None
+if PERSISTENCE_BACKEND == 'sqlite':
+    persistence = SQLitePersistence(PERSISTENCE_PATH, update_interval=PERSISTENCE_UPDATE_INTERVAL)
+    builder = builder.persistence(persistence)
+
+
+# Figures of the caches, jobs and throttling served next to the handler and Firestore metrics
+metrics.add_source('user_cache', get_user_cache_stats)
+metrics.add_source('schedule_cache', schedule_cache.stats)
+metrics.add_source('live_index', live_index.stats)
+metrics.add_source('jobs', get_job_stats)
+metrics.add_source('update_processor', update_processor.metrics)
+metrics.add_source('rate_limiter', rate_limiter.metrics)
+metrics_server = None
+
+
+# Store db in bot_data for access in handlers (after the persistence has restored bot_data)
+async def post_init(application):
+    global metrics_server
+    application.bot_data['db'] = db
+    if LIVE_INDEX:
+        await start_live_index(db)
+    # In webhook mode /metrics is a route of the webhook app
+    if METRICS_PORT and BOT_MODE == 'polling':
+        metrics_server = await start_metrics_server(METRICS_LISTEN, METRICS_PORT)
+
+
+# Unsubscribe the live index listeners and stop the metrics endpoint
+async def post_shutdown(application):
+    if LIVE_INDEX:
+        await stop_live_index()
+    if metrics_server is not None:
+        await metrics_server.stop()
+
+builder = builder.post_init(post_init).post_shutdown(post_shutdown)
+application = builder.build()
 
 # Register Handlers
+register_handlers(application, persistent=persistence is not None)
 
-# START Command Handler
-application.add_handler(CommandHandler('start', start))
-
-# Add the cancel command handler
-application.add_handler(CommandHandler('cancel', cancel_command))
-
-# NEWCLASS Conversation Handler
-application.add_handler(newclass_conv_handler())
-
-# NEWREQUEST Conversation Handler
-application.add_handler(newrequest_conv_handler())
-
-# CANCELCLASS Conversation Handler
-application.add_handler(cancelclass_conv_handler())
-
-# SCHEDULE Conversation Handler
-application.add_handler(schedule_conv_handler())
+# Schedule the reminder and auto-status jobs
+if JOBS_ENABLED:
+    register_jobs(application)
 
-# Button Callback Handler (Handles generic buttons not managed by ConversationHandlers)
-application.add_handler(CallbackQueryHandler(button_handler, pattern='^(CANCEL|SKIP)$'))
+# Log a metrics summary line periodically
+if METRICS_LOG_INTERVAL and application.job_queue is not None:
+    application.job_queue.run_repeating(log_metrics_summary, interval=METRICS_LOG_INTERVAL, first=METRICS_LOG_INTERVAL, name='metrics_summary')
 
 # Error Handler
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
@@ -89,5 +174,13 @@ application.add_error_handler(error_handler)
 
 # Start the Bot
 if __name__ == '__main__':
-    logger.info("Starting the bot...")
-    application.run_polling()
\ No newline at end of file
+    if BOT_MODE == 'webhook':
+        logger.info(f"Starting the bot in webhook mode on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}...")
+        asyncio.run(run_webhook(
+            application, WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_SECRET_TOKEN, serve_metrics=bool(METRICS_PORT),
+        ))
+    else:
+        logger.info("Starting the bot...")
+        application.run_polling()
+    shutdown_executor()
+    stop_logging()
\ No newline at end of file
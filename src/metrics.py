@@ -0,0 +1,314 @@
+# In-process metrics: latency histograms and error counts of the handlers and of the firebase_utils helpers,
+# and the number of Firestore calls each handler run makes.
+
+# instrument_handlers wraps the callback of every handler registered on the application (including the entry
+# points, states and fallbacks of the conversations); instrument_functions wraps the coroutine functions of a
+# module (firebase_utils applies it to itself). Firestore calls are counted by firebase_utils.run_blocking
+# through count_firestore_call and attributed to the handler run of the current asyncio context; background tasks
+# are started outside_handler_run, so they are not attributed to any handler. A call is one blocking helper run in
+# the thread pool, which may issue several RPCs (e.g. a chunked get_all or a retried transaction); cache hits cost
+# no call.
+# The figures are served as JSON on GET /metrics (a Starlette route: on its own local port in polling mode, on
+# the webhook app in webhook mode) and summarized in one log line every METRICS_LOG_INTERVAL seconds. Other
+# components add their own figures with add_source.
+
+import asyncio
+import contextlib
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Route
+from telegram.ext import Application, BaseHandler, CallbackContext, ConversationHandler
+from callback_data import CallbackRouter
+
+# Upper bounds of the latency buckets, in milliseconds (the last bucket is unbounded)
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# Upper bounds of the buckets of Firestore calls per handler run
+CALL_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21)
+
+METRICS_PATH = '/metrics'
+
+# Firestore calls of the handler run of the current context, None outside handlers
+_handler_calls: contextvars.ContextVar[Optional[List[int]]] = contextvars.ContextVar('handler_calls', default=None)
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    # Upper bound of the bucket holding the given quantile (the maximum for the unbounded bucket)
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.buckets[index] if index < len(self.buckets) else self.max
+        return self.max
+
+    def to_dict(self) -> Dict[str, Any]:
+        bounds = [str(bound) for bound in self.buckets] + ['inf']
+        return {
+            'count': self.count,
+            'avg': self.total / self.count if self.count else 0.0,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'max': self.max,
+            'buckets': dict(zip(bounds, self.counts)),
+        }
+
+
+class Metrics:
+    def __init__(self):
+        # Helpers are timed in the Firestore worker threads as well
+        self._lock = threading.Lock()
+        self._latency: Dict[Tuple[str, str], Histogram] = {}
+        self._errors: Dict[Tuple[str, str], int] = {}
+        self._calls: Dict[str, Histogram] = {}
+        self._sources: Dict[str, Callable[[], Any]] = {}
+        self.started = time.time()
+
+    # Record a call of a handler ('handler') or helper ('firestore'), in seconds
+    def observe(self, kind: str, name: str, seconds: float, error: bool = False):
+        with self._lock:
+            histogram = self._latency.get((kind, name))
+            if histogram is None:
+                histogram = self._latency[(kind, name)] = Histogram(LATENCY_BUCKETS_MS)
+            histogram.observe(seconds * 1000)
+            if error:
+                self._errors[(kind, name)] = self._errors.get((kind, name), 0) + 1
+
+    # Record the Firestore calls of a handler run
+    def observe_calls(self, handler: str, calls: int):
+        with self._lock:
+            histogram = self._calls.get(handler)
+            if histogram is None:
+                histogram = self._calls[handler] = Histogram(CALL_BUCKETS)
+            histogram.observe(calls)
+
+    # Add the figures of another component (e.g. a cache) to the snapshot
+    def add_source(self, name: str, source: Callable[[], Any]):
+        self._sources[name] = source
+
+    def reset(self):
+        with self._lock:
+            self._latency.clear()
+            self._errors.clear()
+            self._calls.clear()
+            self.started = time.time()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            result: Dict[str, Any] = {'uptime_seconds': time.time() - self.started, 'handlers': {}, 'firestore': {}}
+            for (kind, name), histogram in sorted(self._latency.items()):
+                errors = self._errors.get((kind, name), 0)
+                entry = {'latency_ms': histogram.to_dict(), 'errors': errors, 'error_rate': errors / histogram.count}
+                if kind == 'handler' and name in self._calls:
+                    entry['firestore_calls_per_run'] = self._calls[name].to_dict()
+                result['handlers' if kind == 'handler' else 'firestore'][name] = entry
+        for name, source in self._sources.items():
+            try:
+                result[name] = source()
+            except Exception as e:
+                result[name] = {'error': str(e)}
+        return result
+
+    # One line with the busiest handlers, e.g. "start n=12 p95=250ms calls=1.5 err=0"
+    def summary(self, limit: int = 8) -> str:
+        with self._lock:
+            handlers = sorted(
+                ((name, histogram) for (kind, name), histogram in self._latency.items() if kind == 'handler'),
+                key=lambda item: item[1].count, reverse=True,
+            )[:limit]
+            helper_calls = sum(histogram.count for (kind, name), histogram in self._latency.items() if kind == 'firestore')
+            errors = sum(self._errors.values())
+            parts = []
+            for name, histogram in handlers:
+                handler_calls = self._calls.get(name)
+                parts.append(
+                    f"{name} n={histogram.count} p95={histogram.quantile(0.95):g}ms "
+                    f"calls={handler_calls.total / handler_calls.count if handler_calls and handler_calls.count else 0:.1f} "
+                    f"err={self._errors.get(('handler', name), 0)}"
+                )
+        return f"handlers: {'; '.join(parts) or 'none'} | firestore helper calls: {helper_calls} | errors: {errors}"
+
+
+# Metrics shared by the whole bot
+metrics = Metrics()
+
+
+# Count a Firestore call for the handler run of the current context
+def count_firestore_call():
+    calls = _handler_calls.get()
+    if calls is not None:
+        calls[0] += 1
+
+
+# Call func(*args) in a copy of the current context that belongs to no handler run. Background tasks (e.g. schedule
+# prefetches) are started this way: a task copies the context it is created in, so it would otherwise add its
+# Firestore calls to the handler that started it, but only if it finished before that handler did.
+def outside_handler_run(func: Callable, *args) -> Any:
+    context = contextvars.copy_context()
+    context.run(_handler_calls.set, None)
+    return context.run(func, *args)
+
+
+# Wrap a handler callback: time it, count its errors and its Firestore calls
+def instrument_callback(name: str, callback: Callable) -> Callable:
+    if getattr(callback, '_instrumented', False):
+        return callback
+
+    @functools.wraps(callback)
+    async def wrapper(update: object, context: CallbackContext, *args, **kwargs):
+        calls = [0]
+        token = _handler_calls.set(calls)
+        started = time.perf_counter()
+        error = False
+        try:
+            return await callback(update, context, *args, **kwargs)
+        except Exception:
+            error = True
+            raise
+        finally:
+            _handler_calls.reset(token)
+            metrics.observe('handler', name, time.perf_counter() - started, error)
+            metrics.observe_calls(name, calls[0])
+
+    wrapper._instrumented = True
+    return wrapper
+
+
+def _instrument_handler(handler: BaseHandler):
+    if isinstance(handler, ConversationHandler):
+        for state_handlers in handler.states.values():
+            for state_handler in state_handlers:
+                _instrument_handler(state_handler)
+        for inner_handler in handler.entry_points + handler.fallbacks:
+            _instrument_handler(inner_handler)
+    elif isinstance(handler, CallbackRouter):
+        # The router's own callback only dispatches, its routes are the handlers
+        for action, callback in handler.routes.items():
+            handler.routes[action] = instrument_callback(callback.__name__, callback)
+        if handler.fallback is not None:
+            handler.fallback = instrument_callback(handler.fallback.__name__, handler.fallback)
+    elif getattr(handler, 'callback', None) is not None:
+        handler.callback = instrument_callback(handler.callback.__name__, handler.callback)
+
+
+# Wrap the callbacks of all handlers registered on the application
+def instrument_handlers(application: Application):
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            _instrument_handler(handler)
+
+
+# Wrap a coroutine function: time it and count its errors
+def instrument_function(name: str, func: Callable) -> Callable:
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        error = False
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            error = True
+            raise
+        finally:
+            metrics.observe('firestore', name, time.perf_counter() - started, error)
+
+    # Keep pointing at the undecorated (blocking) function
+    wrapper.__wrapped__ = getattr(func, '__wrapped__', func)
+    return wrapper
+
+
+# Wrap the public coroutine functions defined in a module namespace (pass the module's globals())
+def instrument_functions(namespace: Dict[str, Any], exclude: Tuple[str, ...] = ()):
+    module_name = namespace['__name__']
+    for name, value in list(namespace.items()):
+        if (
+            not name.startswith('_') and name not in exclude
+            and inspect.iscoroutinefunction(value) and value.__module__ == module_name
+        ):
+            namespace[name] = instrument_function(name, value)
+
+
+# Log the summary line every interval seconds (run as a JobQueue job)
+async def log_metrics_summary(context: CallbackContext):
+    logging.info(f"Metrics: {metrics.summary()}", extra={'sample': False})
+
+
+# GET /metrics: the snapshot as JSON
+async def metrics_endpoint(request: Request) -> Response:
+    return Response(json.dumps(metrics.snapshot(), ensure_ascii=False, default=str), media_type='application/json')
+
+
+# Route of the endpoint, also served by the webhook app (see webhook.py)
+metrics_route = Route(METRICS_PATH, metrics_endpoint, methods=['GET'])
+
+
+# uvicorn server of the metrics app running next to the bot: the bot handles the signals, the server is stopped
+# by stop() on shutdown
+class MetricsServer(uvicorn.Server):
+    def __init__(self, host: str, port: int):
+        super().__init__(config=uvicorn.Config(
+            app=Starlette(routes=[metrics_route]),
+            host=host,
+            port=port,
+            use_colors=False,
+            log_config=None,  # Keep the bot's logging configuration
+        ))
+        self._task: Optional[asyncio.Task] = None
+
+    def capture_signals(self):
+        return contextlib.nullcontext()
+
+    # Port the server listens on (useful with port 0)
+    @property
+    def port(self) -> int:
+        return self.servers[0].sockets[0].getsockname()[1]
+
+    async def start(self):
+        self._task = asyncio.get_running_loop().create_task(self.serve())
+        while not self.started:
+            if self._task.done():
+                # Startup failed: raise its error
+                await self._task
+            await asyncio.sleep(0.01)
+        logging.info(f"Metrics served on http://{self.config.host}:{self.port}{METRICS_PATH}")
+
+    async def stop(self):
+        self.should_exit = True
+        if self._task is not None:
+            await self._task
+
+
+# Serve GET /metrics on a local port. Returns the server (stop it on shutdown).
+async def start_metrics_server(host: str, port: int) -> MetricsServer:
+    server = MetricsServer(host, port)
+    await server.start()
+    return server
@@ -0,0 +1,150 @@
+# Persistence of conversation states, user_data, chat_data and bot_data across restarts.
+
+# SQLitePersistence is a telegram.ext BasePersistence backend storing every entry as a pickled row in a local
+# SQLite file. The application hands over only the users, chats and conversations changed since the last run
+# (every update_interval seconds and on shutdown); those rows are written in a single transaction off the
+# event loop. Everything is loaded once at startup, so restarts stay cheap and users continue where they
+# left off.
+
+import asyncio
+import copy
+import json
+import logging
+import pickle
+import sqlite3
+import threading
+from typing import Any, Dict, Optional, Tuple
+from telegram.ext import BasePersistence, PersistenceInput
+
+# bot_data entries that only live in memory (e.g. the Firestore client) and are never persisted
+TRANSIENT_BOT_DATA_KEYS = ('db',)
+
+
+# bot_data type whose copies, which the application hands over to the persistence, skip the transient entries
+class BotData(dict):
+    def __deepcopy__(self, memo):
+        return BotData({
+            key: copy.deepcopy(value, memo)
+            for key, value in self.items()
+            if key not in TRANSIENT_BOT_DATA_KEYS
+        })
+
+
+class SQLitePersistence(BasePersistence):
+    def __init__(self, filepath: str, update_interval: float = 60):
+        # Callback data is not used by the bot's keyboards
+        super().__init__(
+            store_data=PersistenceInput(bot_data=True, chat_data=True, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._connection = sqlite3.connect(filepath, check_same_thread=False)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS state (kind TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, '
+            'PRIMARY KEY (kind, key))'
+        )
+        self._connection.commit()
+        self._connection_lock = threading.Lock()
+        # Changes not written yet: (kind, key) -> pickled value, None deletes the row
+        self._pending: Dict[Tuple[str, str], Optional[bytes]] = {}
+        self._write_task: Optional[asyncio.Task] = None
+
+    async def get_user_data(self) -> Dict[int, Dict[Any, Any]]:
+        return {int(key): value for key, value in (await self._load('user_data')).items()}
+
+    async def get_chat_data(self) -> Dict[int, Dict[Any, Any]]:
+        return {int(key): value for key, value in (await self._load('chat_data')).items()}
+
+    async def get_bot_data(self) -> BotData:
+        return BotData((await self._load('bot_data')).get('bot_data', {}))
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> Dict[Tuple, object]:
+        rows = await self._load(f'conversation:{name}')
+        return {tuple(json.loads(key)): state for key, state in rows.items()}
+
+    async def update_conversation(self, name: str, key: Tuple, new_state: Optional[object]) -> None:
+        self._stage(f'conversation:{name}', json.dumps(list(key)), new_state)
+
+    async def update_user_data(self, user_id: int, data: Dict[Any, Any]) -> None:
+        self._stage('user_data', str(user_id), data)
+
+    async def update_chat_data(self, chat_id: int, data: Dict[Any, Any]) -> None:
+        self._stage('chat_data', str(chat_id), data)
+
+    async def update_bot_data(self, data: BotData) -> None:
+        self._stage('bot_data', 'bot_data', dict(data))
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._stage('chat_data', str(chat_id), None)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._stage('user_data', str(user_id), None)
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: BotData) -> None:
+        pass
+
+    # Write everything still pending and close the database (called on shutdown)
+    async def flush(self) -> None:
+        if self._write_task:
+            # A failed write was logged and its rows are pending again
+            await asyncio.wait({self._write_task})
+        await self._write_pending()
+        with self._connection_lock:
+            self._connection.close()
+
+    # Remember a changed entry and schedule one write for all changes handed over in this round
+    def _stage(self, kind: str, key: str, value: Any) -> None:
+        self._pending[(kind, key)] = None if value is None else pickle.dumps(value)
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.get_running_loop().create_task(self._write_pending())
+            self._write_task.add_done_callback(self._log_write_error)
+
+    # Write the pending changes, then those staged while the previous transaction was running, until none are left
+    async def _write_pending(self) -> None:
+        while True:
+            # Let the other updates of the same persistence run join this transaction
+            await asyncio.sleep(0)
+            pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self._write_rows, pending)
+            except Exception:
+                # Keep the rows for the next write, unless they were changed again meanwhile
+                for row, value in pending.items():
+                    self._pending.setdefault(row, value)
+                raise
+
+    @staticmethod
+    def _log_write_error(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logging.error("Error writing the persisted state", exc_info=task.exception())
+
+    def _write_rows(self, pending: Dict[Tuple[str, str], Optional[bytes]]) -> None:
+        with self._connection_lock, self._connection:
+            for (kind, key), value in pending.items():
+                if value is None:
+                    self._connection.execute('DELETE FROM state WHERE kind = ? AND key = ?', (kind, key))
+                else:
+                    self._connection.execute(
+                        'INSERT OR REPLACE INTO state (kind, key, value) VALUES (?, ?, ?)', (kind, key, value)
+                    )
+
+    async def _load(self, kind: str) -> Dict[str, Any]:
+        return await asyncio.get_running_loop().run_in_executor(None, self._read_rows, kind)
+
+    def _read_rows(self, kind: str) -> Dict[str, Any]:
+        with self._connection_lock:
+            rows = self._connection.execute('SELECT key, value FROM state WHERE kind = ?', (kind,)).fetchall()
+        return {key: pickle.loads(value) for key, value in rows}
@@ -0,0 +1,226 @@
+# Rate limiter for all outgoing Telegram API requests (plugged into the bot via ApplicationBuilder.rate_limiter).
+
+# Requests addressed to a chat wait for a token from that chat's bucket and then from the global bucket, which
+# keeps the bot below Telegram's flood limits (about one message per second per chat, 20 per minute per group
+# and 30 per second overall). A RetryAfter (429) answer pauses the affected bucket for the time Telegram asks,
+# and the request is retried. An edit of a message that is still waiting while a newer edit of the same message
+# arrives is not sent at all and uses no token; it resolves to the result of the newest edit.
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Tuple, Union
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+# Endpoints whose pending requests are superseded by a newer request for the same message
+COALESCED_ENDPOINTS = ('editMessageText', 'editMessageReplyMarkup')
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    # clock and sleep can be replaced in tests
+    def __init__(self, rate: float, capacity: float, clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], Coroutine[Any, Any, None]] = asyncio.sleep):
+        self.rate = rate  # Tokens added per second
+        self.capacity = capacity
+        self.tokens = capacity
+        self._clock = clock
+        self._sleep = sleep
+        self.updated = clock()
+        self.blocked_until = 0.0
+        # Waiters are served in arrival order
+        self._lock = asyncio.Lock()
+
+    # Wait for a token, returns the seconds spent waiting
+    async def acquire(self) -> float:
+        started = self._clock()
+        async with self._lock:
+            while True:
+                now = self._clock()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                delay = self.blocked_until - now
+                if delay <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return now - started
+                    delay = (1 - self.tokens) / self.rate
+                await self._sleep(delay)
+
+    # Give back a token that was not used
+    def release(self) -> None:
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    # Stop handing out tokens for the given number of seconds
+    def pause(self, seconds: float) -> None:
+        self.blocked_until = max(self.blocked_until, self._clock() + seconds)
+
+    @property
+    def busy(self) -> bool:
+        return self._lock.locked()
+
+
+class OutboundRateLimiter(BaseRateLimiter[int]):
+    def __init__(
+        self,
+        global_per_second: float = 30,
+        chat_per_second: float = 1,
+        chat_burst: float = 3,
+        group_per_minute: float = 20,
+        max_retries: int = 3,
+        max_tracked_chats: int = 10000,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], Coroutine[Any, Any, None]] = asyncio.sleep,
+    ):
+        self._clock = clock
+        self._sleep = sleep
+        self._global_bucket = TokenBucket(global_per_second, global_per_second, clock, sleep)
+        self._chat_per_second = chat_per_second
+        self._chat_burst = chat_burst
+        self._group_per_second = group_per_minute / 60
+        self._max_retries = max_retries
+        self._max_tracked_chats = max_tracked_chats
+        self._chat_buckets: 'OrderedDict[Union[int, str], TokenBucket]' = OrderedDict()
+        # Newest edit per (endpoint, chat_id, message_id): (generation, future with its result). It is kept, even
+        # once sent, until no older edit of the message is in flight, so a retried older edit still resolves to it.
+        self._pending_edits: Dict[Tuple[str, Any, Any], Tuple[int, asyncio.Future]] = {}
+        self._edits_in_flight: Dict[Tuple[str, Any, Any], int] = {}
+        self._edit_generation = 0
+        self.requests = 0
+        self.throttled = 0
+        self.retries_after = 0
+        self.coalesced = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    # rate_limit_args: optional number of retries after RetryAfter for this request
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, Dict[str, Any], List[Dict[str, Any]]]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[int],
+    ) -> Union[bool, Dict[str, Any], List[Dict[str, Any]]]:
+        self.requests += 1
+        max_retries = self._max_retries if rate_limit_args is None else rate_limit_args
+        chat_id = data.get('chat_id')
+        if endpoint not in COALESCED_ENDPOINTS or chat_id is None or data.get('message_id') is None:
+            return await self._send(callback, args, kwargs, endpoint, chat_id, max_retries)
+
+        # Register the edit as the newest one of its message; older waiting edits will resolve to its result
+        edit_key = (endpoint, chat_id, data['message_id'])
+        self._edit_generation += 1
+        generation = self._edit_generation
+        future = asyncio.get_running_loop().create_future()
+        # Results nobody waits for must not be reported as unretrieved
+        future.add_done_callback(lambda done: done.cancelled() or done.exception())
+        self._pending_edits[edit_key] = (generation, future)
+        self._edits_in_flight[edit_key] = self._edits_in_flight.get(edit_key, 0) + 1
+        try:
+            result = await self._send(callback, args, kwargs, endpoint, chat_id, max_retries, edit_key, generation)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self._edits_in_flight[edit_key] -= 1
+            if not self._edits_in_flight[edit_key]:
+                del self._edits_in_flight[edit_key]
+                del self._pending_edits[edit_key]
+
+    # Queue latency and throttling figures for monitoring
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            'requests': self.requests,
+            'throttled': self.throttled,
+            'retries_after': self.retries_after,
+            'coalesced_edits': self.coalesced,
+            'avg_wait_seconds': self.total_wait_seconds / self.requests if self.requests else 0.0,
+            'max_wait_seconds': self.max_wait_seconds,
+            'tracked_chats': len(self._chat_buckets),
+        }
+
+    # Wait for tokens and send the request, retrying after RetryAfter
+    async def _send(self, callback, args, kwargs, endpoint, chat_id, max_retries, edit_key=None, generation=None):
+        chat_bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+        for attempt in range(max_retries + 1):
+            # An edit superseded by a newer edit of the same message is skipped without using any quota: it is
+            # checked before each token and a token taken for it is given back
+            superseded = self._superseded_by(edit_key, generation)
+            if superseded is None and chat_bucket:
+                wait_seconds = await chat_bucket.acquire()
+                superseded = self._superseded_by(edit_key, generation)
+                if superseded is None:
+                    wait_seconds += await self._global_bucket.acquire()
+                    superseded = self._superseded_by(edit_key, generation)
+                    if superseded is not None:
+                        self._global_bucket.release()
+                if superseded is not None:
+                    chat_bucket.release()
+                self._record_wait(wait_seconds)
+            if superseded is not None:
+                self.coalesced += 1
+                return await asyncio.shield(superseded)
+
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as exc:
+                self.retries_after += 1
+                if attempt == max_retries:
+                    logger.error(f"Rate limit hit on {endpoint} after {max_retries} retries")
+                    raise
+                logger.info(f"Rate limit hit on {endpoint}, retrying after {exc.retry_after} seconds")
+                retry_after = exc.retry_after.total_seconds() if hasattr(exc.retry_after, 'total_seconds') else exc.retry_after
+                # Private chats are limited individually, anything else pauses all chats
+                if chat_bucket and isinstance(chat_id, int) and chat_id > 0:
+                    chat_bucket.pause(retry_after)
+                elif chat_bucket:
+                    self._global_bucket.pause(retry_after)
+                else:
+                    await self._sleep(retry_after)
+
+    # Future of the newer edit of the same message, None if the edit is still the newest (or not an edit)
+    def _superseded_by(self, edit_key, generation) -> Optional[asyncio.Future]:
+        if not edit_key:
+            return None
+        latest_generation, latest_future = self._pending_edits[edit_key]
+        return latest_future if latest_generation != generation else None
+
+    def _chat_bucket(self, chat_id: Union[int, str]) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = self._group_per_second if is_group else self._chat_per_second
+            bucket = TokenBucket(rate, self._chat_burst, self._clock, self._sleep)
+            self._chat_buckets[chat_id] = bucket
+            # Forget the least recently used idle chats
+            while len(self._chat_buckets) > self._max_tracked_chats:
+                oldest_id, oldest = next(iter(self._chat_buckets.items()))
+                if oldest.busy:
+                    break
+                del self._chat_buckets[oldest_id]
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    def _record_wait(self, wait_seconds: float) -> None:
+        if wait_seconds > 0.001:
+            self.throttled += 1
+        self.total_wait_seconds += wait_seconds
+        self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
@@ -0,0 +1,139 @@
+# Per-admin cache of schedule windows, so navigating the schedule day by day rarely waits on Firestore.
+
+# A window is one local week (Monday to Sunday) loaded with a single get_classes_between range query and
+# grouped by local date. When an admin views a day, the neighbouring weeks are prefetched in the background,
+# so stepping past the edge of the week is served from memory as well. Windows expire after the TTL, so
+# bookings made elsewhere show up, and the handlers that write classes invalidate the affected day for all
+# admins. At most MAX_WINDOWS_PER_ADMIN windows are kept per admin (the least recently used are dropped).
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from firebase_admin import firestore
+from class_record import ClassRecord, ST_PETERSBURG
+from config import SCHEDULE_CACHE_TTL
+from firebase_utils import get_classes_between
+from metrics import outside_handler_run
+
+WINDOW_DAYS = 7
+MAX_WINDOWS_PER_ADMIN = 4
+
+
+# First day (Monday) of the window that contains a date
+def window_start(day: date) -> date:
+    return day - timedelta(days=day.weekday())
+
+
+class ScheduleCache:
+    def __init__(self, ttl: float):
+        self._ttl = ttl
+        # admin ID -> window start -> (classes by local date 'YYYY-MM-DD', monotonic time the window was loaded)
+        self._windows: Dict[int, 'OrderedDict[date, Tuple[Dict[str, List[ClassRecord]], float]]'] = {}
+        # Loads in flight, shared by concurrent requests and background prefetches
+        self._loading: Dict[Tuple[int, date], asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+
+    # Get the classes of a local day for an admin, loading its window if needed, and prefetch the neighbours
+    async def get_day(self, db: firestore.client, admin_id: int, day: date) -> List[ClassRecord]:
+        start = window_start(day)
+        window = self._fresh_window(admin_id, start)
+        if window is None:
+            self.misses += 1
+            window = await self._load(db, admin_id, start)
+        else:
+            self.hits += 1
+
+        for neighbour in (start - timedelta(days=WINDOW_DAYS), start + timedelta(days=WINDOW_DAYS)):
+            self.prefetch(db, admin_id, neighbour)
+
+        return list(window.get(day.isoformat(), []))
+
+    # Start loading a window in the background unless it is cached or already loading. Its Firestore calls are
+    # not counted for the handler that triggered it.
+    def prefetch(self, db: firestore.client, admin_id: int, start: date):
+        if self._fresh_window(admin_id, start) is None and (admin_id, start) not in self._loading:
+            outside_handler_run(self._start_load, db, admin_id, start)
+
+    # Drop a local day from every admin's cached windows (after a class of that day was written)
+    def invalidate_day(self, day: date):
+        start = window_start(day)
+        for windows in self._windows.values():
+            windows.pop(start, None)
+        # A load in flight may have read the old data: let it finish but do not keep its result
+        for (admin_id, loading_start), task in list(self._loading.items()):
+            if loading_start == start:
+                self._loading.pop((admin_id, loading_start))
+
+    # Drop the windows of one admin, or of all admins
+    def clear(self, admin_id: Optional[int] = None):
+        if admin_id is None:
+            self._windows.clear()
+            self._loading.clear()
+        else:
+            self._windows.pop(admin_id, None)
+            for key in [key for key in self._loading if key[0] == admin_id]:
+                self._loading.pop(key)
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / total if total else 0.0,
+            'windows': sum(len(windows) for windows in self._windows.values()),
+            'loading': len(self._loading),
+        }
+
+    def _fresh_window(self, admin_id: int, start: date) -> Optional[Dict[str, List[ClassRecord]]]:
+        windows = self._windows.get(admin_id)
+        entry = windows.get(start) if windows else None
+        if entry is None or time.monotonic() - entry[1] > self._ttl:
+            return None
+        windows.move_to_end(start)
+        return entry[0]
+
+    async def _load(self, db: firestore.client, admin_id: int, start: date) -> Dict[str, List[ClassRecord]]:
+        task = self._loading.get((admin_id, start)) or self._start_load(db, admin_id, start)
+        # Shield the shared load, so a cancelled handler does not cancel it for the others
+        return await asyncio.shield(task)
+
+    def _start_load(self, db: firestore.client, admin_id: int, start: date) -> asyncio.Task:
+        task = asyncio.create_task(self._fetch(db, admin_id, start))
+        self._loading[(admin_id, start)] = task
+        task.add_done_callback(self._log_prefetch_error)
+        return task
+
+    async def _fetch(self, db: firestore.client, admin_id: int, start: date) -> Dict[str, List[ClassRecord]]:
+        key = (admin_id, start)
+        task = asyncio.current_task()
+        try:
+            start_local = datetime.combine(start, datetime.min.time(), tzinfo=ST_PETERSBURG)
+            classes = await get_classes_between(db, start_local, start_local + timedelta(days=WINDOW_DAYS))
+            window: Dict[str, List[ClassRecord]] = {}
+            for class_record in classes:
+                window.setdefault(class_record.local_start.date().isoformat(), []).append(class_record)
+
+            # Keep the result only if the window was not invalidated while it was loading
+            if self._loading.get(key) is task:
+                windows = self._windows.setdefault(admin_id, OrderedDict())
+                windows[start] = (window, time.monotonic())
+                windows.move_to_end(start)
+                while len(windows) > MAX_WINDOWS_PER_ADMIN:
+                    windows.popitem(last=False)
+            return window
+        finally:
+            if self._loading.get(key) is task:
+                del self._loading[key]
+
+    @staticmethod
+    def _log_prefetch_error(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"Error loading a schedule window: {task.exception()}")
+
+
+# Schedule windows shared by the SCHEDULE handlers
+schedule_cache = ScheduleCache(ttl=SCHEDULE_CACHE_TTL)
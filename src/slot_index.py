@@ -0,0 +1,92 @@
+# In-memory index of occupied class slots, keyed by local (Saint Petersburg) date.
+
+# Each day is stored as a bitmap over the bookable hours 08:00-20:00 (bit 0 is the 08:00 slot).
+# Days are loaded lazily from Firestore on first use and reloaded once they are older than the TTL,
+# so bookings made outside the bot are picked up. Booking, cancellation and deletion handlers keep the
+# index current by claiming and releasing slots as they write.
+
+import time
+from datetime import datetime
+from typing import Dict, Tuple
+from firebase_admin import firestore
+from config import SLOT_INDEX_TTL
+from firebase_utils import get_occupied_time_slots, ST_PETERSBURG
+
+# Bookable hours: a slot starts at every full hour from FIRST_HOUR up to (not including) LAST_HOUR
+FIRST_HOUR = 8
+LAST_HOUR = 20
+
+
+# Bit of the slot starting at the given local hour (0 for hours outside the bookable range)
+def hour_bit(hour: int) -> int:
+    if FIRST_HOUR <= hour < LAST_HOUR:
+        return 1 << (hour - FIRST_HOUR)
+    return 0
+
+
+# Local date ('YYYY-MM-DD') and hour of a class from its UTC ISO8601 startdate
+def slot_of(startdate: str) -> Tuple[str, int]:
+    local_start = datetime.fromisoformat(startdate.replace('Z', '+00:00')).astimezone(ST_PETERSBURG)
+    return local_start.strftime('%Y-%m-%d'), local_start.hour
+
+
+class SlotIndex:
+    def __init__(self, ttl: float):
+        self._ttl = ttl
+        # date -> (bitmap of occupied hours, monotonic time the day was loaded)
+        self._days: Dict[str, Tuple[int, float]] = {}
+
+    # Get the occupied-hours bitmap of a day, loading it from Firestore if missing or expired
+    async def get_bitmap(self, db: firestore.client, date_str: str) -> int:
+        entry = self._days.get(date_str)
+        if entry is None or time.monotonic() - entry[1] > self._ttl:
+            started = time.monotonic()
+            occupied_slots = await get_occupied_time_slots(db, date_str)
+            # Keep a fresher load (and the claims made on it) that finished while this one was running
+            entry = self._days.get(date_str)
+            if entry is not None and entry[1] >= started:
+                return entry[0]
+            bitmap = 0
+            for slot in occupied_slots:
+                bitmap |= hour_bit(int(slot.split(':')[0]))
+            self._days[date_str] = (bitmap, time.monotonic())
+            return bitmap
+        return entry[0]
+
+    # Check whether the slot is still free
+    async def is_free(self, db: firestore.client, date_str: str, hour: int) -> bool:
+        return not await self.get_bitmap(db, date_str) & hour_bit(hour)
+
+    # Mark the slot as occupied. Returns False if it was already taken.
+    # The check and the update happen without yielding to the event loop, so two bookings in this
+    # process can never claim the same slot.
+    async def claim(self, db: firestore.client, date_str: str, hour: int) -> bool:
+        bitmap = await self.get_bitmap(db, date_str)
+        bit = hour_bit(hour)
+        if bitmap & bit:
+            return False
+        self.occupy(date_str, hour)
+        return True
+
+    # Mark the slot as occupied if the day is loaded
+    def occupy(self, date_str: str, hour: int) -> None:
+        entry = self._days.get(date_str)
+        if entry is not None:
+            self._days[date_str] = (entry[0] | hour_bit(hour), entry[1])
+
+    # Mark the slot as free if the day is loaded
+    def release(self, date_str: str, hour: int) -> None:
+        entry = self._days.get(date_str)
+        if entry is not None:
+            self._days[date_str] = (entry[0] & ~hour_bit(hour), entry[1])
+
+    # Forget a day so it is reloaded on next use
+    def invalidate(self, date_str: str) -> None:
+        self._days.pop(date_str, None)
+
+    def clear(self) -> None:
+        self._days.clear()
+
+
+# Slot index shared by all handlers
+slot_index = SlotIndex(ttl=SLOT_INDEX_TTL)
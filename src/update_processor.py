@@ -0,0 +1,92 @@
+# Update processor that handles different chats in parallel while keeping the updates of one chat in order.
+
+# Updates of the same chat wait for each other (a per-chat asyncio.Lock, granted in arrival order), so the
+# ConversationHandler state of a chat always sees its updates one by one. Updates of different chats only
+# share the global limit of concurrently running handlers. A slow Firestore call in one chat therefore
+# no longer stalls every other chat.
+
+import asyncio
+import time
+from contextlib import nullcontext
+from typing import Any, Awaitable, Dict, Optional
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    # max_concurrent_updates: handlers running at the same time.
+    # max_pending_updates: updates admitted at the same time, running or waiting for their chat
+    # (further updates stay in the application's update queue).
+    def __init__(self, max_concurrent_updates: int, max_pending_updates: int):
+        if max_pending_updates < max_concurrent_updates:
+            raise ValueError("max_pending_updates must not be lower than max_concurrent_updates")
+        super().__init__(max_pending_updates)
+        self._running_limit = max_concurrent_updates
+        self._running_semaphore = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._chat_locks: Dict[int, asyncio.Lock] = {}
+        self._chat_users: Dict[int, int] = {}  # Updates holding or waiting for each chat lock
+        self.pending = 0
+        self.running = 0
+        self.peak_pending = 0
+        self.processed = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        chat_id = self._chat_id(update)
+        admitted_at = time.monotonic()
+        started = False
+        self.pending += 1
+        self.peak_pending = max(self.peak_pending, self.pending)
+        if chat_id is not None:
+            self._chat_users[chat_id] = self._chat_users.get(chat_id, 0) + 1
+        chat_lock = self._chat_locks.setdefault(chat_id, asyncio.Lock()) if chat_id is not None else nullcontext()
+        try:
+            async with chat_lock:
+                async with self._running_semaphore:
+                    started = True
+                    wait_seconds = time.monotonic() - admitted_at
+                    self.pending -= 1
+                    self.running += 1
+                    self.total_wait_seconds += wait_seconds
+                    self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+                    try:
+                        await coroutine
+                    finally:
+                        self.running -= 1
+                        self.processed += 1
+        finally:
+            if not started:
+                self.pending -= 1
+            if chat_id is not None:
+                self._chat_users[chat_id] -= 1
+                if not self._chat_users[chat_id]:
+                    # Nobody else uses this chat's lock, drop it to keep memory bounded
+                    del self._chat_users[chat_id]
+                    del self._chat_locks[chat_id]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    # Queue depth and latency figures for monitoring
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            'pending': self.pending,
+            'running': self.running,
+            'peak_pending': self.peak_pending,
+            'processed': self.processed,
+            'active_chats': len(self._chat_locks),
+            'max_running': self._running_limit,
+            'max_pending': self.max_concurrent_updates,
+            'avg_wait_seconds': self.total_wait_seconds / self.processed if self.processed else 0.0,
+            'max_wait_seconds': self.max_wait_seconds,
+        }
+
+    @staticmethod
+    def _chat_id(update: object) -> Optional[int]:
+        if isinstance(update, Update) and update.effective_chat:
+            return update.effective_chat.id
+        return None
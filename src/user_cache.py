@@ -0,0 +1,80 @@
+# In-process cache of user profiles, keyed by Telegram username and by Firestore document ID.
+
+# Entries are evicted least-recently-used once the cache is full and expire after a TTL, so changes made
+# outside the bot (e.g. in the web app) are picked up eventually. Handlers that write a user document
+# invalidate its entry. Cached profiles are deep-copied in and out, so callers can mutate what they get.
+
+import copy
+import threading
+import time
+from typing import Callable, Optional, Dict, Any
+from cachetools import TTLCache
+
+
+class UserCache:
+    # timer can be replaced in tests
+    def __init__(self, maxsize: int, ttl: float, timer: Callable[[], float] = time.monotonic):
+        self._users_by_id = TTLCache(maxsize=maxsize, ttl=ttl, timer=timer)
+        self._ids_by_username = TTLCache(maxsize=maxsize, ttl=ttl, timer=timer)
+        # Helpers run in the Firestore thread pool as well as on the event loop
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Get a cached profile by Telegram username
+    def get_by_username(self, username: Optional[str]) -> Optional[Dict[str, Any]]:
+        if not username:
+            return None
+        with self._lock:
+            user_id = self._ids_by_username.get(username)
+            user_data = self._users_by_id.get(user_id) if user_id else None
+            return self._count(user_data)
+
+    # Get a cached profile by document ID
+    def get_by_id(self, user_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._count(self._users_by_id.get(user_id))
+
+    # Store a profile (must contain 'id')
+    def put(self, user_data: Dict[str, Any]) -> None:
+        user_id = user_data['id']
+        with self._lock:
+            self._users_by_id[user_id] = copy.deepcopy(user_data)
+            username = user_data.get('telegram')
+            if username:
+                self._ids_by_username[username] = user_id
+
+    # Drop a profile, e.g. after its document was written
+    def invalidate(self, user_id: Optional[str] = None, username: Optional[str] = None) -> None:
+        with self._lock:
+            if username and not user_id:
+                user_id = self._ids_by_username.get(username)
+            if username:
+                self._ids_by_username.pop(username, None)
+            if user_id:
+                user_data = self._users_by_id.pop(user_id, None)
+                if user_data and user_data.get('telegram'):
+                    self._ids_by_username.pop(user_data['telegram'], None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._users_by_id.clear()
+            self._ids_by_username.clear()
+
+    # Hit/miss counters and current size
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'size': len(self._users_by_id),
+            }
+
+    def _count(self, user_data: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        if user_data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return copy.deepcopy(user_data)
@@ -1,15 +1,19 @@
 # Contains utility functions that are shared across multiple handler files
 
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from typing import List, Optional
 from zoneinfo import ZoneInfo
 from telegram import (
     BotCommandScopeChat,
     BotCommand,
+    InlineKeyboardMarkup,
     Update,
 )
 from telegram.ext import (
     CallbackContext
 )
+from config import COMMAND_CACHE_SIZE
 from firebase_utils import (
     get_user_by_telegram_username, 
 )
@@ -29,11 +33,36 @@ def convert_to_utc(date_str: str, time_str: str, add_hours: int = 0) -> str:
     return utc_dt.isoformat()
 
 
+# Sets the command list of a chat, skipping the Telegram API call if the same list was pushed last time.
+# The last pushed list per chat is kept in bot_data['command_scopes'] (least recently used chats are evicted
+# beyond COMMAND_CACHE_SIZE entries), so it is restored together with bot_data by the persistence layer.
+async def set_chat_commands(context: CallbackContext, chat_id: int, commands: List[BotCommand]):
+    pushed_commands = context.bot_data.setdefault('command_scopes', OrderedDict())
+    signature = tuple((command.command, command.description) for command in commands)
+    if pushed_commands.get(chat_id) == signature:
+        pushed_commands.move_to_end(chat_id)
+        return
+    await context.bot.set_my_commands(commands, scope=BotCommandScopeChat(chat_id))
+    pushed_commands[chat_id] = signature
+    pushed_commands.move_to_end(chat_id)
+    while len(pushed_commands) > COMMAND_CACHE_SIZE:
+        pushed_commands.popitem(last=False)
+
+
+# Remembers the private chat of a Telegram username in bot_data['chat_ids'], so background jobs (see jobs.py)
+# can message users found in Firestore, which stores usernames only
+def remember_chat(context: CallbackContext, username: Optional[str], chat_id: int):
+    if username:
+        chat_ids = context.bot_data.setdefault('chat_ids', {})
+        if chat_ids.get(username) != chat_id:
+            chat_ids[username] = chat_id
+
+
 # Helper function to reset commands
 async def reset_user_commands(update: Update, context: CallbackContext):
     db = context.bot_data['db']
     user = update.message.from_user if update.message else update.callback_query.from_user
-    user_data = get_user_by_telegram_username(db, user.username)
+    user_data = await get_user_by_telegram_username(db, user.username)
     if user_data:
         is_admin = user_data.get('isadmin', False)
         commands = [
@@ -43,15 +72,18 @@ async def reset_user_commands(update: Update, context: CallbackContext):
         ]
         if is_admin:
             commands.append(BotCommand('schedule', 'Расписание преподавателя'))
-        await context.bot.set_my_commands(
-            commands,
-            scope=BotCommandScopeChat(update.effective_chat.id)
-        )
+        await set_chat_commands(context, update.effective_chat.id, commands)
+    else:
+        await set_chat_commands(context, update.effective_chat.id, [
+            BotCommand('newrequest', 'Оставить заявку на первое занятие'),
+            BotCommand('cancel', 'Отменить команду')
+        ])
+
+
+# Shows a screen: edits the message of the pressed button when the update is a callback query,
+# otherwise sends a new message.
+async def send_or_edit(update: Update, context: CallbackContext, chat_id: int, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None):
+    if update.callback_query and update.callback_query.message:
+        await update.callback_query.edit_message_text(text=text, reply_markup=reply_markup)
     else:
-        await context.bot.set_my_commands(
-            [
-                BotCommand('newrequest', 'Оставить заявку на первое занятие'),
-                BotCommand('cancel', 'Отменить команду')
-            ],
-            scope=BotCommandScopeChat(update.effective_chat.id)
-        )
+        await context.bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
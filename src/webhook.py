@@ -0,0 +1,96 @@
+# Runs the bot in webhook mode as an alternative to long polling.
+
+# An embedded Starlette app served by uvicorn receives updates from Telegram over HTTP and puts them on the
+# update queue of the same Application that polling mode uses, so all handlers work unchanged.
+# Routes: POST /telegram (updates from Telegram), GET /healthcheck (liveness, queue depth and throttling metrics)
+# and, if enabled, GET /metrics (see metrics.py).
+
+import logging
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+from telegram import Update
+from telegram.ext import Application
+from metrics import metrics_route
+
+WEBHOOK_PATH = '/telegram'
+HEALTHCHECK_PATH = '/healthcheck'
+
+logger = logging.getLogger(__name__)
+
+
+# Build the web app that feeds incoming updates into the application
+def create_webhook_app(application: Application, secret_token: str = '', serve_metrics: bool = False) -> Starlette:
+
+    # Receive an update from Telegram and queue it for processing
+    async def telegram(request: Request) -> Response:
+        if secret_token and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret_token:
+            return Response(status_code=403)
+        try:
+            update = Update.de_json(data=await request.json(), bot=application.bot)
+        except Exception as e:
+            logger.warning(f"Rejected malformed webhook payload: {e}")
+            return Response(status_code=400)
+        await application.update_queue.put(update)
+        return Response()
+
+    # Monitoring figures of a component, if it provides them
+    def component_metrics(component) -> dict:
+        metrics = getattr(component, 'metrics', None)
+        return metrics() if metrics else {}
+
+    # Report whether the application is running and how many updates are waiting
+    async def healthcheck(request: Request) -> JSONResponse:
+        return JSONResponse(
+            {
+                'status': 'ok' if application.running else 'starting',
+                'pending_updates': application.update_queue.qsize(),
+                'update_processor': component_metrics(application.update_processor),
+                'rate_limiter': component_metrics(application.bot.rate_limiter),
+            },
+            status_code=200 if application.running else 503,
+        )
+
+    routes = [
+        Route(WEBHOOK_PATH, telegram, methods=['POST']),
+        Route(HEALTHCHECK_PATH, healthcheck, methods=['GET']),
+    ]
+    if serve_metrics:
+        routes.append(metrics_route)
+    return Starlette(routes=routes)
+
+
+# Register the webhook with Telegram and serve updates until the server is stopped (e.g. by SIGINT/SIGTERM).
+# Mirrors the lifecycle of Application.run_polling, including the post_init/post_stop/post_shutdown hooks.
+async def run_webhook(application: Application, url: str, listen: str, port: int, secret_token: str = '',
+                      serve_metrics: bool = False) -> None:
+    webserver = uvicorn.Server(config=uvicorn.Config(
+        app=create_webhook_app(application, secret_token, serve_metrics),
+        host=listen,
+        port=port,
+        use_colors=False,
+        log_config=None,  # Keep the bot's logging configuration
+    ))
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    try:
+        await application.bot.set_webhook(
+            url=f"{url.rstrip('/')}{WEBHOOK_PATH}",
+            allowed_updates=Update.ALL_TYPES,
+            secret_token=secret_token or None,
+        )
+        await application.start()
+        try:
+            await webserver.serve()
+        finally:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+    finally:
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
@@ -0,0 +1,133 @@
+# Offline microbenchmarks for the date/time conversion and keyboard rendering hot paths of the handlers.
+
+# Each benchmark is timed with timeit (best of several repeats, in microseconds per call) on realistic
+# inputs: a dashboard of 10 classes, a schedule day of 12 classes, a cancellation list of 10 classes and
+# the NEWCLASS date and time pickers. THRESHOLDS_US holds the regression budget of each benchmark; they
+# are deliberately loose (several times the expected time), so they catch regressions in complexity
+# rather than machine noise. Set BENCHMARK_SLOWDOWN to scale them on slow machines.
+
+# Usage (from the repository root):
+#   python tests/benchmark.py            print the timings
+#   python tests/benchmark.py --check    also exit with status 1 if a threshold is exceeded
+#   python tests/benchmark.py --json     print the timings as JSON (to compare runs)
+
+import argparse
+import json
+import os
+import sys
+import timeit
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from class_record import ClassRecord  # noqa: E402
+from handlers_cancelclass import build_cancel_keyboard  # noqa: E402
+from handlers_newclass import build_date_keyboard, build_time_buttons  # noqa: E402
+from handlers_schedule import build_schedule_buttons  # noqa: E402
+from handlers_start import build_dashboard  # noqa: E402
+from slot_index import hour_bit  # noqa: E402
+from utils import convert_to_utc, ST_PETERSBURG  # noqa: E402
+
+# Regression budget of each benchmark, in microseconds per call
+THRESHOLDS_US = {
+    'convert_to_utc': 60.0,
+    'startdate_parse_format': 25.0,
+    'dashboard_10_classes': 500.0,
+    'schedule_buttons_12_classes': 600.0,
+    'cancel_keyboard_10_classes': 800.0,
+    'date_keyboard': 600.0,
+    'time_buttons': 500.0,
+}
+
+STATUSES = ['в ожидании', 'подтверждено', 'выполнено', 'отменено']
+
+
+# Class documents as stored in Firestore: UTC ISO strings, in both formats the bot and the web app write
+def make_class_documents(count: int, start: datetime) -> List[dict]:
+    classes = []
+    for i in range(count):
+        startdate = start + timedelta(days=i // 4, hours=i % 4)
+        iso = startdate.isoformat() if i % 2 else startdate.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        classes.append({
+            'id': f"class{i:03d}",
+            'userId': f"user{i % 5}",
+            'startdate': iso,
+            'enddate': (startdate + timedelta(hours=1)).isoformat(),
+            'status': STATUSES[i % len(STATUSES)],
+            'isMembershipUsed': bool(i % 2),
+            'message': '',
+        })
+    return classes
+
+
+# Classes as returned by firebase_utils
+def make_classes(count: int, start: datetime) -> List[ClassRecord]:
+    return [ClassRecord.from_dict(class_data) for class_data in make_class_documents(count, start)]
+
+
+def build_benchmarks() -> Dict[str, Callable[[], object]]:
+    start = datetime(2030, 3, 4, 7, 0, tzinfo=timezone.utc)
+    now = datetime(2030, 3, 4, 9, 30, tzinfo=ST_PETERSBURG)
+    user_data = {'id': 'user0', 'membership': 4, 'isadmin': True}
+    dashboard_classes = make_classes(10, start)
+    schedule_classes = make_classes(12, start)
+    student_names = {f"user{i}": f"Student {i}" for i in range(5)}
+    occupied_hours = hour_bit(10) | hour_bit(14) | hour_bit(15)
+    class_document = make_class_documents(1, start)[0]
+
+    return {
+        'convert_to_utc': lambda: convert_to_utc('2030-03-04', '14:00', add_hours=1),
+        'startdate_parse_format': lambda: ClassRecord.from_dict(class_document).start_text,
+        'dashboard_10_classes': lambda: build_dashboard("Добрый день!", user_data, dashboard_classes),
+        'schedule_buttons_12_classes': lambda: build_schedule_buttons(schedule_classes, student_names),
+        'cancel_keyboard_10_classes': lambda: build_cancel_keyboard(dashboard_classes),
+        'date_keyboard': lambda: build_date_keyboard(now),
+        'time_buttons': lambda: build_time_buttons(now.date() + timedelta(days=1), now, occupied_hours),
+    }
+
+
+# Time a callable: best of `repeat` runs, in microseconds per call
+def measure(func: Callable[[], object], repeat: int = 5, min_time: float = 0.05) -> float:
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e6
+
+
+# Run all benchmarks. Returns {name: (microseconds per call, threshold)}.
+def run_benchmarks(names: List[str] = None, repeat: int = 5) -> Dict[str, Tuple[float, float]]:
+    slowdown = float(os.getenv('BENCHMARK_SLOWDOWN', '1'))
+    results = {}
+    for name, func in build_benchmarks().items():
+        if names and name not in names:
+            continue
+        results[name] = (measure(func, repeat=repeat), THRESHOLDS_US[name] * slowdown)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks of date/time conversion and keyboard rendering.")
+    parser.add_argument('names', nargs='*', help="benchmarks to run (default: all)")
+    parser.add_argument('--repeat', type=int, default=5, help="timing repeats (the best one is reported)")
+    parser.add_argument('--check', action='store_true', help="exit with status 1 if a threshold is exceeded")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.names, repeat=args.repeat)
+    regressions = [name for name, (elapsed, threshold) in results.items() if elapsed > threshold]
+
+    if args.json:
+        print(json.dumps({name: {'us_per_call': elapsed, 'threshold_us': threshold} for name, (elapsed, threshold) in results.items()}, indent=2))
+    else:
+        print(f"{'benchmark':<30}{'us/call':>10}{'threshold':>11}")
+        for name, (elapsed, threshold) in results.items():
+            flag = '  REGRESSION' if name in regressions else ''
+            print(f"{name:<30}{elapsed:>10.2f}{threshold:>11.1f}{flag}")
+
+    if args.check and regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+# Makes the bot modules (src/) and the test fakes importable from the tests, and provides the shared fixtures:
+# db (the Firestore fake with two students, caches cleared), admin_db (the same with an admin), bot (runs a
+# scenario against a real Application with the bot's handler chain and the fake bot) and clock (fake time).
+# Tests marked 'benchmark' (wall-clock thresholds) are skipped unless selected with -m benchmark.
+
+import asyncio
+import os
+import sys
+from typing import Any, Awaitable, Callable, List, Optional
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..', 'src'))
+sys.path.insert(0, TESTS_DIR)
+
+from fake_bot import UpdateFactory  # noqa: E402
+from fake_firestore import FakeFirestore  # noqa: E402
+from firebase_utils import user_cache  # noqa: E402
+from load_test import build_application  # noqa: E402
+from schedule_cache import schedule_cache  # noqa: E402
+from slot_index import slot_index  # noqa: E402
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'benchmark: wall-clock regression thresholds, run with -m benchmark')
+
+
+def pytest_collection_modifyitems(config, items):
+    if 'benchmark' in (config.getoption('markexpr') or ''):
+        return
+    skip = pytest.mark.skip(reason='wall-clock benchmark, run with -m benchmark')
+    for item in items:
+        if 'benchmark' in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest.fixture
+def db() -> FakeFirestore:
+    user_cache.clear()
+    schedule_cache.clear()
+    slot_index.clear()
+    db = FakeFirestore()
+    db.seed('users', {
+        'u1': {'id': 'u1', 'name': 'Anna', 'telegram': 'anna', 'membership': 2, 'classes': []},
+        'u2': {'id': 'u2', 'name': 'Boris', 'telegram': 'boris', 'membership': 0, 'classes': []},
+    })
+    return db
+
+
+@pytest.fixture
+def admin_db(db: FakeFirestore) -> FakeFirestore:
+    db.seed('users', {'a1': {'id': 'a1', 'name': 'Admin', 'telegram': 'admin', 'isadmin': True, 'classes': []}})
+    return db
+
+
+# Runs scenarios against an Application built on the db fixture. The Application is built inside the event loop
+# of the run (its JobQueue needs one); the fake transport stays available as bot.request afterwards.
+class BotHarness:
+    def __init__(self, db: FakeFirestore):
+        self.db = db
+        self.application = None
+        self.factory: Optional[UpdateFactory] = None
+        self.request = None
+
+    # Run `scenario(harness)` between initialize and shutdown of a fresh Application, return its result
+    def run(self, scenario: Callable[['BotHarness'], Awaitable[Any]], **bot_data) -> Any:
+        async def main():
+            self.application = build_application(self.db)
+            self.application.bot_data.update(bot_data)
+            self.factory = UpdateFactory(self.application.bot)
+            self.request = self.application.bot.request
+            await self.application.initialize()
+            try:
+                return await scenario(self)
+            finally:
+                await self.application.shutdown()
+
+        return asyncio.run(main())
+
+    # Process a text message (or command) of a user in their private chat
+    async def send(self, user_id: int, username: str, text: str):
+        await self.application.process_update(self.factory.message(user_id, username, text))
+
+    # Process a tap on an inline button
+    async def press(self, user_id: int, username: str, data: str, message_id: int = 1):
+        await self.application.process_update(self.factory.callback(user_id, username, data, message_id))
+
+    # Wait until the background tasks started by the handlers (e.g. schedule prefetches) have finished. The
+    # Application is not started, so any other task of the loop is one of them.
+    async def settle(self):
+        while True:
+            tasks = asyncio.all_tasks() - {asyncio.current_task()}
+            if not tasks:
+                return
+            await asyncio.wait(tasks)
+
+    # Callback data of the last keyboard shown in a chat
+    def keyboard(self, chat_id: int) -> List[str]:
+        return list(self.request.keyboards[chat_id])
+
+
+@pytest.fixture
+def bot(db: FakeFirestore) -> BotHarness:
+    return BotHarness(db)
+
+
+# Fake monotonic clock: sleep() moves the time forward at once instead of waiting
+class FakeClock:
+    def __init__(self, now: float = 0.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+    async def sleep(self, seconds: float):
+        self.now += max(seconds, 0)
+        # Still let other tasks run, as a real sleep would
+        await asyncio.sleep(0)
+
+
+@pytest.fixture
+def clock() -> FakeClock:
+    return FakeClock()
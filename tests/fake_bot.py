@@ -0,0 +1,122 @@
+# Fake Telegram transport: a BaseRequest that answers Bot API calls locally, so a real ExtBot and Application
+# can run the handlers without network access. Every call is recorded, and an optional latency is injected.
+
+import asyncio
+import itertools
+import json
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Set, Tuple
+from telegram import Update
+from telegram.ext import ExtBot
+from telegram.request import BaseRequest, RequestData
+
+BOT_ID = 123456789
+BOT_USERNAME = 'sigma_test_bot'
+
+
+class FakeRequest(BaseRequest):
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: List[Tuple[str, Dict[str, Any]]] = []
+        self.counts: Dict[str, int] = defaultdict(int)
+        # Last inline keyboard shown in each chat (callback data of every button, row by row)
+        self.keyboards: Dict[int, List[str]] = {}
+        # Chats whose user blocked the bot: sending to them fails with 403 Forbidden
+        self.blocked_chats: Set[int] = set()
+        self._message_ids = itertools.count(1000)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None) -> Tuple[int, bytes]:
+        endpoint = url.rsplit('/', 1)[-1]
+        parameters = request_data.parameters if request_data else {}
+        self.calls.append((endpoint, parameters))
+        self.counts[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if endpoint == 'sendMessage' and int(parameters['chat_id']) in self.blocked_chats:
+            error = {'ok': False, 'error_code': 403, 'description': 'Forbidden: bot was blocked by the user'}
+            return 403, json.dumps(error).encode('utf-8')
+        result = self._result(endpoint, parameters)
+        return 200, json.dumps({'ok': True, 'result': result}).encode('utf-8')
+
+    def _result(self, endpoint: str, parameters: Dict[str, Any]) -> Any:
+        if endpoint == 'getMe':
+            return {'id': BOT_ID, 'is_bot': True, 'first_name': 'Sigma', 'username': BOT_USERNAME}
+        if endpoint in ('sendMessage', 'editMessageText', 'editMessageReplyMarkup'):
+            chat_id = int(parameters['chat_id'])
+            reply_markup = parameters.get('reply_markup')
+            if reply_markup or endpoint != 'sendMessage':
+                self.keyboards[chat_id] = keyboard_data(reply_markup)
+            return {
+                'message_id': int(parameters.get('message_id') or next(self._message_ids)),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': BOT_ID, 'is_bot': True, 'first_name': 'Sigma'},
+                'text': parameters.get('text', ''),
+            }
+        # answerCallbackQuery, setMyCommands, setWebhook, ...
+        return True
+
+
+# Callback data of all buttons of a serialized reply markup
+def keyboard_data(reply_markup: Any) -> List[str]:
+    if not reply_markup:
+        return []
+    if isinstance(reply_markup, str):
+        reply_markup = json.loads(reply_markup)
+    return [
+        button['callback_data']
+        for row in reply_markup.get('inline_keyboard', [])
+        for button in row
+        if 'callback_data' in button
+    ]
+
+
+def make_bot(latency: float = 0.0) -> ExtBot:
+    return ExtBot(token=f"{BOT_ID}:TEST", request=FakeRequest(latency), get_updates_request=FakeRequest())
+
+
+# Builds incoming updates of private chats (chat ID == user ID) for a bot
+class UpdateFactory:
+    def __init__(self, bot: ExtBot):
+        self.bot = bot
+        self._update_ids = itertools.count(1)
+        self._ids = itertools.count(1)
+
+    def _user(self, user_id: int, username: str) -> Dict[str, Any]:
+        return {'id': user_id, 'is_bot': False, 'first_name': username, 'username': username}
+
+    def message(self, user_id: int, username: str, text: str) -> Update:
+        message = {
+            'message_id': next(self._ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user(user_id, username),
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return Update.de_json({'update_id': next(self._update_ids), 'message': message}, self.bot)
+
+    def callback(self, user_id: int, username: str, data: str, message_id: int = 1) -> Update:
+        callback_query = {
+            'id': str(next(self._ids)),
+            'chat_instance': str(user_id),
+            'from': self._user(user_id, username),
+            'data': data,
+            'message': {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': {'id': BOT_ID, 'is_bot': True, 'first_name': 'Sigma'},
+                'text': '',
+            },
+        }
+        return Update.de_json({'update_id': next(self._update_ids), 'callback_query': callback_query}, self.bot)
@@ -0,0 +1,481 @@
+# In-memory stand-in for the firestore.client surface used by firebase_utils and the handlers.
+
+# Supported: collection/document references, get/set/update/delete, where/order_by/limit/stream queries,
+# get_all, write batches and transactions (usable with @firestore.transactional: optimistic, a commit
+# raises Aborted if a document read in the transaction changed, and the transaction is retried).
+# Field transforms: Increment, ArrayUnion, ArrayRemove, DELETE_FIELD and SERVER_TIMESTAMP.
+# on_snapshot listeners on queries and collections: the callback receives the initial result set as ADDED
+# changes and then the changes of every commit, synchronously in the committing thread.
+# Every round trip goes through _rpc(), which counts it and sleeps for the injected latency, so the fake
+# can be used to measure how many RPCs a handler makes and how long it takes on a slow link.
+
+import copy
+import itertools
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from google.api_core import exceptions
+from google.cloud.firestore_v1 import transforms
+from google.cloud.firestore_v1.watch import ChangeType, DocumentChange
+
+# Comparison operators supported in where()
+_OPERATORS = {
+    '==': lambda value, other: value == other,
+    '!=': lambda value, other: value != other,
+    '<': lambda value, other: value < other,
+    '<=': lambda value, other: value <= other,
+    '>': lambda value, other: value > other,
+    '>=': lambda value, other: value >= other,
+    'in': lambda value, other: value in other,
+    'not-in': lambda value, other: value not in other,
+    'array_contains': lambda value, other: isinstance(value, list) and other in value,
+    'array_contains_any': lambda value, other: isinstance(value, list) and any(item in value for item in other),
+}
+
+_MISSING = object()
+
+
+# Read a (dotted) field path from a document
+def _get_field(data: Dict[str, Any], field_path: str) -> Any:
+    value = data
+    for part in field_path.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+
+# Write a (dotted) field path into a document, applying field transforms to the current value
+def _set_field(data: Dict[str, Any], field_path: str, value: Any):
+    parts = field_path.split('.')
+    target = data
+    for part in parts[:-1]:
+        target = target.setdefault(part, {})
+    key = parts[-1]
+    current = target.get(key)
+
+    if value is transforms.DELETE_FIELD:
+        target.pop(key, None)
+    elif value is transforms.SERVER_TIMESTAMP:
+        target[key] = datetime.now(timezone.utc)
+    elif isinstance(value, transforms.Increment):
+        target[key] = (current if isinstance(current, (int, float)) else 0) + value.value
+    elif isinstance(value, transforms.ArrayUnion):
+        items = list(current) if isinstance(current, list) else []
+        items.extend(item for item in value.values if item not in items)
+        target[key] = items
+    elif isinstance(value, transforms.ArrayRemove):
+        target[key] = [item for item in current if item not in value.values] if isinstance(current, list) else []
+    else:
+        target[key] = copy.deepcopy(value)
+
+
+# Build a new document from set() data, applying transforms and dotted keys
+def _apply(data: Dict[str, Any], changes: Dict[str, Any], merge: bool) -> Dict[str, Any]:
+    result = copy.deepcopy(data) if merge else {}
+    for field_path, value in changes.items():
+        if merge or '.' not in field_path:
+            _set_field(result, field_path, value)
+        else:
+            result.setdefault(field_path, copy.deepcopy(value))
+    return result
+
+
+class FakeDocumentSnapshot:
+    def __init__(self, reference: 'FakeDocumentReference', data: Optional[Dict[str, Any]]):
+        self.reference = reference
+        self._data = data
+
+    @property
+    def id(self) -> str:
+        return self.reference.id
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path: str) -> Any:
+        value = _get_field(self._data or {}, field_path)
+        if value is _MISSING:
+            raise KeyError(field_path)
+        return copy.deepcopy(value)
+
+
+class FakeDocumentReference:
+    def __init__(self, client: 'FakeFirestore', collection: str, document_id: str):
+        self._client = client
+        self._collection = collection
+        self.id = document_id
+
+    @property
+    def path(self) -> str:
+        return f"{self._collection}/{self.id}"
+
+    @property
+    def _key(self) -> Tuple[str, str]:
+        return self._collection, self.id
+
+    def get(self, field_paths=None, transaction: Optional['FakeTransaction'] = None) -> FakeDocumentSnapshot:
+        self._client._rpc()
+        return self._client._snapshot(self, transaction)
+
+    def set(self, document_data: Dict[str, Any], merge: bool = False):
+        self._client._rpc()
+        self._client._commit_writes([('set', self, document_data, merge)])
+
+    def update(self, field_updates: Dict[str, Any]):
+        self._client._rpc()
+        self._client._commit_writes([('update', self, field_updates, True)])
+
+    def delete(self):
+        self._client._rpc()
+        self._client._commit_writes([('delete', self, None, False)])
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, FakeDocumentReference) and self._key == other._key
+
+    def __hash__(self) -> int:
+        return hash(self._key)
+
+
+class FakeQuery:
+    def __init__(self, client: 'FakeFirestore', collection: str, filters=(), orders=(), limit: Optional[int] = None):
+        self._client = client
+        self._collection = collection
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+
+    def where(self, field_path: str = None, op_string: str = None, value: Any = None, *, filter=None) -> 'FakeQuery':
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        if op_string not in _OPERATORS:
+            raise ValueError(f"Unsupported operator: {op_string}")
+        return FakeQuery(self._client, self._collection, self._filters + ((field_path, op_string, value),), self._orders, self._limit)
+
+    def order_by(self, field_path: str, direction: str = 'ASCENDING') -> 'FakeQuery':
+        return FakeQuery(self._client, self._collection, self._filters, self._orders + ((field_path, direction),), self._limit)
+
+    def limit(self, count: int) -> 'FakeQuery':
+        return FakeQuery(self._client, self._collection, self._filters, self._orders, count)
+
+    def _matches(self, data: Dict[str, Any]) -> bool:
+        for field_path, op_string, value in self._filters:
+            field_value = _get_field(data, field_path)
+            if field_value is _MISSING:
+                return False
+            try:
+                if not _OPERATORS[op_string](field_value, value):
+                    return False
+            except TypeError:
+                # Values of different types never match a range filter
+                return False
+        return True
+
+    def stream(self, transaction: Optional['FakeTransaction'] = None) -> Iterator[FakeDocumentSnapshot]:
+        self._client._rpc()
+        return iter(self._client._run_query(self, transaction))
+
+    def get(self, transaction: Optional['FakeTransaction'] = None) -> List[FakeDocumentSnapshot]:
+        return list(self.stream(transaction=transaction))
+
+    def on_snapshot(self, callback) -> 'FakeWatch':
+        return self._client._watch(self, callback)
+
+
+class FakeWatch:
+    def __init__(self, client: 'FakeFirestore', query: FakeQuery, callback):
+        self._client = client
+        self.query = query
+        self.callback = callback
+        # document ID -> version of the documents in the last delivered result set
+        self.versions: Dict[str, int] = {}
+        self.delivered = False
+        self.active = True
+
+    def unsubscribe(self):
+        self.active = False
+        with self._client._lock:
+            if self in self._client._watches:
+                self._client._watches.remove(self)
+
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, client: 'FakeFirestore', collection: str):
+        super().__init__(client, collection)
+        self.id = collection
+
+    def document(self, document_id: Optional[str] = None) -> FakeDocumentReference:
+        return FakeDocumentReference(self._client, self._collection, document_id or uuid.uuid4().hex[:20])
+
+    def add(self, document_data: Dict[str, Any]) -> Tuple[datetime, FakeDocumentReference]:
+        doc_ref = self.document()
+        doc_ref.set(document_data)
+        return datetime.now(timezone.utc), doc_ref
+
+    def list_documents(self) -> List[FakeDocumentReference]:
+        self._client._rpc()
+        with self._client._lock:
+            return [self.document(document_id) for document_id in self._client._collection_docs(self._collection)]
+
+
+class FakeWriteBatch:
+    def __init__(self, client: 'FakeFirestore'):
+        self._client = client
+        self._writes = []
+
+    def set(self, reference: FakeDocumentReference, document_data: Dict[str, Any], merge: bool = False):
+        self._writes.append(('set', reference, copy.deepcopy(document_data), merge))
+
+    def update(self, reference: FakeDocumentReference, field_updates: Dict[str, Any]):
+        self._writes.append(('update', reference, copy.deepcopy(field_updates), True))
+
+    def delete(self, reference: FakeDocumentReference):
+        self._writes.append(('delete', reference, None, False))
+
+    def __len__(self) -> int:
+        return len(self._writes)
+
+    def commit(self) -> list:
+        self._client._rpc()
+        writes, self._writes = self._writes, []
+        self._client._commit_writes(writes)
+        return writes
+
+
+# A transaction compatible with firestore.transactional: it implements the private hooks that
+# _Transactional calls (_clean_up, _begin, _commit, _rollback) on top of optimistic version checks.
+class FakeTransaction(FakeWriteBatch):
+    def __init__(self, client: 'FakeFirestore', max_attempts: int = 5, read_only: bool = False):
+        super().__init__(client)
+        self._max_attempts = max_attempts
+        self._read_only = read_only
+        self._id = None
+        self._read_versions: Dict[Tuple[str, str], int] = {}
+
+    @property
+    def in_progress(self) -> bool:
+        return self._id is not None
+
+    @property
+    def id(self):
+        return self._id
+
+    def _clean_up(self):
+        self._writes = []
+        self._read_versions = {}
+        self._id = None
+
+    def _begin(self, retry_id=None):
+        if self.in_progress:
+            raise ValueError("Transaction already in progress")
+        self._client._rpc()
+        self._id = uuid.uuid4().bytes
+
+    def _record_read(self, key: Tuple[str, str], version: int):
+        # The first read of a document pins the version the commit is checked against
+        self._read_versions.setdefault(key, version)
+
+    def _rollback(self):
+        if self.in_progress:
+            self._client._rpc()
+        self._clean_up()
+
+    def _commit(self) -> list:
+        if not self.in_progress:
+            raise ValueError("Transaction not in progress")
+        if self._read_only and self._writes:
+            raise ValueError("Cannot perform write operation in read-only transaction.")
+        self._client._rpc()
+        writes = self._writes
+        try:
+            self._client._commit_writes(writes, self._read_versions)
+        finally:
+            self._clean_up()
+        return writes
+
+    def commit(self) -> list:
+        return self._commit()
+
+    def get(self, ref_or_query, transaction=None):
+        if isinstance(ref_or_query, FakeDocumentReference):
+            return iter([ref_or_query.get(transaction=self)])
+        return ref_or_query.stream(transaction=self)
+
+    def get_all(self, references: List[FakeDocumentReference]) -> Iterator[FakeDocumentSnapshot]:
+        return self._client.get_all(references, transaction=self)
+
+
+# In-memory Firestore client. latency/jitter are in seconds and applied to every round trip (uniform jitter).
+class FakeFirestore:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, seed: Optional[int] = None):
+        self.latency = latency
+        self.jitter = jitter
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+        self._documents: Dict[Tuple[str, str], Tuple[int, Dict[str, Any]]] = {}
+        self._versions = itertools.count(1)
+        self._watches: List[FakeWatch] = []
+        self.rpc_count = 0
+        self.aborted_commits = 0
+
+    # Count a round trip and wait for the injected latency
+    def _rpc(self):
+        with self._lock:
+            self.rpc_count += 1
+            delay = self.latency + (self._random.uniform(-self.jitter, self.jitter) if self.jitter else 0.0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def collection(self, collection_id: str) -> FakeCollectionReference:
+        return FakeCollectionReference(self, collection_id)
+
+    def document(self, document_path: str) -> FakeDocumentReference:
+        collection, document_id = document_path.split('/', 1)
+        return FakeDocumentReference(self, collection, document_id)
+
+    def batch(self) -> FakeWriteBatch:
+        return FakeWriteBatch(self)
+
+    def transaction(self, max_attempts: int = 5, read_only: bool = False) -> FakeTransaction:
+        return FakeTransaction(self, max_attempts=max_attempts, read_only=read_only)
+
+    def get_all(self, references, field_paths=None, transaction: Optional[FakeTransaction] = None) -> Iterator[FakeDocumentSnapshot]:
+        self._rpc()
+        unique_refs = list(dict.fromkeys(references))
+        return iter([self._snapshot(reference, transaction) for reference in unique_refs])
+
+    def _snapshot(self, reference: FakeDocumentReference, transaction: Optional[FakeTransaction]) -> FakeDocumentSnapshot:
+        with self._lock:
+            version, data = self._documents.get(reference._key, (0, None))
+            if transaction is not None:
+                transaction._record_read(reference._key, version)
+            return FakeDocumentSnapshot(reference, copy.deepcopy(data))
+
+    def _watch(self, query: FakeQuery, callback) -> FakeWatch:
+        watch = FakeWatch(self, query, callback)
+        with self._lock:
+            self._watches.append(watch)
+        self._notify([watch])
+        return watch
+
+    # Deliver the changes of each watch's result set since its last callback
+    def _notify(self, watches: List[FakeWatch]):
+        for watch in watches:
+            with self._lock:
+                if not watch.active:
+                    continue
+                matches = {
+                    document_id: (version, data)
+                    for (collection, document_id), (version, data) in self._documents.items()
+                    if collection == watch.query._collection and watch.query._matches(data)
+                }
+                changes = []
+                for document_id, (version, data) in matches.items():
+                    if watch.versions.get(document_id) != version:
+                        change_type = ChangeType.MODIFIED if document_id in watch.versions else ChangeType.ADDED
+                        changes.append((change_type, document_id, data))
+                for document_id in watch.versions:
+                    if document_id not in matches:
+                        changes.append((ChangeType.REMOVED, document_id, None))
+                if not changes and watch.delivered:
+                    continue
+                watch.delivered = True
+                watch.versions = {document_id: version for document_id, (version, data) in matches.items()}
+                docs = [
+                    FakeDocumentSnapshot(FakeDocumentReference(self, watch.query._collection, document_id), copy.deepcopy(data))
+                    for document_id, (version, data) in sorted(matches.items())
+                ]
+                document_changes = [
+                    DocumentChange(
+                        change_type,
+                        FakeDocumentSnapshot(FakeDocumentReference(self, watch.query._collection, document_id), copy.deepcopy(data)),
+                        -1, -1,
+                    )
+                    for change_type, document_id, data in changes
+                ]
+            watch.callback(docs, document_changes, datetime.now(timezone.utc))
+
+    def _collection_docs(self, collection: str) -> List[str]:
+        return [document_id for (name, document_id) in self._documents if name == collection]
+
+    def _run_query(self, query: FakeQuery, transaction: Optional[FakeTransaction]) -> List[FakeDocumentSnapshot]:
+        with self._lock:
+            matches = []
+            for (collection, document_id), (version, data) in self._documents.items():
+                if collection == query._collection and query._matches(data):
+                    matches.append((document_id, version, data))
+
+            # Sort by the requested fields, then by document ID like Firestore
+            matches.sort(key=lambda match: match[0])
+            for field_path, direction in reversed(query._orders):
+                matches.sort(
+                    key=lambda match: (_get_field(match[2], field_path) is _MISSING, _get_field(match[2], field_path)),
+                    reverse=str(direction).upper().startswith('DESC'),
+                )
+            if query._limit is not None:
+                matches = matches[:query._limit]
+
+            snapshots = []
+            for document_id, version, data in matches:
+                reference = FakeDocumentReference(self, query._collection, document_id)
+                if transaction is not None:
+                    transaction._record_read(reference._key, version)
+                snapshots.append(FakeDocumentSnapshot(reference, copy.deepcopy(data)))
+            return snapshots
+
+    # Apply writes atomically. With read_versions (a transaction), abort if any read document changed since.
+    def _commit_writes(self, writes, read_versions: Optional[Dict[Tuple[str, str], int]] = None):
+        with self._lock:
+            if read_versions:
+                for key, version in read_versions.items():
+                    if self._documents.get(key, (0, None))[0] != version:
+                        self.aborted_commits += 1
+                        raise exceptions.Aborted(f"Transaction aborted: {key[0]}/{key[1]} was modified.")
+
+            # Validate first so a failing write leaves nothing applied
+            staged = dict()
+            for operation, reference, changes, merge in writes:
+                key = reference._key
+                current = staged[key] if key in staged else self._documents.get(key, (0, None))[1]
+                if operation == 'delete':
+                    staged[key] = None
+                elif operation == 'update':
+                    if current is None:
+                        raise exceptions.NotFound(f"No document to update: {reference.path}")
+                    staged[key] = _apply(current, changes, merge=True)
+                else:
+                    staged[key] = _apply(current or {}, changes, merge=merge)
+
+            for key, data in staged.items():
+                if data is None:
+                    self._documents.pop(key, None)
+                else:
+                    self._documents[key] = (next(self._versions), data)
+            watches = list(self._watches)
+        # Listeners are called outside the lock, like the background threads of real listeners
+        self._notify(watches)
+
+    # Insert documents directly (no RPC), e.g. to seed a test. Returns the document IDs.
+    def seed(self, collection: str, documents: Dict[str, Dict[str, Any]]) -> List[str]:
+        with self._lock:
+            for document_id, data in documents.items():
+                self._documents[(collection, document_id)] = (next(self._versions), copy.deepcopy(data))
+            watches = list(self._watches)
+        self._notify(watches)
+        return list(documents)
+
+    # Read a whole collection directly (no RPC), keyed by document ID
+    def dump(self, collection: str) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {
+                document_id: copy.deepcopy(data)
+                for (name, document_id), (version, data) in self._documents.items()
+                if name == collection
+            }
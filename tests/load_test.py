@@ -0,0 +1,277 @@
+# Load generator: replays synthetic students through NEWCLASS and CANCELCLASS and admins through SCHEDULE
+# against the in-memory Firestore fake and the fake bot, and reports throughput and latency percentiles
+# per handler. The handlers run through a real Application with the same handler chain as the bot.
+
+# Usage (from the repository root):
+#   python tests/load_test.py --students 50 --admins 2 --rounds 3 --db-latency 0.02 --bot-latency 0.01
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from telegram.ext import ApplicationBuilder, ContextTypes  # noqa: E402
+from callback_data import Action, decode, encode  # noqa: E402
+from fake_bot import UpdateFactory, make_bot  # noqa: E402
+from fake_firestore import FakeFirestore  # noqa: E402
+from firebase_utils import shutdown_executor, user_cache  # noqa: E402
+from handlers import register_handlers  # noqa: E402
+from persistence import BotData  # noqa: E402
+from schedule_cache import schedule_cache  # noqa: E402
+from slot_index import slot_index  # noqa: E402
+
+STUDENT_ID_BASE = 100000
+ADMIN_ID_BASE = 900000
+
+
+# Nearest-rank percentile of a sorted list
+def percentile(sorted_values: List[float], percent: float) -> float:
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(percent / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+# Collects the duration of every processed update per handler (flow) and per step of the flow
+class LoadReport:
+    def __init__(self):
+        self.durations: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.elapsed = 0.0
+        self.db_rpcs = 0
+        self.aborted_commits = 0
+        self.bot_calls: Dict[str, int] = {}
+
+    def record(self, handler: str, step: str, duration: float):
+        self.durations[handler].append(duration)
+        self.durations[f"{handler}:{step}"].append(duration)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        rows = {}
+        for name, values in sorted(self.durations.items()):
+            ordered = sorted(values)
+            rows[name] = {
+                'count': len(ordered),
+                'throughput': len(ordered) / self.elapsed if self.elapsed else 0.0,
+                'p50': percentile(ordered, 50),
+                'p95': percentile(ordered, 95),
+                'p99': percentile(ordered, 99),
+                'max': ordered[-1],
+                'errors': self.errors.get(name, 0),
+            }
+        return rows
+
+    def format(self) -> str:
+        lines = [f"{'handler':<28}{'count':>7}{'upd/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}{'errors':>8}"]
+        for name, row in self.summary().items():
+            lines.append(
+                f"{name:<28}{row['count']:>7}{row['throughput']:>9.1f}{row['p50'] * 1000:>9.1f}"
+                f"{row['p95'] * 1000:>9.1f}{row['p99'] * 1000:>9.1f}{row['max'] * 1000:>9.1f}{row['errors']:>8}"
+            )
+        total = sum(len(values) for name, values in self.durations.items() if ':' not in name)
+        lines.append(
+            f"\n{total} updates in {self.elapsed:.2f}s ({total / self.elapsed if self.elapsed else 0:.1f} upd/s), "
+            f"{self.db_rpcs} Firestore RPCs, {self.aborted_commits} aborted transactions, "
+            f"{sum(self.bot_calls.values())} Bot API calls"
+        )
+        return '\n'.join(lines)
+
+
+# One synthetic user in a private chat, driving the conversations by pressing buttons
+class SyntheticUser:
+    def __init__(self, application, factory: UpdateFactory, report: LoadReport, user_id: int, username: str, rng: random.Random):
+        self.application = application
+        self.factory = factory
+        self.report = report
+        self.user_id = user_id
+        self.username = username
+        self.rng = rng
+
+    # Buttons of the last keyboard shown to this user (those of one action if given)
+    def buttons(self, action: str = '') -> List[str]:
+        keyboard = self.application.bot.request.keyboards.get(self.user_id, [])
+        return [data for data in keyboard if not action or decode(data).action == action]
+
+    def choose(self, action: str) -> Optional[str]:
+        buttons = self.buttons(action)
+        return self.rng.choice(buttons) if buttons else None
+
+    async def press(self, handler: str, step: str, data: str):
+        update = self.factory.callback(self.user_id, self.username, data)
+        await self.process(handler, step, update)
+
+    async def process(self, handler: str, step: str, update):
+        errors = self.application.bot_data['load_errors']
+        errors_before = errors[self.user_id]
+        started = time.perf_counter()
+        await self.application.process_update(update)
+        self.report.record(handler, step, time.perf_counter() - started)
+        if errors[self.user_id] != errors_before:
+            self.report.errors[handler] += 1
+            self.report.errors[f"{handler}:{step}"] += 1
+
+    async def book_class(self):
+        await self.press('NEWCLASS', 'start', encode(Action.NEWCLASS))
+        for attempt in range(3):
+            date = self.choose(Action.DATE)
+            if not date:
+                break
+            await self.press('NEWCLASS', 'select_date', date)
+            time_slot = self.choose(Action.TIME)
+            if time_slot:
+                await self.press('NEWCLASS', 'select_time', time_slot)
+                await self.press('NEWCLASS', 'book', encode(Action.SKIP))
+                return
+        # No free slot found: leave the conversation
+        await self.press('NEWCLASS', 'cancel', encode(Action.CANCEL))
+
+    async def cancel_class(self):
+        await self.press('CANCELCLASS', 'start', encode(Action.CANCELCLASS))
+        class_button = self.choose(Action.PICK_CLASS_TO_CANCEL)
+        if not class_button:
+            return
+        await self.press('CANCELCLASS', 'select_class', class_button)
+        await self.press('CANCELCLASS', 'confirm', encode(Action.CONFIRM_CANCEL))
+
+    async def browse_schedule(self, days: int):
+        await self.press('SCHEDULE', 'start', encode(Action.SCHEDULE))
+        for day in range(days):
+            await self.press('SCHEDULE', 'navigate', encode(Action.NEXT_DAY))
+            class_button = self.choose(Action.CLASS)
+            if class_button:
+                await self.press('SCHEDULE', 'select_class', class_button)
+                await self.press('SCHEDULE', 'edit_status', encode(Action.EDIT_STATUS))
+                await self.press('SCHEDULE', 'update_status', encode(Action.STATUS, self.rng.choice(['подтверждено', 'в ожидании'])))
+        await self.press('SCHEDULE', 'cancel', encode(Action.CANCEL))
+
+
+async def run_student(user: SyntheticUser, rounds: int, cancel_ratio: float, semaphore: asyncio.Semaphore):
+    for round_number in range(rounds):
+        async with semaphore:
+            await user.book_class()
+            if user.rng.random() < cancel_ratio:
+                await user.cancel_class()
+
+
+async def run_admin(user: SyntheticUser, rounds: int, days: int, semaphore: asyncio.Semaphore):
+    for round_number in range(rounds):
+        async with semaphore:
+            await user.browse_schedule(days)
+
+
+# Build an application with the bot's handlers on the fake bot and the given Firestore fake.
+# Handler errors are counted per user in bot_data['load_errors'].
+def build_application(db: FakeFirestore, bot_latency: float = 0.0):
+    application = (
+        ApplicationBuilder()
+        .bot(make_bot(bot_latency))
+        .updater(None)
+        .context_types(ContextTypes(bot_data=BotData))
+        .build()
+    )
+    register_handlers(application)
+    application.bot_data['db'] = db
+    application.bot_data['load_errors'] = defaultdict(int)
+
+    async def count_error(update, context):
+        logging.debug("Handler error during load test", exc_info=context.error)
+        if update is not None and update.effective_user:
+            context.bot_data['load_errors'][update.effective_user.id] += 1
+
+    application.add_error_handler(count_error)
+    return application
+
+
+# Runs the load and returns the report. latency values are in seconds.
+async def run_load(students: int = 20, admins: int = 1, rounds: int = 2, concurrency: int = 50, cancel_ratio: float = 0.5,
+                   schedule_days: int = 5, db_latency: float = 0.0, db_jitter: float = 0.0, bot_latency: float = 0.0,
+                   seed: int = 0) -> LoadReport:
+    rng = random.Random(seed)
+    db = FakeFirestore(latency=db_latency, jitter=db_jitter, seed=seed)
+    db.seed('users', {
+        f"student-{i}": {
+            'id': f"student-{i}", 'name': f"Student {i}", 'telegram': f"student_{i}",
+            'membership': rng.randint(0, 8), 'classes': [], 'isadmin': False,
+        }
+        for i in range(students)
+    })
+    db.seed('users', {
+        f"admin-{i}": {
+            'id': f"admin-{i}", 'name': f"Admin {i}", 'telegram': f"admin_{i}",
+            'membership': 0, 'classes': [], 'isadmin': True,
+        }
+        for i in range(admins)
+    })
+
+    # Start from empty process-wide caches so runs are independent
+    user_cache.clear()
+    slot_index.clear()
+    schedule_cache.clear()
+
+    application = build_application(db, bot_latency)
+    report = LoadReport()
+    factory = UpdateFactory(application.bot)
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = []
+    for i in range(students):
+        user = SyntheticUser(application, factory, report, STUDENT_ID_BASE + i, f"student_{i}", random.Random(rng.random()))
+        tasks.append(run_student(user, rounds, cancel_ratio, semaphore))
+    for i in range(admins):
+        user = SyntheticUser(application, factory, report, ADMIN_ID_BASE + i, f"admin_{i}", random.Random(rng.random()))
+        tasks.append(run_admin(user, rounds, schedule_days, semaphore))
+
+    await application.initialize()
+    rpcs_before = db.rpc_count
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        report.elapsed = time.perf_counter() - started
+        report.db_rpcs = db.rpc_count - rpcs_before
+        report.aborted_commits = db.aborted_commits
+        report.bot_calls = dict(application.bot.request.counts)
+        await application.shutdown()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay synthetic users through the bot's handlers against in-memory fakes.")
+    parser.add_argument('--students', type=int, default=50, help="number of synthetic students")
+    parser.add_argument('--admins', type=int, default=2, help="number of synthetic admins browsing the schedule")
+    parser.add_argument('--rounds', type=int, default=3, help="booking (and cancellation) rounds per user")
+    parser.add_argument('--concurrency', type=int, default=50, help="users active at the same time")
+    parser.add_argument('--cancel-ratio', type=float, default=0.5, help="share of bookings cancelled right after")
+    parser.add_argument('--schedule-days', type=int, default=5, help="days an admin pages through per round")
+    parser.add_argument('--db-latency', type=float, default=0.02, help="seconds added to every Firestore round trip")
+    parser.add_argument('--db-jitter', type=float, default=0.005, help="uniform jitter of the Firestore latency")
+    parser.add_argument('--bot-latency', type=float, default=0.01, help="seconds added to every Bot API call")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    report = asyncio.run(run_load(
+        students=args.students,
+        admins=args.admins,
+        rounds=args.rounds,
+        concurrency=args.concurrency,
+        cancel_ratio=args.cancel_ratio,
+        schedule_days=args.schedule_days,
+        db_latency=args.db_latency,
+        db_jitter=args.db_jitter,
+        bot_latency=args.bot_latency,
+        seed=args.seed,
+    ))
+    shutdown_executor()
+    print(report.format())
+
+
+if __name__ == '__main__':
+    main()
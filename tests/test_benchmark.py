@@ -0,0 +1,13 @@
+# Fails if a rendering or date/time conversion hot path exceeds its regression budget (see benchmark.py).
+# Marked 'benchmark': wall-clock timings depend on the machine's load, so these only run with -m benchmark.
+
+import pytest
+from benchmark import THRESHOLDS_US, run_benchmarks
+
+pytestmark = pytest.mark.benchmark
+
+
+@pytest.mark.parametrize('name', sorted(THRESHOLDS_US))
+def test_benchmark_within_threshold(name):
+    elapsed, threshold = run_benchmarks([name], repeat=3)[name]
+    assert elapsed <= threshold, f"{name}: {elapsed:.1f} us per call, threshold {threshold:.1f} us"
@@ -0,0 +1,850 @@
+# Tests run against the in-memory Firestore fake and the fake bot (see fake_firestore.py and fake_bot.py);
+# the db, admin_db and bot fixtures are defined in conftest.py.
+
+import asyncio
+import pytest
+from firebase_admin import firestore
+from callback_data import Action, decode, encode
+from firebase_utils import book_class, cancel_class, SlotTakenError
+from load_test import run_load
+
+
+def class_data(startdate='2030-01-07T09:00:00+00:00'):
+    return {'status': 'в ожидании', 'startdate': startdate, 'enddate': startdate.replace('T09', 'T10'), 'message': ''}
+
+
+def seed_classes(db, startdates):
+    db.seed('classes', {
+        f"c{i}": {'userId': 'u1', 'status': 'в ожидании', 'startdate': startdate, 'enddate': startdate, 'message': ''}
+        for i, startdate in enumerate(startdates)
+    })
+
+
+def test_book_class_takes_membership_point_and_claims_slot(db):
+    booked = asyncio.run(book_class(db, 'u1', class_data()))
+
+    assert booked['isMembershipUsed'] is True
+    user = db.dump('users')['u1']
+    assert user['membership'] == 1
+    assert user['classes'] == [booked['id']]
+    assert db.dump('slots')['2030-01-07T09:00']['classId'] == booked['id']
+
+
+def test_book_class_rejects_taken_slot(db):
+    asyncio.run(book_class(db, 'u1', class_data()))
+
+    with pytest.raises(SlotTakenError):
+        asyncio.run(book_class(db, 'u2', class_data()))
+    assert db.dump('users')['u2']['classes'] == []
+
+
+def test_concurrent_bookings_of_one_slot_let_exactly_one_win(db):
+    from firebase_utils import get_user_by_telegram_username, user_cache
+
+    # Every RPC takes a while, so both transactions read the free slot before either commits
+    db.latency = 0.01
+
+    async def run():
+        for username in ('anna', 'boris'):
+            await get_user_by_telegram_username(db, username)
+        return await asyncio.gather(
+            book_class(db, 'u1', class_data()), book_class(db, 'u2', class_data()), return_exceptions=True,
+        )
+
+    results = asyncio.run(run())
+
+    booked = [result for result in results if isinstance(result, dict)]
+    rejected = [result for result in results if isinstance(result, SlotTakenError)]
+    assert len(booked) == 1 and len(rejected) == 1
+    assert db.aborted_commits >= 1  # the losing transaction conflicted and was retried
+    assert list(db.dump('classes')) == [booked[0]['id']]
+    assert db.dump('slots')['2030-01-07T09:00']['classId'] == booked[0]['id']
+    winner, loser = ('u1', 'u2') if booked[0]['userId'] == 'u1' else ('u2', 'u1')
+    assert db.dump('users')[winner]['classes'] == [booked[0]['id']] and db.dump('users')[loser]['classes'] == []
+    # Only the profile that was written is dropped from the user cache
+    assert user_cache.get_by_id(winner) is None and user_cache.get_by_id(loser) is not None
+
+
+def test_cancel_class_refunds_and_frees_slot(db):
+    booked = asyncio.run(book_class(db, 'u1', class_data()))
+    result = asyncio.run(cancel_class(db, booked['id']))
+
+    assert result['refunded'] is True
+    assert db.dump('users')['u1'] == {'id': 'u1', 'name': 'Anna', 'telegram': 'anna', 'membership': 2, 'classes': []}
+    assert db.dump('classes') == {}
+    assert db.dump('slots') == {}
+    assert asyncio.run(cancel_class(db, booked['id'])) is None
+
+
+def test_transaction_retries_after_concurrent_write(db):
+    transaction = db.transaction(max_attempts=3)
+    user_ref = db.collection('users').document('u1')
+    attempts = []
+
+    @firestore.transactional
+    def add_point(transaction):
+        snapshot = user_ref.get(transaction=transaction)
+        if not attempts:
+            # A write from outside the transaction between its read and its commit
+            user_ref.update({'membership': firestore.Increment(10)})
+        attempts.append(snapshot.get('membership'))
+        transaction.update(user_ref, {'membership': snapshot.get('membership') + 1})
+
+    add_point(transaction)
+
+    assert attempts == [2, 12]
+    assert db.dump('users')['u1']['membership'] == 13
+    assert db.aborted_commits == 1
+
+
+def test_load_run_reports_every_handler():
+    report = asyncio.run(run_load(students=6, admins=1, rounds=1, cancel_ratio=1.0, schedule_days=2))
+    summary = report.summary()
+
+    for handler in ('NEWCLASS', 'CANCELCLASS', 'SCHEDULE'):
+        assert summary[handler]['count'] > 0
+        assert summary[handler]['errors'] == 0
+        assert summary[handler]['p50'] <= summary[handler]['p95'] <= summary[handler]['p99']
+    assert report.bot_calls['setMyCommands'] > 0
+
+
+def test_user_cache_expires_evicts_and_isolates_profiles(clock):
+    from user_cache import UserCache
+
+    cache = UserCache(maxsize=2, ttl=60, timer=clock)
+    anna = {'id': 'u1', 'telegram': 'anna', 'classes': ['c1']}
+    cache.put(anna)
+    # Copies in and out: neither the stored nor a returned profile can be changed from outside
+    anna['classes'].append('c2')
+    cache.get_by_id('u1')['classes'].append('c3')
+    assert cache.get_by_username('anna') == {'id': 'u1', 'telegram': 'anna', 'classes': ['c1']}
+
+    cache.put({'id': 'u2', 'telegram': 'boris'})
+    cache.get_by_id('u1')
+    cache.put({'id': 'u3', 'telegram': 'clara'})
+    # u2 was the least recently used profile
+    assert cache.get_by_id('u2') is None and cache.get_by_username('boris') is None
+    assert cache.get_by_id('u1') is not None and cache.get_by_username('clara')['id'] == 'u3'
+
+    clock.advance(61)
+    assert cache.get_by_id('u1') is None and cache.get_by_username('clara') is None
+    assert cache.stats()['size'] == 0
+
+
+def test_user_cache_is_invalidated_by_writes(db):
+    from firebase_utils import get_user_by_telegram_username, user_cache
+
+    async def run():
+        before = await get_user_by_telegram_username(db, 'anna')
+        rpcs = db.rpc_count
+        cached = await get_user_by_telegram_username(db, 'anna')
+        cached_rpcs = db.rpc_count - rpcs
+        await book_class(db, 'u1', class_data())
+        return before, cached, cached_rpcs, await get_user_by_telegram_username(db, 'anna')
+
+    before, cached, cached_rpcs, after = asyncio.run(run())
+
+    assert cached == before and cached_rpcs == 0
+    assert before['membership'] == 2 and after['membership'] == 1 and len(after['classes']) == 1
+
+    user_cache.invalidate(username='anna')
+    assert user_cache.get_by_username('anna') is None and user_cache.get_by_id('u1') is None
+
+
+def test_slot_index_claims_releases_and_reloads_after_ttl(db, clock, monkeypatch):
+    import types
+    import slot_index as slot_index_module
+    from slot_index import SlotIndex
+
+    monkeypatch.setattr(slot_index_module, 'time', types.SimpleNamespace(monotonic=clock))
+    seed_classes(db, ['2030-01-07T09:00:00+00:00'])  # 12:00 local
+    index = SlotIndex(ttl=60)
+
+    async def run():
+        results = {'taken': await index.claim(db, '2030-01-07', 12), 'free': await index.claim(db, '2030-01-07', 13)}
+        results['twice'] = await index.claim(db, '2030-01-07', 13)
+        index.release('2030-01-07', 13)
+        results['released'] = await index.is_free(db, '2030-01-07', 13)
+        index.occupy('2030-01-07', 15)
+        index.occupy('2030-01-08', 15)  # not loaded: nothing to update
+        results['occupied'] = await index.is_free(db, '2030-01-07', 15)
+        results['loads'] = db.rpc_count
+
+        # A booking made outside the bot is seen once the day is older than the TTL
+        db.seed('classes', {'web': {'userId': 'u2', 'status': 'в ожидании', 'startdate': '2030-01-07T11:00:00+00:00', 'message': ''}})
+        clock.advance(30)
+        results['before_ttl'] = await index.is_free(db, '2030-01-07', 14)
+        clock.advance(31)
+        results['after_ttl'] = await index.is_free(db, '2030-01-07', 14)
+        results['reloads'] = db.rpc_count - results['loads']
+        return results
+
+    results = asyncio.run(run())
+
+    assert results['taken'] is False and results['free'] is True and results['twice'] is False
+    assert results['released'] is True and results['occupied'] is False
+    assert results['loads'] == 1
+    assert results['before_ttl'] is True and results['after_ttl'] is False and results['reloads'] == 1
+
+
+def test_webhook_rejects_wrong_secret_and_reports_health(bot):
+    from starlette.testclient import TestClient
+    from webhook import create_webhook_app
+
+    async def scenario(bot):
+        update = bot.factory.message(1, 'anna', '/start').to_dict()
+        app = create_webhook_app(bot.application, secret_token='s3cret')
+        with TestClient(app) as client:
+            starting = client.get('/healthcheck')
+            rejected = [
+                client.post('/telegram', json=update),
+                client.post('/telegram', json=update, headers={'X-Telegram-Bot-Api-Secret-Token': 'wrong'}),
+            ]
+            queued_after_rejects = bot.application.update_queue.qsize()
+            malformed = client.post('/telegram', content=b'not json', headers={'X-Telegram-Bot-Api-Secret-Token': 's3cret'})
+            accepted = client.post('/telegram', json=update, headers={'X-Telegram-Bot-Api-Secret-Token': 's3cret'})
+            queued = bot.application.update_queue.qsize()
+            await bot.application.start()
+            try:
+                running = client.get('/healthcheck')
+            finally:
+                await bot.application.stop()
+        return starting, rejected, queued_after_rejects, malformed, accepted, queued, running
+
+    starting, rejected, queued_after_rejects, malformed, accepted, queued, running = bot.run(scenario)
+
+    assert [response.status_code for response in rejected] == [403, 403] and queued_after_rejects == 0
+    assert malformed.status_code == 400
+    assert accepted.status_code == 200 and queued == 1
+    assert starting.status_code == 503 and starting.json()['status'] == 'starting'
+    assert running.status_code == 200 and running.json()['status'] == 'ok'
+    assert {'pending_updates', 'update_processor', 'rate_limiter'} <= set(running.json())
+
+
+
+def test_schedule_keeps_only_plain_data_in_persisted_user_data(admin_db, bot):
+    import pickle
+    from datetime import datetime
+    from utils import ST_PETERSBURG
+
+    today = datetime.now(ST_PETERSBURG).date().isoformat()
+    seed_classes(admin_db, [f"{today}T06:00:00+00:00", f"{today}T07:00:00+00:00"])
+
+    async def scenario(bot):
+        user_data = bot.application.user_data[7]
+        await bot.send(7, 'admin', '/schedule')
+        await bot.press(7, 'admin', encode(Action.CLASS, 'c0'))
+        await bot.press(7, 'admin', encode(Action.EDIT_STATUS))
+        selected = pickle.dumps(dict(user_data))
+        await bot.press(7, 'admin', encode(Action.BACK_TO_SCHEDULE))
+        await bot.press(7, 'admin', encode(Action.BULK_START))
+        await bot.press(7, 'admin', encode(Action.BULK_TOGGLE, 'c1'))
+        return selected, pickle.dumps(dict(user_data)), bot.keyboard(7)
+
+    selected, bulk, bulk_keyboard = bot.run(scenario)
+
+    # A change of ClassRecord cannot break the loading of persisted conversations
+    assert b'class_record' not in selected and b'class_record' not in bulk
+    assert pickle.loads(selected)['selected_class_data']['id'] == 'c0'
+    assert [class_data['id'] for class_data in pickle.loads(bulk)['bulk_classes']] == ['c0', 'c1']
+    assert encode(Action.BULK_STATUS, 'выполнено') in bulk_keyboard
+
+
+def test_update_processor_keeps_chat_order_and_caps_concurrency():
+    from fake_bot import UpdateFactory, make_bot
+    from update_processor import ChatOrderedUpdateProcessor
+
+    factory = UpdateFactory(make_bot())
+    events = []
+
+    async def run():
+        processor = ChatOrderedUpdateProcessor(max_concurrent_updates=2, max_pending_updates=10)
+        gates = {name: asyncio.Event() for name in ('a1', 'a2', 'b1', 'c1')}
+
+        async def handle(name):
+            events.append(f"start {name}")
+            await gates[name].wait()
+            events.append(f"end {name}")
+
+        async def settle():
+            for _ in range(5):
+                await asyncio.sleep(0)
+
+        updates = [('a1', 1), ('a2', 1), ('b1', 2), ('c1', 3)]
+        tasks = [
+            asyncio.create_task(processor.process_update(factory.message(chat_id, 'user', name), handle(name)))
+            for name, chat_id in updates
+        ]
+        await settle()
+        # a2 waits for a1 of the same chat, c1 for a free slot
+        first = list(events), processor.metrics()['running']
+        gates['b1'].set()
+        await settle()
+        second = list(events)
+        gates['a1'].set()
+        await settle()
+        gates['a2'].set()
+        gates['c1'].set()
+        await asyncio.gather(*tasks)
+        return first, second, processor.metrics()
+
+    (first_events, first_running), second_events, metrics = asyncio.run(run())
+
+    assert first_events == ['start a1', 'start b1'] and first_running == 2
+    assert second_events == ['start a1', 'start b1', 'end b1', 'start c1']
+    assert events.index('end a1') < events.index('start a2')
+    assert metrics['processed'] == 4 and metrics['running'] == 0 and metrics['active_chats'] == 0
+
+
+def test_set_chat_commands_skips_repeats_and_evicts_oldest_chat(bot, monkeypatch):
+    import utils
+    from telegram import BotCommand
+    from telegram.ext import CallbackContext
+
+    monkeypatch.setattr(utils, 'COMMAND_CACHE_SIZE', 2)
+    commands = [BotCommand('start', 'Начать'), BotCommand('cancel', 'Отмена')]
+
+    async def scenario(bot):
+        context = CallbackContext(bot.application)
+        for chat_id in (1, 1, 2, 1, 3):
+            await utils.set_chat_commands(context, chat_id, commands)
+        cached = list(bot.application.bot_data['command_scopes'])
+        await utils.set_chat_commands(context, 2, commands)
+        await utils.set_chat_commands(context, 3, commands)
+        return cached
+
+    cached = bot.run(scenario)
+
+    pushed = [params['scope']['chat_id'] for endpoint, params in bot.request.calls if endpoint == 'setMyCommands']
+    # The repeated lists of chats 1 and 3 were skipped, chat 2 was evicted and is pushed again
+    assert pushed == [1, 2, 3, 2]
+    assert cached == [1, 3]
+
+
+def make_limiter(clock, **limits):
+    from rate_limiter import OutboundRateLimiter
+
+    calls = []
+
+    async def callback(endpoint, chat_id, text=''):
+        calls.append((clock(), endpoint, chat_id, text))
+        return {'chat_id': chat_id, 'text': text}
+
+    limiter = OutboundRateLimiter(clock=clock, sleep=clock.sleep, **limits)
+
+    def request(endpoint, chat_id, text='', **data):
+        data.update(chat_id=chat_id)
+        return limiter.process_request(callback, (endpoint, chat_id, text), {}, endpoint, data, None)
+
+    return limiter, request, calls
+
+
+def test_rate_limiter_paces_each_chat_and_all_chats(clock):
+    limiter, request, calls = make_limiter(clock, global_per_second=2, chat_per_second=1, chat_burst=1)
+
+    async def run():
+        for chat_id in (1, 1, 1):
+            await request('sendMessage', chat_id)
+        # Another chat has its own bucket, only the global rate applies
+        await request('sendMessage', 2)
+        for chat_id in (3, 4, 5):
+            await request('sendMessage', chat_id)
+
+    asyncio.run(run())
+
+    assert [call[0] for call in calls[:3]] == [0.0, 1.0, 2.0]
+    assert calls[3][0] == 2.0
+    # Two requests per second overall
+    assert [call[0] for call in calls[3:]] == [2.0, 2.5, 3.0, 3.5]
+    assert limiter.metrics()['requests'] == 7 and limiter.metrics()['throttled'] == 5
+
+
+def test_rate_limiter_pauses_and_retries_after_flood_control(clock):
+    from telegram.error import RetryAfter
+    from rate_limiter import OutboundRateLimiter
+
+    attempts = []
+
+    async def flooded(text):
+        attempts.append(clock())
+        if len(attempts) < 3:
+            raise RetryAfter(5)
+        return text
+
+    limiter = OutboundRateLimiter(max_retries=2, clock=clock, sleep=clock.sleep)
+    result = asyncio.run(limiter.process_request(flooded, ('hi',), {}, 'sendMessage', {'chat_id': 1}, None))
+
+    assert result == 'hi'
+    assert attempts == [0.0, 5.0, 10.0]
+    assert limiter.metrics()['retries_after'] == 2
+
+    attempts.clear()
+    with pytest.raises(RetryAfter):
+        asyncio.run(limiter.process_request(flooded, ('hi',), {}, 'sendMessage', {'chat_id': 1}, 1))
+    assert len(attempts) == 2
+
+
+def test_rate_limiter_coalesces_edits_without_spending_tokens(clock):
+    limiter, request, calls = make_limiter(clock, chat_per_second=1, chat_burst=1)
+
+    async def run():
+        await request('sendMessage', 1, 'schedule')
+        # Three edits of the same message while the chat has no token left
+        edits = [
+            asyncio.create_task(request('editMessageText', 1, f"day {day}", message_id=1000))
+            for day in (1, 2, 3)
+        ]
+        results = await asyncio.gather(*edits)
+        await request('sendMessage', 1, 'next')
+        return results
+
+    results = asyncio.run(run())
+
+    assert [(call[0], call[1], call[3]) for call in calls] == [
+        (0.0, 'sendMessage', 'schedule'),
+        (1.0, 'editMessageText', 'day 3'),
+        # The superseded edits gave their tokens back
+        (2.0, 'sendMessage', 'next'),
+    ]
+    assert [result['text'] for result in results] == ['day 3'] * 3
+    assert limiter.metrics()['coalesced_edits'] == 2
+
+
+def test_rate_limiter_retried_edit_resolves_to_a_newer_finished_edit(clock):
+    from telegram.error import RetryAfter
+    from rate_limiter import OutboundRateLimiter
+
+    limiter = OutboundRateLimiter(chat_per_second=1, chat_burst=2, clock=clock, sleep=clock.sleep)
+    sent = []
+    flooded = asyncio.Event()
+
+    async def edit(text):
+        sent.append(text)
+        if text == 'day 1':
+            await flooded.wait()
+            raise RetryAfter(1)
+        return {'text': text}
+
+    def request(text):
+        data = {'chat_id': 1, 'message_id': 1000}
+        return limiter.process_request(edit, (text,), {}, 'editMessageText', data, None)
+
+    async def run():
+        older = asyncio.create_task(request('day 1'))
+        await asyncio.sleep(0)
+        # The newer edit is sent and finishes while the older one is still in flight, then the older one is
+        # answered with a flood-control error
+        newer = await request('day 2')
+        flooded.set()
+        return await older, newer
+
+    older, newer = asyncio.run(run())
+
+    assert older == newer == {'text': 'day 2'}
+    assert sent == ['day 1', 'day 2']  # the older edit was not sent again over the newer one
+    assert limiter.metrics()['coalesced_edits'] == 1
+    assert limiter._pending_edits == {} and limiter._edits_in_flight == {}
+
+
+def test_sqlite_persistence_writes_changes_staged_during_a_write(tmp_path):
+    from persistence import SQLitePersistence
+
+    path = str(tmp_path / 'state.sqlite3')
+
+    async def run():
+        persistence = SQLitePersistence(path)
+        await persistence.update_user_data(7, {'filter_by_this_date': '2030-01-07'})
+        # Let the write of the first change start, then stage another one while it runs
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        await persistence.update_conversation('schedule', (7, 7), 1)
+        await persistence._write_task
+        unwritten = dict(persistence._pending)
+
+        # A new process reading the same file, without a flush of the first one
+        restarted = SQLitePersistence(path)
+        state = await restarted.get_conversations('schedule'), await restarted.get_user_data()
+        await restarted.flush()
+        await persistence.flush()
+        return unwritten, state
+
+    unwritten, (conversations, user_data) = asyncio.run(run())
+
+    assert unwritten == {}
+    assert conversations == {(7, 7): 1}
+    assert user_data == {7: {'filter_by_this_date': '2030-01-07'}}
+
+
+def test_class_record_formats_local_time_and_survives_pickling():
+    import copy
+    import pickle
+    from class_record import ClassRecord
+
+    record = ClassRecord.from_dict({
+        'userId': 'u1', 'status': 'подтверждено', 'startdate': '2030-01-07T09:00:00.000Z',
+        'enddate': '2030-01-07T10:00:00.000Z', 'message': 'hi', 'isMembershipUsed': True,
+    }, 'c1')
+
+    assert record.label == '07.01.2030 12:00 | статус: подтверждено'
+    assert record['userId'] == 'u1' and record.get('isMembershipUsed') is True and record.get('missing', 1) == 1
+    for restored in (pickle.loads(pickle.dumps(record)), copy.deepcopy(record)):
+        assert restored == record
+        assert restored.start_text == '07.01.2030 12:00'
+
+
+def test_get_classes_by_date_uses_local_day_bounds(db):
+    from firebase_utils import get_classes_by_date
+
+    seed_classes(db, [
+        '2030-01-06T20:59:59.000Z',   # 06.01 23:59 local
+        '2030-01-06T21:00:00.000Z',   # 07.01 00:00 local
+        '2030-01-07T09:00:00+00:00',  # 07.01 12:00 local
+        '2030-01-07T20:30:00+00:00',  # 07.01 23:30 local
+        '2030-01-07T21:00:00+00:00',  # 08.01 00:00 local
+    ])
+    classes = asyncio.run(get_classes_by_date(db, '2030-01-07'))
+
+    assert [class_record.id for class_record in classes] == ['c1', 'c2', 'c3']
+
+
+def test_schedule_cache_loads_week_once_and_prefetches_neighbours(db):
+    from datetime import date
+    from schedule_cache import ScheduleCache
+
+    seed_classes(db, ['2030-01-07T09:00:00+00:00', '2030-01-09T09:00:00+00:00', '2030-01-14T09:00:00+00:00'])
+    cache = ScheduleCache(ttl=60)
+
+    async def browse():
+        days = [await cache.get_day(db, 1, date(2030, 1, day)) for day in (7, 8, 9)]
+        await asyncio.sleep(0.05)  # let the background prefetches finish
+        rpcs = db.rpc_count
+        next_monday = await cache.get_day(db, 1, date(2030, 1, 14))
+        await asyncio.sleep(0.05)
+        return days, rpcs, next_monday
+
+    days, rpcs, next_monday = asyncio.run(browse())
+
+    assert [[class_record.id for class_record in day] for day in days] == [['c0'], [], ['c1']]
+    assert [class_record.id for class_record in next_monday] == ['c2']
+    assert rpcs == 3  # the viewed week and both neighbours
+    assert db.rpc_count == rpcs + 1  # the next week was prefetched, only the week after it is loaded now
+    assert cache.stats()['misses'] == 1
+
+    cache.invalidate_day(date(2030, 1, 8))
+    asyncio.run(cache.get_day(db, 1, date(2030, 1, 9)))
+    assert cache.stats()['misses'] == 2
+
+
+def test_schedule_month_overview_drills_into_day(admin_db, bot):
+    from datetime import datetime
+    from handlers_schedule import classes_count_text
+    from utils import ST_PETERSBURG
+
+    today = datetime.now(ST_PETERSBURG).date()
+    seed_classes(admin_db, [
+        f"{today.isoformat()}T06:00:00+00:00",
+        f"{today.isoformat()}T07:00:00.000Z",
+        f"{today.replace(day=1).isoformat()}T08:00:00+00:00",
+    ])
+
+    async def scenario(bot):
+        await bot.send(7, 'admin', '/schedule month')
+        overview = bot.keyboard(7)
+        await bot.press(7, 'admin', encode(Action.DAY, today.isoformat()))
+        return overview, bot.keyboard(7)
+
+    overview, day_view = bot.run(scenario)
+
+    assert encode(Action.DAY, today.isoformat()) in overview
+    assert encode(Action.RANGE_NEXT) in overview
+    assert len([data for data in overview if decode(data).action == Action.DAY]) <= 7
+    overview_text = next(params['text'] for endpoint, params in bot.request.calls if endpoint == 'editMessageText' and 'Расписание на месяц' in params['text'])
+    assert classes_count_text(3) in overview_text
+    day_classes = sorted(decode(data).args[0] for data in day_view if decode(data).action == Action.CLASS)
+    assert day_classes == (['c0', 'c1', 'c2'] if today.day == 1 else ['c0', 'c1'])
+    assert [classes_count_text(n) for n in (1, 3, 5, 11, 22)] == ['1 занятие', '3 занятия', '5 занятий', '11 занятий', '22 занятия']
+
+
+def test_live_index_serves_reads_and_follows_external_changes(db):
+    from datetime import datetime, timedelta, timezone
+    from firebase_utils import get_class_by_id, get_classes_by_date, get_user_by_telegram_username, live_index, start_live_index, stop_live_index
+    from live_index import NOT_INDEXED
+
+    tomorrow = datetime.now(timezone.utc).replace(hour=9, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    seed_classes(db, [tomorrow.isoformat(), (tomorrow + timedelta(days=365)).isoformat()])
+
+    async def run():
+        await start_live_index(db)
+        try:
+            rpcs = db.rpc_count
+            user = await get_user_by_telegram_username(db, 'anna')
+            day = await get_classes_by_date(db, tomorrow.date().isoformat())
+            indexed_rpcs = db.rpc_count - rpcs
+
+            # Written by the web app: delivered by the listeners
+            db.collection('classes').document('c0').update({'status': 'подтверждено'})
+            db.collection('users').document('u1').update({'membership': 5})
+            changed_class = await get_class_by_id(db, 'c0')
+            changed_user = await get_user_by_telegram_username(db, 'anna')
+
+            # Outside the window: read from Firestore
+            rpcs = db.rpc_count
+            far_class = await get_class_by_id(db, 'c1')
+            return user, day, indexed_rpcs, changed_class, changed_user, far_class, db.rpc_count - rpcs
+        finally:
+            await stop_live_index()
+
+    user, day, indexed_rpcs, changed_class, changed_user, far_class, far_rpcs = asyncio.run(run())
+
+    assert user['id'] == 'u1' and [class_record.id for class_record in day] == ['c0']
+    assert indexed_rpcs == 0
+    assert changed_class.status == 'подтверждено' and changed_user['membership'] == 5
+    assert far_class.id == 'c1' and far_rpcs == 1
+    assert not live_index.running
+
+    # A stopped (or disabled) index answers nothing and does not count its reads as misses
+    stats = live_index.stats()
+    assert live_index.get_class('c0') is NOT_INDEXED and live_index.get_user_by_username('anna') is NOT_INDEXED
+    assert live_index.get_user_by_id('u1') is NOT_INDEXED
+    assert live_index.get_classes_between(tomorrow, tomorrow + timedelta(days=1)) is NOT_INDEXED
+    assert (live_index.stats()['hits'], live_index.stats()['misses']) == (stats['hits'], stats['misses'])
+
+
+def test_jobs_remind_once_and_complete_past_classes(db, bot):
+    from datetime import datetime, timedelta, timezone
+    from telegram.ext import CallbackContext
+    from jobs import complete_past_classes, get_job_stats, send_reminders
+
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    seed_classes(db, [
+        (now + timedelta(hours=3)).isoformat(),   # c0: upcoming, reminded
+        (now - timedelta(hours=3)).isoformat(),   # c1: ended, confirmed
+        (now - timedelta(minutes=30)).isoformat(),  # c2: confirmed, still running
+    ])
+    db.collection('classes').document('c1').update({'status': 'подтверждено', 'enddate': (now - timedelta(hours=2)).isoformat()})
+    db.collection('classes').document('c2').update({'status': 'подтверждено', 'enddate': (now + timedelta(minutes=30)).isoformat()})
+    # c3: upcoming, its student blocked the bot
+    db.seed('classes', {'c3': {'userId': 'u2', 'status': 'в ожидании', 'startdate': (now + timedelta(hours=4)).isoformat(), 'message': ''}})
+
+    async def scenario(bot):
+        bot.request.blocked_chats.add(102)
+        context = CallbackContext(bot.application)
+        sent = [await send_reminders(context), await send_reminders(context)]
+        return sent, await complete_past_classes(context)
+
+    sent, completed = bot.run(scenario, chat_ids={'anna': 101, 'boris': 102})
+
+    # The blocked student is not counted and not retried
+    assert sent == [1, 0]
+    assert sorted(int(params['chat_id']) for endpoint, params in bot.request.calls if endpoint == 'sendMessage') == [101, 102]
+    assert set(bot.application.bot_data['reminded_classes']) == {'c0', 'c3'}
+    assert completed == 1
+    statuses = {class_id: class_data['status'] for class_id, class_data in db.dump('classes').items()}
+    assert statuses == {'c0': 'в ожидании', 'c1': 'выполнено', 'c2': 'подтверждено', 'c3': 'в ожидании'}
+    assert get_job_stats()['reminders']['runs'] >= 2 and get_job_stats()['auto_status']['errors'] == 0
+
+
+def test_metrics_time_handlers_and_count_firestore_calls(db, bot):
+    import httpx
+    from metrics import metrics, start_metrics_server
+
+    metrics.reset()
+
+    async def scenario(bot):
+        await bot.send(1, 'anna', '/start')
+        await bot.send(1, 'anna', '/start')
+
+        server = await start_metrics_server('127.0.0.1', 0)
+        try:
+            async with httpx.AsyncClient() as client:
+                return await client.get(f"http://127.0.0.1:{server.port}/metrics")
+        finally:
+            await server.stop()
+
+    response = bot.run(scenario)
+    snapshot = metrics.snapshot()
+
+    start = snapshot['handlers']['start']
+    assert start['latency_ms']['count'] == 2 and start['errors'] == 0
+    # The first run reads the user from Firestore, the second one from the user cache
+    assert start['firestore_calls_per_run']['count'] == 2 and start['firestore_calls_per_run']['max'] == 1
+    assert snapshot['firestore']['get_user_by_telegram_username']['latency_ms']['count'] == 2
+    assert 'start n=2' in metrics.summary()
+    assert response.status_code == 200 and response.headers['content-type'] == 'application/json'
+    assert response.json()['handlers']['start']['latency_ms']['count'] == 2
+
+
+def test_metrics_do_not_count_background_prefetches_for_the_handler(db):
+    from datetime import date
+    from metrics import instrument_callback, metrics
+    from schedule_cache import ScheduleCache
+
+    metrics.reset()
+    cache = ScheduleCache(ttl=60)
+
+    async def view_day(update, context):
+        await cache.get_day(db, 1, date(2030, 1, 7))
+        # The neighbouring weeks are prefetched by tasks started from this handler: let them finish in it
+        for _ in range(100):
+            if db.rpc_count == 3:
+                break
+            await asyncio.sleep(0.01)
+
+    asyncio.run(instrument_callback('view_day', view_day)(None, None))
+
+    assert db.rpc_count == 3
+    # Only the viewed week is the handler's own call
+    assert metrics.snapshot()['handlers']['view_day']['firestore_calls_per_run']['max'] == 1
+
+
+def test_webhook_app_serves_metrics_only_when_enabled(bot):
+    from starlette.testclient import TestClient
+    from webhook import create_webhook_app
+
+    async def scenario(bot):
+        with TestClient(create_webhook_app(bot.application, serve_metrics=True)) as client:
+            enabled = client.get('/metrics')
+        with TestClient(create_webhook_app(bot.application)) as client:
+            disabled = client.get('/metrics')
+        return enabled, disabled
+
+    enabled, disabled = bot.run(scenario)
+
+    assert enabled.status_code == 200 and 'handlers' in enabled.json()
+    assert disabled.status_code == 404
+
+
+def test_logging_pipeline_samples_info_and_writes_json(tmp_path):
+    import json
+    import logging
+    from bot_logging import setup_logging, stop_logging
+
+    root = logging.getLogger()
+    saved_handlers, saved_level = list(root.handlers), root.level
+    log_file = tmp_path / 'bot.log'
+    try:
+        setup_logging(str(log_file), json_format=True, sample_every=3, max_bytes=2048, backup_count=5)
+        for i in range(6):
+            logging.info(f"noisy {i}")
+        logging.info("summary", extra={'sample': False, 'updates': 7})
+        logging.warning("careful")
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            logging.exception("failed")
+        for i in range(20):
+            logging.warning(f"filler {i}")
+        stop_logging()
+    finally:
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        for handler in saved_handlers:
+            root.addHandler(handler)
+        root.setLevel(saved_level)
+
+    files = sorted(tmp_path.iterdir(), key=lambda path: -int(path.suffix[1:]) if path.suffix[1:].isdigit() else 0)
+    assert len(files) > 1 and all(path.stat().st_size <= 2048 for path in files)  # rotated by size
+    entries = [json.loads(line) for path in files for line in path.read_text(encoding='utf-8').splitlines()]
+    messages = [entry['message'] for entry in entries]
+    assert messages == ['noisy 0', 'noisy 3', 'summary', 'careful', 'failed'] + [f"filler {i}" for i in range(20)]
+    assert entries[2]['updates'] == 7
+    assert 'ValueError: boom' in entries[4]['exception']
+
+
+def test_schedule_bulk_status_update_writes_once_and_edits_in_place(admin_db, bot):
+    from datetime import datetime
+    from utils import ST_PETERSBURG
+
+    today = datetime.now(ST_PETERSBURG).date().isoformat()
+    seed_classes(admin_db, [f"{today}T06:00:00+00:00", f"{today}T07:00:00+00:00", f"{today}T08:00:00+00:00"])
+
+    async def scenario(bot):
+        await bot.send(7, 'admin', '/schedule')
+        await bot.press(7, 'admin', encode(Action.BULK_START))
+        await bot.press(7, 'admin', encode(Action.BULK_TOGGLE, 'c0'))
+        await bot.press(7, 'admin', encode(Action.BULK_TOGGLE, 'c2'))
+        bulk_keyboard = bot.keyboard(7)
+        # Neighbouring weeks are prefetched in the background: let them finish before counting
+        await bot.settle()
+        calls_before, rpcs_before = len(bot.request.calls), admin_db.rpc_count
+        await bot.press(7, 'admin', encode(Action.BULK_STATUS, 'выполнено'))
+        return bulk_keyboard, bot.request.calls[calls_before:], admin_db.rpc_count - rpcs_before
+
+    bulk_keyboard, apply_calls, apply_rpcs = bot.run(scenario)
+
+    assert encode(Action.BULK_STATUS, 'выполнено') in bulk_keyboard and encode(Action.BULK_ALL) in bulk_keyboard
+    statuses = {class_id: class_data['status'] for class_id, class_data in admin_db.dump('classes').items()}
+    assert statuses == {'c0': 'выполнено', 'c1': 'в ожидании', 'c2': 'выполнено'}
+    assert apply_rpcs == 1  # one batched commit, the day is re-rendered from memory
+    assert [endpoint for endpoint, params in apply_calls] == ['answerCallbackQuery', 'editMessageText']
+    assert 'выполнено' in str(apply_calls[-1][1]['reply_markup']) and '2 занятия' in apply_calls[-1][1]['text']
+
+
+def test_schedule_bulk_status_update_skips_deleted_and_unchanged_classes(admin_db, bot):
+    from datetime import datetime
+    from utils import ST_PETERSBURG
+
+    today = datetime.now(ST_PETERSBURG).date().isoformat()
+    seed_classes(admin_db, [f"{today}T06:00:00+00:00", f"{today}T07:00:00+00:00", f"{today}T08:00:00+00:00"])
+    admin_db.collection('classes').document('c1').update({'status': 'выполнено'})
+
+    async def scenario(bot):
+        await bot.send(7, 'admin', '/schedule')
+        await bot.press(7, 'admin', encode(Action.BULK_START))
+        await bot.press(7, 'admin', encode(Action.BULK_ALL))
+        # Deleted in the web app while the admin was ticking classes
+        admin_db.collection('classes').document('c2').delete()
+        await bot.press(7, 'admin', encode(Action.BULK_STATUS, 'выполнено'))
+        return bot.request.calls[-1][1], bot.keyboard(7)
+
+    day_view, day_keyboard = bot.run(scenario)
+
+    statuses = {class_id: class_data['status'] for class_id, class_data in admin_db.dump('classes').items()}
+    assert statuses == {'c0': 'выполнено', 'c1': 'выполнено'}
+    assert "установлен: 1 занятие" in day_view['text']
+    assert 'Уже имели этот статус: 1 занятие' in day_view['text'] and 'Не найдены (удалены): 1 занятие' in day_view['text']
+    # The day is shown without the deleted class
+    assert encode(Action.CLASS, 'c2') not in day_keyboard and encode(Action.CLASS, 'c0') in day_keyboard
+
+
+def test_schedule_navigation_edits_one_message(admin_db, bot):
+    async def scenario(bot):
+        await bot.send(7, 'admin', '/schedule')
+        opening_calls = len(bot.request.calls)
+        buttons = [
+            encode(Action.NEXT_DAY), encode(Action.NEXT_DAY), encode(Action.PREV_DAY), encode(Action.MODE, 'week'),
+            encode(Action.RANGE_NEXT),
+        ]
+        for data in buttons:
+            await bot.press(7, 'admin', data, message_id=1000)
+        return opening_calls
+
+    opening_calls = bot.run(scenario)
+    calls = bot.request.calls
+
+    # The /schedule reply is the only message sent; it is then turned into the schedule and edited on every tap
+    message_calls = [(endpoint, params) for endpoint, params in calls if endpoint in ('sendMessage', 'editMessageText', 'editMessageReplyMarkup')]
+    assert [endpoint for endpoint, params in message_calls] == ['sendMessage'] + ['editMessageText'] * 6
+    assert all(int(params['message_id']) == 1000 for endpoint, params in message_calls[1:])
+    navigation_calls = [endpoint for endpoint, params in calls[opening_calls:]]
+    assert navigation_calls == ['answerCallbackQuery', 'editMessageText'] * 5
+
+
+def test_callback_codec_round_trips_and_answers_outdated_buttons(admin_db, bot):
+    data = encode(Action.STATUS, 'выполнено')
+    assert decode(data) == (Action.STATUS, ['выполнено'])
+    assert decode('STATUS_выполнено') is None and decode('9|st|x') is None
+    with pytest.raises(ValueError):
+        encode(Action.CLASS, 'a|b')
+    with pytest.raises(ValueError):
+        encode(Action.CLASS, 'x' * 64)
+
+    async def scenario(bot):
+        # A button of the old format and a button of a conversation that is not active
+        await bot.press(7, 'admin', 'NEXT_DAY')
+        await bot.press(7, 'admin', encode(Action.BULK_ALL))
+
+    bot.run(scenario)
+
+    answers = [params for endpoint, params in bot.request.calls if endpoint == 'answerCallbackQuery']
+    assert len(answers) == 2 and all('/start' in params['text'] for params in answers)
\ No newline at end of file